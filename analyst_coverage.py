@@ -27,6 +27,8 @@ from database import database
 from data import data
 from strategy_data import strategy_data
 from strategy import strategy
+from batch_regression import batch_regression
+from rank_kernel import rank_kernel
 
 # 分析师预测覆盖因子的单因子策略
 
@@ -453,25 +455,20 @@ class analyst_coverage(single_factor_strategy):
         # 生成调仓日
         self.generate_holding_days(holding_freq='m', start_date='2007-01-01')
 
-        # 建立储存数据的dataframe
-        abn_coverage = self.strategy_data.raw_data.ix['ln_coverage', self.holding_days, :] * np.nan
+        # 建立储存数据的panel
         self.reg_stats = pd.Panel(np.nan, items=['coef', 't_stats', 'rsquare'],
                         major_axis=self.holding_days, minor_axis=['int', 'lncap', 'turnover', 'momentum'])
-        # 对调仓日进行循环回归
-        for cursor, time in enumerate(self.holding_days):
-            y = self.strategy_data.raw_data.ix['ln_coverage', time, :]
-            x = self.strategy_data.stock_price.ix[['lncap', 'turnover', 'momentum'], time, :]
-            x = sm.add_constant(x)
-            # 如果只有小于等于1个有效数据，则返回nan序列
-            if pd.concat([y, x], axis=1).dropna().shape[0] <= 3:
-                continue
-            model = sm.OLS(y, x, missing='drop')
-            results = model.fit()
-            abn_coverage.ix[time] = results.resid
-            self.reg_stats.ix['coef', time, :] = results.params.values
-            self.reg_stats.ix['t_stats', time, :] = results.tvalues.values
-            self.reg_stats.ix['rsquare', time, 0] = results.rsquared
-            self.reg_stats.ix['rsquare', time, 1] = results.rsquared_adj
+        # 所有调仓日的回归用批量回归一次完成，截距项为第一个变量
+        y = self.strategy_data.raw_data.ix['ln_coverage', self.holding_days, :]
+        x = self.strategy_data.stock_price.ix[['lncap', 'turnover', 'momentum'], self.holding_days, :]
+        # 如果只有小于等于3个有效数据，则这一期的结果为nan
+        resid, params, t_stats, p_values, rsquared, rsquared_adj = batch_regression.batch_wls(
+            y.values, x.reindex(minor_axis=y.columns).values, add_constant=True, min_obs=3)
+        abn_coverage = pd.DataFrame(resid, index=y.index, columns=y.columns)
+        self.reg_stats.ix['coef'] = params
+        self.reg_stats.ix['t_stats'] = t_stats
+        self.reg_stats.ix['rsquare', :, 0] = rsquared
+        self.reg_stats.ix['rsquare', :, 1] = rsquared_adj
 
         abn_coverage = abn_coverage.reindex(self.strategy_data.stock_price.major_axis, method='ffill')
         self.strategy_data.factor = pd.Panel({'abn_coverage':abn_coverage}, major_axis=
@@ -995,33 +992,20 @@ class analyst_coverage(single_factor_strategy):
         # abn coverage数据
         abn_coverage = self.base['abn_coverage']
 
-        def pct_rank_qcut(x, *, n):
-            if x.dropna().size <= 3:
-                return pd.Series(np.nan, index=x.index)
-            q_labels = pd.qcut(x, q=n, labels=['low', 'mid', 'high'])
-            return q_labels
-
-        # 将disp, ep, abn coverage分为3个分位点
-        disp_tercile = disp.apply(pct_rank_qcut, axis=1, n=3)
-        ep_tercile = ep.apply(pct_rank_qcut, axis=1, n=3)
-        abn_coverage_tercile = abn_coverage.apply(pct_rank_qcut, axis=1, n=3)
-        # 循环取得dummy变量
-        disp_dummies = pd.Panel(data=None, major_axis=disp.columns, minor_axis=['disp_low', 'disp_mid', 'disp_high'])
-        ep_dummies = pd.Panel(data=None, major_axis=disp.columns, minor_axis=['ep_low', 'ep_mid', 'ep_high'])
-        abn_coverage_dummies = pd.Panel(data=None, major_axis=disp.columns, minor_axis=['abn_coverage_low',
-                                        'abn_coverage_mid', 'abn_coverage_high'])
-        for cursor, time in enumerate(self.holding_days):
-            if disp_tercile.ix[time, :].dropna().size >= 3:
-                disp_dummies[time] = pd.get_dummies(disp_tercile.ix[time, :], prefix='disp')
-            if ep_tercile.ix[time, :].dropna().size >= 3:
-                ep_dummies[time] = pd.get_dummies(ep_tercile.ix[time, :], prefix='ep')
-            if abn_coverage_tercile.ix[time, :].dropna().size >= 3:
-                abn_coverage_dummies[time] = pd.get_dummies(abn_coverage_tercile.ix[time, :], prefix='abn_coverage')
-
-        # 循环结束后进行转置
-        disp_dummies = disp_dummies.transpose(2, 0, 1)
-        ep_dummies = ep_dummies.transpose(2, 0, 1)
-        abn_coverage_dummies = abn_coverage_dummies.transpose(2, 0, 1)
+        # 将disp, ep, abn coverage分为3个分位点，并取得dummy变量，有效数据不超过3个的期的dummy变量为nan
+        def get_tercile_dummies(x, *, prefix):
+            x = x.ix[self.holding_days, :]
+            labels = rank_kernel.get_qcut_labels(x.values, 3, min_valid=4)
+            has_labels = np.logical_not(np.isnan(labels)).any(1)[:, np.newaxis]
+            dummies = {}
+            for i, q in enumerate(['low', 'mid', 'high']):
+                dummies[prefix + '_' + q] = pd.DataFrame(np.where(has_labels, (labels == i).astype(float), np.nan),
+                                                         index=x.index, columns=x.columns)
+            return pd.Panel(dummies, items=[prefix + '_low', prefix + '_mid', prefix + '_high'])
+
+        disp_dummies = get_tercile_dummies(disp, prefix='disp')
+        ep_dummies = get_tercile_dummies(ep, prefix='ep')
+        abn_coverage_dummies = get_tercile_dummies(abn_coverage, prefix='abn_coverage')
         # 将所有的dummy变量链接成一个大的panel, 从中选取解释变量,并首先进行数据过滤
         dummy_base = pd.concat([abn_coverage_dummies, disp_dummies, ep_dummies], axis=0)
         for item, df in dummy_base.iteritems():
@@ -1120,16 +1104,11 @@ class analyst_coverage(single_factor_strategy):
         plt.hist(stacked_uc_old.values)
         plt.savefig(str(os.path.abspath('.')) + '/' + str(self.strategy_data.stock_pool) + '/kde_old.png', dpi=1200)
 
-        def pct_rank_qcut(x, *, n):
-            if x.dropna().size <= 3:
-                return pd.Series(np.nan, index=x.index)
-            q_labels = pd.qcut(x, q=n, labels=False)
-            return q_labels
-
         # 按照市值分组画图
         lncap = self.base.ix['lncap', self.holding_days, :]
-        # 将市值分成3组
-        lncap_labels = lncap.apply(pct_rank_qcut, axis=1, n=3)
+        # 将市值分成3组，有效数据不超过3个的期不分组
+        lncap_labels = pd.DataFrame(rank_kernel.get_qcut_labels(lncap.values, 3, min_valid=4),
+                                    index=lncap.index, columns=lncap.columns)
 
         # 根据每组市值进行画图
         for i, mv in enumerate(['s', 'm', 'l']):
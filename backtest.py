@@ -18,6 +18,7 @@ from backtest_data import backtest_data
 from position import position
 from performance import performance
 from performance_attribution import performance_attribution
+from trading_calendar import trading_calendar
 
 # 回测类，对给定的持仓进行回测
 # 添加支持卖空，但仅支持正杠杆的卖空，账户净值为0或者为负的不支持
@@ -80,6 +81,8 @@ class backtest(object):
         assert not stock_in_condition.any(), \
                'Some stocks in the input holding matrix are NOT included in the backtest database, '\
                'please check it carefully!\n'
+        # 回测数据的交易日历，回测中对交易日的查找都用交易日历中的整数位置
+        self.calendar = trading_calendar(self.bkt_data.stock_price.major_axis)
         # 检测回测数据是否覆盖了回测时间段
         # 检测起始时间
         if bkt_start == 'default':
@@ -97,7 +100,7 @@ class backtest(object):
                    'The default end time of backtest is later than the end time in backtest database, '\
                    'please try to set an earlier end time which must be a trading day\n'
             # 回测数据中的最后一天在最后一个调仓日后，现在判断是否之后有60个交易日可取
-            last_holding_loc = self.bkt_data.stock_price.major_axis.get_loc(self.bkt_position.holding_matrix.index[-1])
+            last_holding_loc = self.calendar.get_loc(self.bkt_position.holding_matrix.index[-1])
             total_size = self.bkt_data.stock_price.major_axis.size
             assert total_size>=last_holding_loc+1+60, \
                    'The default end time of backtest is later than the end time in backtest database, '\
@@ -109,14 +112,14 @@ class backtest(object):
         
         # 设置回测的起止时间，这里要注意默认的时间可能超过回测数据的范围
         # 起始时间：默认为第一个调仓日，如有输入数据，则为输入数据和默认时间的较晚日期
-        default_start = self.bkt_data.stock_price.major_axis[self.bkt_data.stock_price.major_axis.get_loc(self.bkt_position.holding_matrix.index[0])]
+        default_start = self.calendar.trading_days[self.calendar.get_loc(self.bkt_position.holding_matrix.index[0])]
         if bkt_start == 'default':
             self.bkt_start = default_start
         else:
             self.bkt_start = max(default_start, bkt_start)
         # 停止时间：默认为最后一个调仓日后的21个交易日，如有输入数据，则以输入数据为准
         if bkt_end == 'default':
-            default_end = self.bkt_data.stock_price.major_axis[self.bkt_data.stock_price.major_axis.get_loc(self.bkt_position.holding_matrix.index[-1])+21]
+            default_end = self.calendar.trading_days[self.calendar.get_loc(self.bkt_position.holding_matrix.index[-1])+21]
             self.bkt_end = default_end
         else:
             self.bkt_end = bkt_end
@@ -129,8 +132,8 @@ class backtest(object):
         self.risk_free_rate = risk_free_rate
         
         # 以回测期（而不是回测数据期或调仓期）为时间索引的持仓量矩阵，注意vol的持仓单位为手，pct的持仓单位为百分比
-        start_loc = self.bkt_data.stock_price.major_axis.get_loc(self.bkt_start)
-        end_loc = self.bkt_data.stock_price.major_axis.get_loc(self.bkt_end)
+        start_loc = self.calendar.get_loc(self.bkt_start)
+        end_loc = self.calendar.get_loc(self.bkt_end)
         backtest_period_holding_matrix = self.bkt_data.stock_price.ix[0,start_loc:end_loc+1,:]
         self.tar_pct_position = position(backtest_period_holding_matrix)
         # 初始化持仓目标矩阵
@@ -183,6 +186,10 @@ class backtest(object):
         foo
         """
         cursor = -1
+        # 回测期内每一天是否为调仓日的标记，在循环前一次算好
+        start_loc = self.calendar.get_loc(self.tar_pct_position.holding_matrix.index[0])
+        is_holding_day = self.calendar.get_day_mask(self.bkt_position.holding_matrix.index)[
+                         start_loc:start_loc+self.tar_pct_position.holding_matrix.shape[0]]
         # 开始执行循环，对tar_pct_position.holding_matrix进行循环
         for curr_time, curr_tar_pct_holding in self.tar_pct_position.holding_matrix.iterrows():
             
@@ -194,7 +201,7 @@ class backtest(object):
             
             # 非回测第一天
             # 如果为非调仓日
-            elif curr_time not in self.bkt_position.holding_matrix.index:
+            elif not is_holding_day[cursor]:
                 # 移动持仓和现金
                 self.real_vol_position.holding_matrix.ix[cursor, :] = self.real_vol_position.holding_matrix.ix[cursor-1, :]
                 self.cash.ix[cursor] = self.cash.ix[cursor-1]
@@ -224,9 +231,11 @@ class backtest(object):
                 self.execute_real_trading(curr_time, cursor, proj_vol_holding)
                 
         # 循环结束，开始计算持仓的序列
-        self.real_pct_position.holding_matrix = self.real_vol_position.holding_matrix.mul(self.bkt_data.stock_price.\
-                                ix['ClosePrice_adj']).fillna(0.0). \
-                                apply(lambda x: x if (x==0).all() else x.div(x.sum()), axis=1)
+        # 不全为0的行直接除以行的和，不分多空归一
+        real_value_holding = self.real_vol_position.holding_matrix.mul(self.bkt_data.stock_price.\
+                                ix['ClosePrice_adj']).fillna(0.0)
+        self.real_pct_position.holding_matrix = pd.DataFrame(position.normalize_rows(real_value_holding.values,
+                                infinitesimal=-np.inf), index=real_value_holding.index, columns=real_value_holding.columns)
         
         # 计算账面的价值，注意，这里的账面价值没有加上资金中不能用于投资的部分（即1-trade_ratio那部分）
         self.account_value = (self.real_vol_position.holding_matrix * 100 * \
@@ -13,10 +13,15 @@ from pandas import Series, DataFrame, Panel
 from datetime import datetime
 import os
 import statsmodels.api as sm
+import functools
+import copy
 
 from data import data
 from strategy_data import strategy_data
 from position import position
+from rolling_kernel import rolling_kernel
+from factor_graph import factor_graph
+from factor_cache import factor_cache
 
 # barra base类，计算barra的风格因子以及行业因子，以此作为基础
 # 注意：此类中参照barra计算的因子中，excess return暂时都没有减去risk free rate
@@ -26,14 +31,78 @@ class barra_base(object):
     
     foo
     """
-    
-    def __init__(self, *, stock_pool='all'):
+    # 各因子（包括成分因子）缓存的输入数据和参数，输入数据以'panel名.数据名'表示
+    # filter_uninv为True的因子，按照过滤了uninv之后的数据计算
+    cache_specs = {
+        'lncap': {'inputs': ['stock_price.FreeMarketValue'], 'params': {}, 'filter_uninv': False},
+        'beta': {'inputs': ['stock_price.daily_excess_return', 'stock_price.FreeMarketValue'],
+                 'params': {'half_life': 63, 'window': 252, 'min_obs': 100}, 'filter_uninv': False},
+        'momentum': {'inputs': ['stock_price.daily_excess_return'],
+                     'params': {'half_life': 126, 'window': 504, 'lag': 21}, 'filter_uninv': False},
+        'dastd': {'inputs': ['stock_price.daily_excess_return'], 'params': {'half_life': 42, 'window': 252},
+                  'filter_uninv': False},
+        'cmra': {'inputs': ['stock_price.daily_excess_return'], 'params': {'window': 252, 'month_length': 21},
+                 'filter_uninv': False},
+        'rv': {'inputs': ['stock_price.daily_excess_return', 'stock_price.FreeMarketValue', 'factor.lncap',
+                          'factor.beta', 'temp_hsigma', 'raw_data.dastd', 'raw_data.cmra', 'if_tradable.if_inv'],
+               'params': {'dastd_weight': 0.74, 'cmra_weight': 0.16, 'hsigma_weight': 0.1}, 'filter_uninv': False},
+        'nls': {'inputs': ['factor.lncap', 'stock_price.FreeMarketValue'], 'params': {}, 'filter_uninv': True},
+        'bp': {'inputs': ['raw_data.PB'], 'params': {}, 'filter_uninv': True},
+        'stom': {'inputs': ['stock_price.Volume', 'stock_price.FreeShares'], 'params': {'window': 21, 'min_periods': 5},
+                 'filter_uninv': True},
+        'stoq': {'inputs': ['raw_data.stom'], 'params': {'months': 3}, 'filter_uninv': True},
+        'stoa': {'inputs': ['raw_data.stom'], 'params': {'months': 12}, 'filter_uninv': True},
+        'liquidity': {'inputs': ['stock_price.Volume', 'stock_price.FreeShares', 'stock_price.FreeMarketValue',
+                                 'factor.lncap', 'raw_data.stom', 'raw_data.stoq', 'raw_data.stoa'],
+                      'params': {'stom_weight': 0.35, 'stoq_weight': 0.35, 'stoa_weight': 0.3}, 'filter_uninv': True},
+        'epfwd': {'inputs': ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_fy2', 'stock_price.FreeMarketValue'],
+                  'params': {}, 'filter_uninv': True},
+        'cetop': {'inputs': ['raw_data.CashEarnings_ttm', 'stock_price.FreeMarketValue'], 'params': {},
+                  'filter_uninv': True},
+        'etop': {'inputs': ['raw_data.PE_ttm'], 'params': {}, 'filter_uninv': True},
+        'ey': {'inputs': ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_fy2', 'raw_data.CashEarnings_ttm',
+                          'raw_data.PE_ttm', 'stock_price.FreeMarketValue'],
+               'params': {'epfwd_weight': 0.68, 'cetop_weight': 0.21, 'etop_weight': 0.11}, 'filter_uninv': True},
+        'egrlf': {'inputs': ['raw_data.NetIncome_fy2', 'raw_data.NetIncome_ttm'], 'params': {}, 'filter_uninv': True},
+        'egrsf': {'inputs': ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_ttm'], 'params': {}, 'filter_uninv': True},
+        'egro': {'inputs': ['raw_data.NetIncome_ttm_growth_8q'], 'params': {}, 'filter_uninv': True},
+        'sgro': {'inputs': ['raw_data.Revenue_ttm_growth_8q'], 'params': {}, 'filter_uninv': True},
+        'growth': {'inputs': ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_fy2', 'raw_data.NetIncome_ttm',
+                              'raw_data.NetIncome_ttm_growth_8q', 'raw_data.Revenue_ttm_growth_8q',
+                              'stock_price.FreeMarketValue'],
+                   'params': {'egrlf_weight': 0.18, 'egrsf_weight': 0.11, 'egro_weight': 0.24, 'sgro_weight': 0.47},
+                   'filter_uninv': True},
+        'leverage': {'inputs': ['raw_data.TotalLiability', 'raw_data.TotalAssets'], 'params': {},
+                     'filter_uninv': True}}
+    # 不依赖于股票池的因子，其因子文件在任何股票池下都可以读取，其余因子的因子文件只在股票池为所有股票时读取
+    # beta虽然不依赖于股票池，但rv需要和beta一起算出的hsigma，因此只在rv也能从因子文件读取时（即股票池为所有股票时）读取
+    pool_free_stored_factors = ['lncap', 'momentum']
+
+    def __init__(self, *, stock_pool='all', n_jobs='default'):
         self.bb_data = strategy_data()
         self.bb_factor_return = pd.DataFrame()
+        # 回归计算因子收益时的残差（加权后的残差），与因子收益一一对应
+        self.bb_residual_return = pd.DataFrame()
         # 提示barra base的股票池
         self.bb_data.stock_pool = stock_pool
         # 提示是否为数据更新
         self.is_update = False
+        # 计算因子时只计算这个日期及之后的因子值，之前的为nan，用于增量更新，默认计算所有日期
+        self.calc_start_date = 'default'
+        # 用依赖图计算风格因子时，进程池中的进程数，默认为cpu个数
+        self.n_jobs = n_jobs
+        # 因子缓存，因子的输入数据，参数或股票池改变时，缓存自动失效
+        # 输入数据每多一天，缓存的键就会改变，因此每个因子在每个股票池下只保留最新的factor_cache_keep个条目，设为'default'则不清理
+        self.factor_cache = factor_cache()
+        self.factor_cache_keep = 2
+        # 精度策略，为'Empty'时所有数据为float64，否则读取的原始数据按策略转换，因子和因子暴露按策略中的数据类型计算，
+        # 构建完成后所有数据再按策略转换一次
+        self.precision_policy = 'Empty'
+        # 所有股票的市值加权收益，beta回归的自变量，默认在get_beta中用当前所有股票计算，
+        # 只有部分股票的数据时（如按股票分块计算时），需要事先用所有股票算好后传入
+        self.cap_wgt_universe_return = 'Empty'
+        # 事先一次算好的各股票池的风格因子暴露，股票池名为键，计算某个股票池的暴露时如果已有，则直接使用
+        self.pool_style_expo = {}
         
     # 建立指数加权序列
     @staticmethod
@@ -43,6 +112,29 @@ class barra_base(object):
         exponential_weights = exponential_weights/np.sum(exponential_weights)
         return exponential_weights
 
+    # 按精度策略取数据的数据类型，没有精度策略时为float64
+    def get_dtype(self, panel_name, item='Empty'):
+        if type(self.precision_policy) == str:
+            return np.float64
+        return self.precision_policy.get_dtype(panel_name, item)
+
+    # 需要计算的第一个日期在所有日期中的位置
+    def get_calc_start_cursor(self):
+        if self.calc_start_date == 'default':
+            return 0
+        return self.bb_data.stock_price.major_axis.searchsorted(pd.Timestamp(self.calc_start_date))
+
+    # 滚动窗口的计算只需要从计算起点之前window-1期开始的数据，返回这部分数据的起点
+    def get_calc_input_cursor(self, window):
+        return max(self.get_calc_start_cursor() - window + 1, 0)
+
+    # 将从input_cursor开始的数据上计算出的结果还原到所有日期上，计算起点之前的为nan
+    def expand_calc_outcome(self, outcome, input_cursor, *, like):
+        expanded = pd.DataFrame(np.nan, index=like.index, columns=like.columns, dtype=np.asarray(outcome).dtype)
+        expanded.iloc[input_cursor:] = outcome
+        expanded.iloc[:self.get_calc_start_cursor()] = np.nan
+        return expanded
+
     # 读取在计算风格因子中需要用到的原始数据，注意：行业信息数据不在这里读取
     # 即使可以读取已算好的因子，也在这里处理，因为这样方便统一处理，不至于让代码太乱
     # 这里的标准为，读取前都检查一下是否已经存在数据，这样可以方便手动读取特定数据
@@ -136,369 +228,324 @@ class barra_base(object):
         # 在barra base中，事实上只有beta需要不依赖于股票池的全局计算，在beta因子计算过后，即可过滤uninv
         # 但同时注意，一旦过滤uninv，数据就不能再作为一般的因子值储存了
         self.bb_data.discard_untradable_data()
-
-    # 计算市值对数因子，市值需要第一个计算以确保各个panel有index和column
-    def get_lncap(self):
-        # 如果有文件，则直接读取
-        if os.path.isfile('lncap.csv') and not self.is_update:
-            self.bb_data.factor = data.read_data(['lncap'], ['lncap'])
-        # 没有就用市值进行计算
+        # 按精度策略转换读取的数据，之后的因子计算都在转换后的数据上进行
+        if type(self.precision_policy) != str:
+            self.precision_policy.apply(self.bb_data, panels=['stock_price', 'raw_data'])
+
+    # 根据'panel名.数据名'取数据，如'stock_price.FreeMarketValue'，temp_hsigma为beta中算出的hsigma
+    def get_named_data(self, data_name):
+        if data_name == 'temp_hsigma':
+            return self.temp_hsigma
+        panel_name, item = data_name.split('.', 1)
+        return getattr(self.bb_data, panel_name).ix[item]
+
+    def has_named_data(self, data_name):
+        if data_name == 'temp_hsigma':
+            return hasattr(self, 'temp_hsigma')
+        panel_name, item = data_name.split('.', 1)
+        return item in getattr(self.bb_data, panel_name).items
+
+    # 根据'panel名.数据名'写入数据，panel还没有数据时以stock_price的索引建立panel
+    # 因此各因子不需要写入lncap建立的panel，计算顺序只取决于真正用到的数据
+    def set_named_data(self, data_name, value):
+        if data_name == 'temp_hsigma':
+            self.temp_hsigma = value
+            return
+        panel_name, item = data_name.split('.', 1)
+        panel = getattr(self.bb_data, panel_name)
+        if panel.empty:
+            setattr(self.bb_data, panel_name, pd.Panel({item: value}, major_axis=self.bb_data.stock_price.major_axis,
+                                                       minor_axis=self.bb_data.stock_price.minor_axis))
         else:
-            self.bb_data.factor = pd.Panel({'lncap':np.log(self.bb_data.stock_price.ix['FreeMarketValue'])},
-                                             major_axis=self.bb_data.stock_price.major_axis,
-                                             minor_axis=self.bb_data.stock_price.minor_axis)
+            panel[item] = value
+
+    # 取过滤了uninv之后的数据，只过滤这一个数据，而不像discard_uninv_data那样改写所有panel
+    # 因子的计算中只过滤自己用到的数据，在依赖图的子进程中计算时，不会因为改写所有数据而复制整个父进程的数据
+    def get_inv_data(self, data_name):
+        named_data = self.get_named_data(data_name)
+        if self.bb_data.if_tradable.ix['if_inv'].empty:
+            return named_data
+        return named_data.where(self.bb_data.if_tradable.ix['if_inv'], np.nan)
+
+    # 因子的缓存条目，键由输入数据的版本，参数，计算起点和股票池决定
+    # 对于按照过滤了uninv之后的数据计算的因子，输入数据过滤后再计算版本，使得过滤前后算出的键一致
+    # 输入数据中当前没有的（如只在增量更新时预先算好的成分因子）不计入
+    def get_cache_entry(self, name):
+        spec = barra_base.cache_specs[name]
+        inputs = {}
+        for data_name in spec['inputs']:
+            if not self.has_named_data(data_name):
+                continue
+            input_data = self.get_named_data(data_name)
+            if spec['filter_uninv']:
+                input_data = input_data.where(self.bb_data.if_tradable.ix['if_inv'], np.nan)
+            inputs[data_name] = input_data
+        if spec['filter_uninv']:
+            inputs['if_tradable.if_inv'] = self.bb_data.if_tradable.ix['if_inv']
+        params = dict(spec['params'], calc_start_date=self.calc_start_date)
+        return factor_cache.get_entry(name, inputs=inputs, params=params, stock_pool=self.bb_data.stock_pool)
+
+    # 从缓存中取因子，没有有效的缓存时计算，并存入缓存，factor_cache为'Empty'时不使用缓存
+    def get_cached(self, name, calc_func):
+        if type(self.factor_cache) == str:
+            return calc_func()
+        entry = self.get_cache_entry(name)
+        if self.factor_cache.has(entry):
+            return self.factor_cache.load(entry)
+        outcome = calc_func()
+        self.factor_cache.save(entry, outcome)
+        if self.factor_cache_keep != 'default':
+            self.factor_cache.prune(name=name, keep_latest=self.factor_cache_keep, by_params=False)
+        return outcome
+
+    # 从因子文件中读取已储存的因子，因子文件由股票池为所有股票时的构建写入，之后由增量更新追加新日期的因子值
+    # 只有因子文件覆盖当前所有日期和股票时才读取，否则（如因子文件还没有更新到最新一天）返回'Empty'，因子需要重新计算
+    # 增量更新或只计算部分日期时不读取
+    def read_stored_factor(self, name):
+        if self.is_update or self.calc_start_date != 'default' or not os.path.isfile(name + '.csv'):
+            return 'Empty'
+        if self.bb_data.stock_pool != 'all' and name not in barra_base.pool_free_stored_factors:
+            return 'Empty'
+        # 先只读取表头和时间索引，判断因子文件能否覆盖当前数据
+        stored_columns = pd.read_csv(name + '.csv', index_col=0, nrows=0, encoding='GB18030').columns
+        stored_index = pd.read_csv(name + '.csv', index_col=0, usecols=[0], parse_dates=True,
+                                   encoding='GB18030').index
+        major_axis = self.bb_data.stock_price.major_axis
+        minor_axis = self.bb_data.stock_price.minor_axis
+        if not (major_axis.isin(stored_index).all() and minor_axis.isin(stored_columns).all()):
+            return 'Empty'
+        stored_factor = data.read_data([name], [name]).ix[name]
+        return stored_factor.reindex(index=major_axis, columns=minor_axis).astype(self.get_dtype('factor', name))
+
+    # 计算市值对数因子
+    def get_lncap(self):
+        self.set_named_data('factor.lncap', self.get_cached('lncap', lambda:
+            np.log(self.bb_data.stock_price.ix['FreeMarketValue'])))
 
     # 计算beta因子
+    # 每只股票每一期的回归为252期、63半衰期的加权最小二乘回归，回归结果只和窗口中的加权矩有关，
+    # 因此用rolling_kernel一次算出所有日期所有股票的加权矩，再得到beta和hsigma，结果与逐个回归一致
     def get_beta(self):
-        if os.path.isfile('beta.csv') and not self.is_update:
-            beta = data.read_data(['beta'], ['beta'])
-            self.bb_data.factor['beta'] = beta.ix['beta']
-        else:
+        params = barra_base.cache_specs['beta']['params']
+        def calc_beta():
             # 所有股票的日对数收益的市值加权，加权用前一交易日的市值数据进行加权
-            cap_wgt_universe_return = self.bb_data.stock_price.ix['daily_excess_return'].mul(
+            if type(self.cap_wgt_universe_return) != str:
+                cap_wgt_universe_return = self.cap_wgt_universe_return
+            else:
+                cap_wgt_universe_return = self.bb_data.stock_price.ix['daily_excess_return'].mul(
                                        self.bb_data.stock_price.ix['FreeMarketValue'].shift(1)).div(
                                        self.bb_data.stock_price.ix['FreeMarketValue'].shift(1).sum(1), axis=0).sum(1)
-            
+
             # 指数权重
-            exponential_weights = barra_base.construct_expo_weights(63, 252)
-            # 回归函数
-            def reg_func(y, *, x, weights):
-                # 如果y全是nan或只有一个不是nan，则直接返回nan，可自由设定阈值
-                if y.notnull().sum() <= 100:
-                    return pd.Series({'beta':np.nan,'hsigma':np.nan})
-                x = sm.add_constant(x)
-                model = sm.WLS(y, x, weights=weights, missing='drop')
-                results = model.fit()
-                resid = results.resid
-                # 在这里提前计算hsigma----------------------------------------------------------------------
-                # 求std，252个交易日，63的半衰期
-                exponential_weights_h = barra_base.construct_expo_weights(63, 252)
-                # 给weights加上index以索引resid
-                exponential_weights_h = pd.Series(exponential_weights_h, index=y.index)
-                hsigma = (resid*exponential_weights_h).std()
-                # ----------------------------------------------------------------------------------------
-                return pd.Series({'beta':results.params[1],'hsigma':hsigma})
-            # 按照Barra的方法进行回归
-            # 储存回归结果的dataframe
-            temp_beta = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            temp_hsigma = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(self.bb_data.stock_price.ix['daily_excess_return'].index):
-                # 至少第252期时才回归
-                if cursor<=250:
-                    continue
-                curr_data = self.bb_data.stock_price.ix['daily_excess_return',cursor-251:cursor+1,:]
-                curr_x = cap_wgt_universe_return.ix[cursor-251:cursor+1]
-                temp = curr_data.apply(reg_func, x=curr_x, weights=exponential_weights)
-                temp_beta.ix[cursor,:] = temp.ix['beta']
-                temp_hsigma.ix[cursor,:] = temp.ix['hsigma']
-                print(cursor)
-                pass
-            self.bb_data.factor['beta'] = temp_beta
-            self.temp_hsigma = temp_hsigma
-            pass
-
-    # beta parallel
+            exponential_weights = barra_base.construct_expo_weights(params['half_life'], params['window'])
+            # 按照Barra的方法进行回归，有效数据不超过100个的股票不回归
+            # 残差的std（即hsigma）也在这里提前计算，其权重同样为252个交易日，63的半衰期
+            daily_excess_return = self.bb_data.stock_price.ix['daily_excess_return']
+            input_cursor = self.get_calc_input_cursor(params['window'])
+            beta, hsigma = rolling_kernel.rolling_wls_beta(daily_excess_return.values[input_cursor:],
+                cap_wgt_universe_return.reindex(daily_excess_return.index).values[input_cursor:],
+                exponential_weights, min_obs=params['min_obs'], dtype=self.get_dtype('factor', 'beta'))
+            return [self.expand_calc_outcome(beta, input_cursor, like=daily_excess_return),
+                    self.expand_calc_outcome(hsigma, input_cursor, like=daily_excess_return)]
+        beta, self.temp_hsigma = self.get_cached('beta', calc_beta)
+        self.set_named_data('factor.beta', beta)
+
+    # beta parallel，get_beta已经是向量化的计算，不再需要多进程，保留此函数以兼容之前的调用
     def get_beta_parallel(self):
-        if os.path.isfile('beta.csv') and not self.is_update:
-            beta = data.read_data(['beta'], ['beta'])
-            self.bb_data.factor['beta'] = beta.ix['beta']
-        else:
-            # 所有股票的日对数收益的市值加权，加权用前一交易日的市值数据进行加权
-            cap_wgt_universe_return = self.bb_data.stock_price.ix['daily_excess_return'].mul(
-                self.bb_data.stock_price.ix['FreeMarketValue'].shift(1)).div(
-                self.bb_data.stock_price.ix['FreeMarketValue'].shift(1).sum(1), axis=0).sum(1)
+        self.get_beta()
 
-            # 指数权重
-            exponential_weights = barra_base.construct_expo_weights(63, 252)
-
-            # 回归函数
-            def reg_func(y, *, x, weights):
-                # 如果y全是nan或只有一个不是nan，则直接返回nan，可自由设定阈值
-                if y.notnull().sum() <= 100:
-                    return pd.Series({'beta': np.nan, 'hsigma': np.nan})
-                x = sm.add_constant(x)
-                model = sm.WLS(y, x, weights=weights, missing='drop')
-                results = model.fit()
-                resid = results.resid
-                # 在这里提前计算hsigma----------------------------------------------------------------------
-                # 求std，252个交易日，63的半衰期
-                exponential_weights_h = barra_base.construct_expo_weights(63, 252)
-                # 给weights加上index以索引resid
-                exponential_weights_h = pd.Series(exponential_weights_h, index=y.index)
-                hsigma = (resid * exponential_weights_h).std()
-                # ----------------------------------------------------------------------------------------
-                return pd.Series({'beta': results.params[1], 'hsigma': hsigma})
-            # 按照Barra的方法进行回归
-            # 计算每期beta的函数
-            def one_time_beta(cursor):
-                curr_data = self.bb_data.stock_price.ix['daily_excess_return', cursor - 251:cursor+1, :]
-                curr_x = cap_wgt_universe_return.ix[cursor - 251:cursor+1]
-                temp = curr_data.apply(reg_func, x=curr_x, weights=exponential_weights)
-                print(cursor)
-                return temp
-            import pathos.multiprocessing as mp
-            if __name__ == '__main__':
-                ncpus = 16
-                p = mp.ProcessPool(ncpus)
-                # 从252期开始
-                data_size = np.arange(251, self.bb_data.stock_price.ix['daily_excess_return'].shape[0])
-                chunksize = int(len(data_size)/ncpus)
-                results = p.map(one_time_beta, data_size, chunksize=chunksize)
-                # 储存结果
-                beta = pd.concat([i.ix['beta'] for i in results], axis=1).T
-                hsigma = pd.concat([i.ix['hsigma'] for i in results], axis=1).T
-                # 两个数据对应的日期，为原始数据的日期减去251，因为前251期的数据并没有计算
-                data_index = self.bb_data.stock_price.iloc[:, 251-self.bb_data.stock_price.shape[1]:, :].major_axis
-                beta = beta.set_index(data_index)
-                hsigma = hsigma.set_index(data_index)
-                self.bb_data.factor['beta'] = beta
-                self.temp_hsigma = hsigma.reindex(self.bb_data.stock_price.major_axis)
-
-
-
-    # 计算momentum因子 
+    # 计算momentum因子
     def get_momentum(self):
-        if os.path.isfile('momentum.csv') and not self.is_update:
-            momentum = data.read_data(['momentum'], ['momentum'])
-            self.bb_data.factor['momentum'] = momentum.ix['momentum']
-        else:
-            # 计算momentum因子
+        params = barra_base.cache_specs['momentum']['params']
+        def calc_momentum():
             # 首先数据有一个21天的lag
-            lag_return = self.bb_data.stock_price.ix['daily_excess_return'].shift(21)
+            lag_return = self.bb_data.stock_price.ix['daily_excess_return'].shift(params['lag'])
             # rolling后求sum，504个交易日，126的半衰期
-            exponential_weights = barra_base.construct_expo_weights(126, 504)
-            # 定义momentum的函数
-            def func_mom(df, *, weights):
-                iweights = pd.Series(weights, index=df.index)
-                return df.mul(iweights, axis=0).sum(0)
-            momentum = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(lag_return.index):
-                # 至少504+21期才开始计算
-                if cursor<=(502+21):
-                    continue
-                curr_data = lag_return.ix[cursor-503:cursor+1, :]
-                temp = func_mom(curr_data, weights=exponential_weights)
-                momentum.ix[cursor, :] = temp
-            self.bb_data.factor['momentum'] = momentum
-            pass
-        
+            exponential_weights = barra_base.construct_expo_weights(params['half_life'], params['window'])
+            input_cursor = self.get_calc_input_cursor(params['window'])
+            momentum = rolling_kernel.window_nansum(lag_return.values[input_cursor:], exponential_weights,
+                                                    dtype=self.get_dtype('factor', 'momentum'))
+            momentum = self.expand_calc_outcome(momentum, input_cursor, like=lag_return)
+            # 至少504+21期才开始计算
+            momentum.iloc[:params['window']+params['lag']-1] = np.nan
+            return momentum
+        self.set_named_data('factor.momentum', self.get_cached('momentum', calc_momentum))
+
      # 计算residual volatility中的dastd
     def get_rv_dastd(self):
-        if os.path.isfile('dastd.csv') and not self.is_update:
-            dastd = data.read_data(['dastd'], ['dastd'])
-            dastd = dastd.ix['dastd']
-        else:
-            # rolling后求std，252个交易日，42的半衰期
-            exponential_weights = barra_base.construct_expo_weights(42, 252)
-            # 定义dastd的函数
-            def func_dastd(df, *, weights):
-                iweights = pd.Series(weights, index=df.index)
-                return df.mul(iweights, axis=0).std(0)
-            dastd = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(self.bb_data.stock_price.ix['daily_excess_return'].index):
-                # 至少252期才开始计算
-                if cursor<=250:
-                    continue
-                curr_data = self.bb_data.stock_price.ix['daily_excess_return', cursor-251:cursor+1,:]
-                temp = func_dastd(curr_data, weights=exponential_weights)
-                dastd.ix[cursor,:] = temp
-  
-        self.bb_data.raw_data['dastd'] = dastd
-    
+        params = barra_base.cache_specs['dastd']['params']
+        def calc_dastd():
+            # rolling后求std，252个交易日，42的半衰期，即对窗口中的收益乘以权重后求std
+            exponential_weights = barra_base.construct_expo_weights(params['half_life'], params['window'])
+            daily_excess_return = self.bb_data.stock_price.ix['daily_excess_return']
+            # 至少252期才开始计算
+            input_cursor = self.get_calc_input_cursor(params['window'])
+            dastd = rolling_kernel.window_std(daily_excess_return.values[input_cursor:], exponential_weights,
+                                              dtype=self.get_dtype('raw_data', 'dastd'))
+            return self.expand_calc_outcome(dastd, input_cursor, like=daily_excess_return)
+        self.bb_data.raw_data['dastd'] = self.get_cached('dastd', calc_dastd)
+
     # 计算residual volatility中的cmra
     def get_rv_cmra(self):
-        if os.path.isfile('cmra.csv') and not self.is_update:
-            cmra = data.read_data(['cmra'], ['cmra'])
-            cmra = cmra.ix['cmra']
-        else:
-            # 定义需要cmra的函数，这个函数计算252个交易日中的cmra
-            def func_cmra(df):
-                # 累计收益率
-                cum_df = df.cumsum(axis=0)
-                # 取每月的累计收益率
-                months = np.arange(20,252,21)
-                months_cum_df = cum_df.ix[months]
-                z_max = months_cum_df.max(axis=0)
-                z_min = months_cum_df.min(axis=0)
-#                # 避免出现log函数中出现非正参数
-#                z_min[z_min <= -1] = -0.9999
-#                return np.log(1+z_max)-np.log(1+z_min)
-                # 为避免出现z_min<=-1调整后的极端值，cmra改为z_max-z_min
-                # 注意：改变后并未改变因子排序，而是将因子原本的scale变成了exp(scale)
-                return z_max - z_min
-            cmra = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(self.bb_data.stock_price.ix['daily_excess_return'].index):
-                # 至少252期才开始计算
-                if cursor <= 250:
-                    continue
-                curr_data = self.bb_data.stock_price.ix['daily_excess_return', cursor-251:cursor+1, :]
-                temp = func_cmra(curr_data)
-                cmra.ix[cursor,:] = temp
-        self.bb_data.raw_data['cmra'] = cmra
-    
-    # 计算residual volatility中的hsigma
+        params = barra_base.cache_specs['cmra']['params']
+        def calc_cmra():
+            # 计算252个交易日中的cmra，取每月的累计收益率（窗口中的第20, 41, ..., 251期）的最大值与最小值
+            daily_excess_return = self.bb_data.stock_price.ix['daily_excess_return']
+            months = np.arange(params['month_length']-1, params['window'], params['month_length'])
+            input_cursor = self.get_calc_input_cursor(params['window'])
+            z_max, z_min = rolling_kernel.window_cum_max_min(daily_excess_return.values[input_cursor:],
+                                                             params['window'], months,
+                                                             dtype=self.get_dtype('raw_data', 'cmra'))
+#            # 避免出现log函数中出现非正参数
+#            z_min[z_min <= -1] = -0.9999
+#            cmra = np.log(1+z_max)-np.log(1+z_min)
+            # 为避免出现z_min<=-1调整后的极端值，cmra改为z_max-z_min
+            # 注意：改变后并未改变因子排序，而是将因子原本的scale变成了exp(scale)
+            # 至少252期才开始计算
+            return self.expand_calc_outcome(z_max - z_min, input_cursor, like=daily_excess_return)
+        self.bb_data.raw_data['cmra'] = self.get_cached('cmra', calc_cmra)
+
+    # 计算residual volatility中的hsigma，hsigma在计算beta时一起算出（或一起从缓存中取出）
     def get_rv_hsigma(self):
-        if os.path.isfile('hsigma.csv') and not self.is_update:
-            hsigma = data.read_data(['hsigma'], ['hsigma'])
-            hsigma = hsigma.ix['hsigma']
-        elif hasattr(self, 'temp_hsigma'):
+        if hasattr(self, 'temp_hsigma'):
             hsigma = self.temp_hsigma
         else:
-            print('hsigma has not been accquired, if you have rv file stored instead, ingored this message.\n')
+            print('hsigma has not been accquired, if you have rv cached instead, ingored this message.\n')
             hsigma = np.nan
         self.bb_data.raw_data['hsigma'] = hsigma
-    
+
     # 计算residual volatility
     def get_residual_volatility(self):
-        if os.path.isfile('rv.csv') and not self.is_update:
-            rv = data.read_data(['rv'], ['rv'])
-            self.bb_data.factor['rv'] = rv.ix['rv']
-        else:
-            self.get_rv_dastd()
-            self.get_rv_cmra()
-            self.get_rv_hsigma()
-            # 过滤数据，因为之前的因子数据之后要正交化，会影响计算
-            # 此处为barra base计算中第一次过滤掉uninv数据，此后的数据都不能再储存，因为依赖于stock pool
-            self.bb_data.discard_uninv_data()
+        params = barra_base.cache_specs['rv']['params']
+        def calc_rv():
+            # 增量更新时，成分因子已经在截取数据之前计算好了
+            if not self.is_update:
+                self.get_rv_dastd()
+                self.get_rv_cmra()
+                self.get_rv_hsigma()
+            # 过滤用到的数据，因为之前的因子数据之后要正交化，会影响计算
+            # 此后的数据都不能再储存，因为依赖于stock pool
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            dtype = self.get_dtype('factor', 'rv')
             # 计算三个成分因子的暴露
-            self.bb_data.raw_data['dastd_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['dastd'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['cmra_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['cmra'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['hsigma_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['hsigma'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            
-            rv = 0.74*self.bb_data.raw_data.ix['dastd_expo']+0.16*self.bb_data.raw_data.ix['cmra_expo']+ \
-                                                        0.1*self.bb_data.raw_data.ix['hsigma_expo']
+            dastd_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.dastd'), mv, dtype=dtype)
+            cmra_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.cmra'), mv, dtype=dtype)
+            hsigma_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.hsigma'), mv,
+                                                             dtype=dtype)
+
+            rv = params['dastd_weight']*dastd_expo + params['cmra_weight']*cmra_expo + \
+                 params['hsigma_weight']*hsigma_expo
             # 计算rv的因子暴露，不再去极值
-            y = strategy_data.get_cap_wgt_exposure(rv, self.bb_data.stock_price.ix['FreeMarketValue'], percentile=0)
+            y = strategy_data.get_cap_wgt_exposure(rv, mv, percentile=0, dtype=dtype)
             # 计算市值因子与beta因子的暴露
-            x = pd.Panel({'lncap_expo':strategy_data.get_cap_wgt_exposure(self.bb_data.factor.ix['lncap'],
-                                                                          self.bb_data.stock_price.ix['FreeMarketValue']),
-                          'beta_expo':strategy_data.get_cap_wgt_exposure(self.bb_data.factor.ix['beta'],
-                                                                         self.bb_data.stock_price.ix['FreeMarketValue'])})
+            x = pd.Panel({'lncap_expo': strategy_data.get_cap_wgt_exposure(self.get_inv_data('factor.lncap'), mv,
+                                                                           dtype=dtype),
+                          'beta_expo': strategy_data.get_cap_wgt_exposure(self.get_inv_data('factor.beta'), mv,
+                                                                          dtype=dtype)})
             # 正交化
-            new_rv = strategy_data.simple_orth_gs(y, x, weights = np.sqrt(self.bb_data.stock_price.ix['FreeMarketValue']))[0]
+            new_rv = strategy_data.simple_orth_gs(y, x, weights = np.sqrt(mv))[0]
             # 之后会再次的计算暴露，注意再次计算暴露后，new_rv依然保有对x的正交性
-            self.bb_data.factor['rv'] = new_rv
-                           
+            return new_rv
+        self.set_named_data('factor.rv', self.get_cached('rv', calc_rv))
+
     # 计算nonlinear size
     def get_nonlinear_size(self):
-        if os.path.isfile('nls.csv') and not self.is_update:
-            nls = data.read_data(['nls'], ['nls'])
-            self.bb_data.factor['nls'] = nls.ix['nls']
-        else:
-            size_cube = self.bb_data.factor.ix['lncap']**3
+        def calc_nls():
+            lncap = self.get_inv_data('factor.lncap')
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            dtype = self.get_dtype('factor', 'nls')
+            size_cube = lncap**3
             # 计算原始nls的暴露
-            y = strategy_data.get_cap_wgt_exposure(size_cube, self.bb_data.stock_price.ix['FreeMarketValue'])
+            y = strategy_data.get_cap_wgt_exposure(size_cube, mv, dtype=dtype)
             # 计算市值因子的暴露，注意解释变量需要为一个panel
-            x = pd.Panel({'lncap_expo': strategy_data.get_cap_wgt_exposure(self.bb_data.factor.ix['lncap'],
-                                                                           self.bb_data.stock_price.ix['FreeMarketValue'])})
+            x = pd.Panel({'lncap_expo': strategy_data.get_cap_wgt_exposure(lncap, mv, dtype=dtype)})
             # 对市值因子做正交化
-            new_nls = strategy_data.simple_orth_gs(y, x, weights = np.sqrt(self.bb_data.stock_price.ix['FreeMarketValue']))[0]
-            self.bb_data.factor['nls'] = new_nls
+            return strategy_data.simple_orth_gs(y, x, weights = np.sqrt(mv))[0]
+        self.set_named_data('factor.nls', self.get_cached('nls', calc_nls))
 
     # 计算pb
     def get_pb(self):
-        if os.path.isfile('bp.csv') and not self.is_update:
-            pb = data.read_data(['bp'], ['bp'])
-            self.bb_data.factor['bp'] = pb.ix['bp']
-        else:
-            self.bb_data.factor['bp'] = 1/self.bb_data.raw_data.ix['PB']
+        self.set_named_data('factor.bp', self.get_cached('bp', lambda: 1/self.get_inv_data('raw_data.PB')))
+
 
-    
     # 计算liquidity中的stom
     def get_liq_stom(self):
-        if os.path.isfile('stom.csv') and not self.is_update:
-            stom = data.read_data(['stom'], ['stom'])
-            stom = stom.ix['stom']
-        else:
-            v2s = self.bb_data.stock_price.ix['Volume'].div(self.bb_data.stock_price.ix['FreeShares'])
-            stom = v2s.rolling(21, min_periods=5).apply(lambda x:np.log(np.sum(x)))
-        self.bb_data.raw_data['stom'] = stom
-        # 过滤数据，因为stom会影响之后stoq，stoa的计算
-        self.bb_data.discard_uninv_data()
-        
+        params = barra_base.cache_specs['stom']['params']
+        def calc_stom():
+            v2s = self.get_inv_data('stock_price.Volume').div(self.get_inv_data('stock_price.FreeShares'))
+            # 只计算部分日期时，stoa需要之前231期的stom，因此stom从计算起点之前231期开始计算，
+            # 而每一期的stom又需要之前20期的数据
+            start_cursor = max(self.get_calc_start_cursor() - 231, 0)
+            curr_v2s = v2s.iloc[max(start_cursor - params['window'] + 1, 0):]
+            # 窗口中有任何一期为nan，则stom为nan（与之前的rolling().apply(lambda x: np.log(np.sum(x)))一致）
+            has_nan = curr_v2s.isnull().astype(np.float64).rolling(params['window'], min_periods=1).sum() > 0
+            stom = np.log(curr_v2s.rolling(params['window'], min_periods=params['min_periods']).sum().
+                          where(np.logical_not(has_nan)))
+            stom = stom.reindex(index=v2s.index).astype(self.get_dtype('raw_data', 'stom'))
+            # 计算起点之前的stom，其窗口中的数据并不完整，不能使用
+            stom.iloc[:start_cursor] = np.nan
+            return stom
+        # stom由过滤了uninv之后的数据算出，因此之后stoq，stoa的计算也只用到了过滤后的数据
+        self.bb_data.raw_data['stom'] = self.get_cached('stom', calc_stom)
+
     # 计算liquidity中的stoq
     def get_liq_stoq(self):
-        if os.path.isfile('stoq.csv') and not self.is_update:
-            stoq = data.read_data(['stoq'], ['stoq'])
-            stoq = stoq.ix['stoq']
-        else:
-            # 定义stoq的函数
-            def func_stoq(df):
-                # 去过去3个月的stom
-                months = np.arange(20,63,21)
-                months_stom = df.ix[months]
-                return np.log(np.exp(months_stom).mean(axis=0))
-            stoq = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(self.bb_data.stock_price.ix['daily_excess_return'].index):
-                # 至少63期才开始计算
-                if cursor<=61:
-                    continue
-                curr_data = self.bb_data.raw_data.ix['stom', cursor-62:cursor+1,:]
-                temp = func_stoq(curr_data)
-                stoq.ix[cursor,:] = temp
-        self.bb_data.raw_data['stoq'] = stoq
+        # 取过去3个月的stom，即当期，21期前，42期前的stom
+        months = barra_base.cache_specs['stoq']['params']['months']
+        self.bb_data.raw_data['stoq'] = self.get_cached('stoq',
+            lambda: self.get_liq_sampled_stom(np.arange(0, 21*months, 21), 21*months))
 
     # 计算liquidity中的stoa
     def get_liq_stoa(self):
-        if os.path.isfile('stoa.csv') and not self.is_update:
-            stoa = data.read_data(['stoa'], ['stoa'])
-            stoa = stoa.ix['stoa']
-        else:
-            # 定义stoa的函数
-            def func_stoa(df):
-                # 去过去12个月的stom
-                months = np.arange(20,252,21)
-                months_stom = df.ix[months]
-                return np.log(np.exp(months_stom).mean(axis=0))
-            stoa = self.bb_data.stock_price.ix['daily_excess_return']*np.nan
-            for cursor, date in enumerate(self.bb_data.stock_price.ix['daily_excess_return'].index):
-                # 至少252期才开始计算
-                if cursor<=250:
-                    continue
-                curr_data = self.bb_data.raw_data.ix['stom', cursor-251:cursor+1,:]
-                temp = func_stoa(curr_data)
-                stoa.ix[cursor,:] = temp
-        self.bb_data.raw_data['stoa'] = stoa
+        # 取过去12个月的stom
+        months = barra_base.cache_specs['stoa']['params']['months']
+        self.bb_data.raw_data['stoa'] = self.get_cached('stoa',
+            lambda: self.get_liq_sampled_stom(np.arange(0, 21*months, 21), 21*months))
+
+    # 计算stoq和stoa的函数，即取过去若干个月的stom，计算log(mean(exp(stom)))，window为至少需要的期数
+    def get_liq_sampled_stom(self, lags, window):
+        stom = self.bb_data.raw_data.ix['stom']
+        calc_start_cursor = self.get_calc_start_cursor()
+        start_cursor = max(calc_start_cursor - max(lags), 0)
+        sampled_stom = rolling_kernel.sampled_nanmean(np.exp(stom.values[start_cursor:]), lags,
+                                                      dtype=self.get_dtype('raw_data', 'stom'))
+        sampled_stom = pd.DataFrame(np.log(sampled_stom), index=stom.index[start_cursor:], columns=stom.columns)
+        sampled_stom = sampled_stom.reindex(index=self.bb_data.stock_price.major_axis)
+        # 至少window期才开始计算，且计算起点之前的不计算
+        sampled_stom.iloc[:max(window - 1, calc_start_cursor)] = np.nan
+        return sampled_stom
 
     # 计算liquidity
     def get_liquidity(self):
-        if os.path.isfile('liquidity.csv') and not self.is_update:
-            liquidity = data.read_data(['liquidity'], ['liquidity'])
-            self.bb_data.factor['liquidity'] = liquidity.ix['liquidity']
-        else:
-            self.get_liq_stom()
-            self.get_liq_stoq()
-            self.get_liq_stoa()
-            # 过滤数据
-            self.bb_data.discard_uninv_data()
+        params = barra_base.cache_specs['liquidity']['params']
+        def calc_liquidity():
+            # 增量更新时，成分因子已经在截取数据之前计算好了
+            if not self.is_update:
+                self.get_liq_stom()
+                self.get_liq_stoq()
+                self.get_liq_stoa()
+            # 过滤用到的数据
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            dtype = self.get_dtype('factor', 'liquidity')
             # 计算三个成分因子的暴露
-            self.bb_data.raw_data['stom_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['stom'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['stoq_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['stoq'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['stoa_expo'] = strategy_data.get_cap_wgt_exposure( 
-                    self.bb_data.raw_data.ix['stoa'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            
-            liquidity = 0.35*self.bb_data.raw_data.ix['stom_expo']+0.35*self.bb_data.raw_data.ix['stoq_expo']+ \
-                                                              0.3*self.bb_data.raw_data.ix['stoa_expo']
+            stom_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.stom'), mv, dtype=dtype)
+            stoq_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.stoq'), mv, dtype=dtype)
+            stoa_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.stoa'), mv, dtype=dtype)
+
+            liquidity = params['stom_weight']*stom_expo + params['stoq_weight']*stoq_expo + \
+                        params['stoa_weight']*stoa_expo
             # 计算liquidity的因子暴露，不再去极值
-            y = strategy_data.get_cap_wgt_exposure(liquidity, self.bb_data.stock_price.ix['FreeMarketValue'], percentile=0)
+            y = strategy_data.get_cap_wgt_exposure(liquidity, mv, percentile=0, dtype=dtype)
             # 计算市值因子的暴露
-            x = pd.Panel({'lncap_expo': strategy_data.get_cap_wgt_exposure(self.bb_data.factor.ix['lncap'],
-                                                                           self.bb_data.stock_price.ix['FreeMarketValue'])})
+            x = pd.Panel({'lncap_expo': strategy_data.get_cap_wgt_exposure(self.get_inv_data('factor.lncap'), mv,
+                                                                           dtype=dtype)})
             # 正交化
-            new_liq = strategy_data.simple_orth_gs(y, x, weights = np.sqrt(self.bb_data.stock_price.ix['FreeMarketValue']))[0]
-            self.bb_data.factor['liquidity'] = new_liq
+            return strategy_data.simple_orth_gs(y, x, weights = np.sqrt(mv))[0]
+        self.set_named_data('factor.liquidity', self.get_cached('liquidity', calc_liquidity))
 
     # 计算earnings yield中的epfwd
     def get_ey_epfwd(self):
-        if os.path.isfile('epfwd.csv') and not self.is_update:
-            epfwd = data.read_data(['epfwd'], ['epfwd'])
-            epfwd = epfwd.ix['epfwd']
-        else:
+        def calc_epfwd():
             # 定义计算epfwd的函数
             def epfwd_func(fy1_data, fy2_data):
                 # 获取当前的月份数
@@ -515,127 +562,90 @@ class barra_base(object):
                 fy2_weight = 1-fy1_weight
                 return (fy1_data.mul(fy1_weight, axis=0) + fy2_data.mul(fy2_weight, axis=0))
             # 用预测的净利润数据除以市值数据得到预测的ep
-            ep_fy1 = self.bb_data.raw_data.ix['NetIncome_fy1']/self.bb_data.stock_price.ix['FreeMarketValue']
-            ep_fy2 = self.bb_data.raw_data.ix['NetIncome_fy2']/self.bb_data.stock_price.ix['FreeMarketValue']
-            epfwd = epfwd_func(ep_fy1, ep_fy2)
-        self.bb_data.raw_data['epfwd'] = epfwd
-            
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            ep_fy1 = self.get_inv_data('raw_data.NetIncome_fy1')/mv
+            ep_fy2 = self.get_inv_data('raw_data.NetIncome_fy2')/mv
+            return epfwd_func(ep_fy1, ep_fy2)
+        self.bb_data.raw_data['epfwd'] = self.get_cached('epfwd', calc_epfwd)
+
     # 计算earnings yield中的cetop
     def get_ey_cetop(self):
-        if os.path.isfile('cetop.csv') and not self.is_update:
-            cetop = data.read_data(['cetop'], ['cetop'])
-            cetop = cetop.ix['cetop']
-        else:
-            # 用cash earnings ttm 除以市值
-            cetop = self.bb_data.raw_data.ix['CashEarnings_ttm']/self.bb_data.stock_price.ix['FreeMarketValue']
-        self.bb_data.raw_data['cetop'] = cetop
-        
+        # 用cash earnings ttm 除以市值
+        self.bb_data.raw_data['cetop'] = self.get_cached('cetop', lambda:
+            self.get_inv_data('raw_data.CashEarnings_ttm')/self.get_inv_data('stock_price.FreeMarketValue'))
+
     # 计算earnings yield中的etop
     def get_ey_etop(self):
-        if os.path.isfile('etop.csv') and not self.is_update:
-            etop = data.read_data(['etop'], ['etop'])
-            etop = etop.ix['etop']
-        else:
-            # 用pe_ttm的倒数来计算etop
-            etop = 1/self.bb_data.raw_data.ix['PE_ttm']
-        self.bb_data.raw_data['etop'] = etop
+        # 用pe_ttm的倒数来计算etop
+        self.bb_data.raw_data['etop'] = self.get_cached('etop', lambda: 1/self.get_inv_data('raw_data.PE_ttm'))
 
     # 计算earnings yield
     def get_earnings_yeild(self):
-        if os.path.isfile('ey.csv') and not self.is_update:
-            EarningsYield = data.read_data(['ey'], ['ey'])
-            self.bb_data.factor['ey'] = EarningsYield.ix['ey']
-        else:
+        params = barra_base.cache_specs['ey']['params']
+        def calc_ey():
             self.get_ey_epfwd()
             self.get_ey_cetop()
             self.get_ey_etop()
-            self.bb_data.discard_uninv_data()
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            dtype = self.get_dtype('factor', 'ey')
             # 计算三个成分因子的暴露
-            self.bb_data.raw_data['epfwd_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['epfwd'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['cetop_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['cetop'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['etop_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['etop'], self.bb_data.stock_price.ix['FreeMarketValue'])
+            epfwd_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.epfwd'), mv, dtype=dtype)
+            cetop_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.cetop'), mv, dtype=dtype)
+            etop_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.etop'), mv, dtype=dtype)
 
-            EarningsYield = 0.68*self.bb_data.raw_data.ix['epfwd_expo']+0.21*self.bb_data.raw_data.ix['cetop_expo']+ \
-                                0.11*self.bb_data.raw_data.ix['etop_expo']
-            self.bb_data.factor['ey'] = EarningsYield
+            return params['epfwd_weight']*epfwd_expo + params['cetop_weight']*cetop_expo + \
+                   params['etop_weight']*etop_expo
+        self.set_named_data('factor.ey', self.get_cached('ey', calc_ey))
 
     # 计算growth中的egrlf
     def get_g_egrlf(self):
-        if os.path.isfile('egrlf.csv') and not self.is_update:
-            egrlf = data.read_data(['egrlf'], ['egrlf'])
-            egrlf = egrlf.ix['egrlf']
-        else:
-            # 用ni_fy2来代替长期预测的净利润
-            egrlf = (self.bb_data.raw_data.ix['NetIncome_fy2']/self.bb_data.raw_data.ix['NetIncome_ttm'])**(1/2) - 1
-        self.bb_data.raw_data['egrlf'] = egrlf
+        # 用ni_fy2来代替长期预测的净利润
+        self.bb_data.raw_data['egrlf'] = self.get_cached('egrlf', lambda:
+            (self.get_inv_data('raw_data.NetIncome_fy2')/self.get_inv_data('raw_data.NetIncome_ttm'))**(1/2) - 1)
 
     # 计算growth中的egrsf
     def get_g_egrsf(self):
-        if os.path.isfile('egrsf.csv') and not self.is_update:
-            egrsf = data.read_data(['egrsf'], ['egrsf'])
-            egrsf = egrsf.ix['egrsf']
-        else:
-            # 用ni_fy1来代替短期预测净利润
-            egrsf = self.bb_data.raw_data.ix['NetIncome_fy1'] / self.bb_data.raw_data.ix['NetIncome_ttm'] - 1
-        self.bb_data.raw_data['egrsf'] = egrsf
+        # 用ni_fy1来代替短期预测净利润
+        self.bb_data.raw_data['egrsf'] = self.get_cached('egrsf', lambda:
+            self.get_inv_data('raw_data.NetIncome_fy1') / self.get_inv_data('raw_data.NetIncome_ttm') - 1)
 
     # 计算growth中的egro
     def get_g_egro(self):
-        if os.path.isfile('egro.csv') and not self.is_update:
-            egro = data.read_data(['egro'], ['egro'])
-            egro = egro.ix['egro']
-        else:
-            # 用ni ttm的两年增长率代替ni ttm的5年增长率
-            egro = self.bb_data.raw_data.ix['NetIncome_ttm_growth_8q']
-        self.bb_data.raw_data['egro'] = egro
+        # 用ni ttm的两年增长率代替ni ttm的5年增长率
+        self.bb_data.raw_data['egro'] = self.get_cached('egro', lambda:
+            self.get_inv_data('raw_data.NetIncome_ttm_growth_8q'))
 
     # 计算growth中的sgro
     def get_g_sgro(self):
-        if os.path.isfile('sgro.csv') and not self.is_update:
-            sgro = data.read_data(['sgro'], ['sgro'])
-            sgro = sgro.ix['sgro']
-        else:
-            # 用历史营业收入代替历史sales per share
-            sgro = self.bb_data.raw_data.ix['Revenue_ttm_growth_8q']
-        self.bb_data.raw_data['sgro'] = sgro
+        # 用历史营业收入代替历史sales per share
+        self.bb_data.raw_data['sgro'] = self.get_cached('sgro', lambda:
+            self.get_inv_data('raw_data.Revenue_ttm_growth_8q'))
 
     # 计算growth
     def get_growth(self):
-        if os.path.isfile('growth.csv') and not self.is_update:
-            growth = data.read_data(['growth'], ['growth'])
-            self.bb_data.factor['growth'] = growth.ix['growth']
-        else:
+        params = barra_base.cache_specs['growth']['params']
+        def calc_growth():
             self.get_g_egrlf()
             self.get_g_egrsf()
             self.get_g_egro()
             self.get_g_sgro()
-            self.bb_data.discard_uninv_data()
+            mv = self.get_inv_data('stock_price.FreeMarketValue')
+            dtype = self.get_dtype('factor', 'growth')
             # 计算四个成分因子的暴露
-            self.bb_data.raw_data['egrlf_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['egrlf'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['egrsf_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['egrsf'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['egro_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['egro'], self.bb_data.stock_price.ix['FreeMarketValue'])
-            self.bb_data.raw_data['sgro_expo'] = strategy_data.get_cap_wgt_exposure(
-                self.bb_data.raw_data.ix['sgro'], self.bb_data.stock_price.ix['FreeMarketValue'])
-
-            growth = 0.18*self.bb_data.raw_data.ix['egrlf_expo']+0.11*self.bb_data.raw_data.ix['egrsf_expo']+ \
-                             0.24*self.bb_data.raw_data.ix['egro_expo']+0.47*self.bb_data.raw_data.ix['sgro_expo']
-            self.bb_data.factor['growth'] = growth
+            egrlf_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.egrlf'), mv, dtype=dtype)
+            egrsf_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.egrsf'), mv, dtype=dtype)
+            egro_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.egro'), mv, dtype=dtype)
+            sgro_expo = strategy_data.get_cap_wgt_exposure(self.get_inv_data('raw_data.sgro'), mv, dtype=dtype)
+
+            return params['egrlf_weight']*egrlf_expo + params['egrsf_weight']*egrsf_expo + \
+                   params['egro_weight']*egro_expo + params['sgro_weight']*sgro_expo
+        self.set_named_data('factor.growth', self.get_cached('growth', calc_growth))
 
     # 计算leverage
     def get_leverage(self):
-        if os.path.isfile('leverage.csv') and not self.is_update:
-            leverage = data.read_data(['leverage'], ['leverage'])
-            self.bb_data.factor['leverage'] = leverage.ix['leverage']
-        else:
-            # 用简单的资产负债率计算leverage
-            leverage = self.bb_data.raw_data.ix['TotalLiability']/self.bb_data.raw_data.ix['TotalAssets']
-            self.bb_data.factor['leverage'] = leverage
+        # 用简单的资产负债率计算leverage
+        self.set_named_data('factor.leverage', self.get_cached('leverage', lambda:
+            self.get_inv_data('raw_data.TotalLiability')/self.get_inv_data('raw_data.TotalAssets')))
 
     # 计算风格因子的因子暴露
     def get_style_factor_exposure(self):
@@ -644,35 +654,66 @@ class barra_base(object):
                                             minor_axis=self.bb_data.factor.minor_axis)
         # 循环计算暴露
         for item, df in self.bb_data.factor.iteritems():
+            dtype = self.get_dtype('factor_expo', item)
             # 通过内部因子加总得到的因子，或已经计算过一次暴露的因子（如正交化过），不再需要去极值
             if item in ['rv', 'nls', 'liquidity', 'ey', 'growth']:
                 self.bb_data.factor_expo[item] = strategy_data.get_cap_wgt_exposure(df,
-                                        self.bb_data.stock_price.ix['FreeMarketValue'], percentile=0)
+                                        self.bb_data.stock_price.ix['FreeMarketValue'], percentile=0, dtype=dtype)
             else:
                 self.bb_data.factor_expo[item] = strategy_data.get_cap_wgt_exposure(df,
-                                        self.bb_data.stock_price.ix['FreeMarketValue'])
+                                        self.bb_data.stock_price.ix['FreeMarketValue'], dtype=dtype)
+
+    # 股票池的标记，即可交易且在股票池内，与对bb_data设置该股票池后（不shift）handle_stock_pool得到的if_inv一致
+    def get_pool_mask(self, stock_pool):
+        if_tradable = self.bb_data.if_tradable.ix['if_tradable']
+        if stock_pool == 'all':
+            return if_tradable.astype(bool)
+        if 'Weight_' + stock_pool in self.bb_data.benchmark_price.items:
+            weights = self.bb_data.benchmark_price.ix['Weight_' + stock_pool]
+        else:
+            weights = data.read_data(['Weight_' + stock_pool], ['Weight_' + stock_pool]).ix['Weight_' + stock_pool]
+        in_pool = weights.reindex(index=if_tradable.index, columns=if_tradable.columns) > 0
+        return np.logical_and(if_tradable, in_pool)
+
+    # 一次计算多个股票池的风格因子暴露，每个因子的所有股票池在一次遍历数据中完成标准化
+    # 结果与对每个股票池分别深拷贝bb对象，设置股票池后调用just_get_factor_expo得到的风格因子暴露一致
+    # 注意：因子值需要是在所有股票池下（即stock_pool为'all'）计算的，否则股票池外的数据已经丢失
+    def get_multi_pool_style_factor_expo(self, stock_pools):
+        """ Get style factor exposures of several stock pools together.
+
+        :param stock_pools: (list) names of stock pools, e.g. ['all', 'hs300', 'zz500', 'zz800']
+        :return: (dict) stock pool names as keys, pd.Panel of style factor exposures as values
+        """
+        masks = [self.get_pool_mask(stock_pool) for stock_pool in stock_pools]
+        mv = self.bb_data.stock_price.ix['FreeMarketValue']
+        pool_expo = {stock_pool: {} for stock_pool in stock_pools}
+        for item, df in self.bb_data.factor.iteritems():
+            # 与get_style_factor_exposure一致，通过内部因子加总得到的因子不再去极值
+            percentile = 0 if item in ['rv', 'nls', 'liquidity', 'ey', 'growth'] else 0.01
+            curr_expo = strategy_data.get_multi_pool_exposure(df, pool_masks=masks, mv=mv, percentile=percentile,
+                                                              dtype=self.get_dtype('factor_expo', item))
+            for stock_pool, expo in zip(stock_pools, curr_expo):
+                pool_expo[stock_pool][item] = expo
+        return {stock_pool: pd.Panel(pool_expo[stock_pool], items=self.bb_data.factor.items)
+                for stock_pool in stock_pools}
 
     # 得到行业因子的虚拟变量
     def get_industry_factor(self):
         # 读取行业信息数据
         industry = data.read_data(['Industry'],['Industry'])
         self.industry = industry.ix['Industry']
-        # 对第一个拥有所有行业的日期取虚拟变量，以建立储存数据的panel
-        industry_num = self.industry.apply(lambda x:x.unique().size, axis=1)
-        # 注意所有行业28个，加上nan有29个
-        first_valid_index = industry_num[industry_num==29].index[0]
-        temp_dum = pd.get_dummies(self.industry.ix[first_valid_index], prefix='Industry')
-        industry_dummies = pd.Panel(data=None, major_axis = temp_dum.index, minor_axis = temp_dum.columns)
-        # 开始循环
-        for time, ind_data in self.industry.iterrows():
-            industry_dummies[time] = pd.get_dummies(ind_data, prefix='Industry')
-        # 转置
-        industry_dummies = industry_dummies.transpose(2,0,1)
-        # 将行业因子暴露与风格因子暴露的索引对其
-        industry_dummies = data.align_index(self.bb_data.factor_expo.ix[0], industry_dummies)
-        # 将nan填成0，主要是有些行业在某一时间点，没有一只股票属于它，这会造成在这个行业上的暴露是nan
-        # 因此需要把这个行业的暴露填成0，而uninv的nan同样会被填上，但会在之后的filter中再次变成nan
-        industry_dummies = industry_dummies.fillna(0)
+        # 将所有日期的行业一次性编码为整数，行业为所有日期中出现过的所有行业，nan的编码为-1
+        codes, industry_names = strategy_data.encode_labels(self.industry)
+        self.industry_codes = pd.DataFrame(codes, index=self.industry.index, columns=self.industry.columns)
+        # 只对风格因子暴露的日期和股票生成虚拟变量，没有行业数据的编码为-1，即在所有行业上的暴露都为0，
+        # 其中uninv的股票会在之后的filter中再次变成nan
+        aligned_codes = self.industry_codes.reindex(index=self.bb_data.factor_expo.major_axis,
+                            columns=self.bb_data.factor_expo.minor_axis, fill_value=-1).values
+        # 根据编码一次性生成所有日期的行业虚拟变量，因子名与pd.get_dummies的前缀一致
+        industry_dummies = pd.Panel(strategy_data.get_dummies_from_codes(aligned_codes, industry_names.size),
+                                    items=['Industry_'+str(name) for name in industry_names],
+                                    major_axis=self.bb_data.factor_expo.major_axis,
+                                    minor_axis=self.bb_data.factor_expo.minor_axis)
         # 将行业因子暴露与风格因子暴露衔接在一起
         self.bb_data.factor_expo = pd.concat([self.bb_data.factor_expo, industry_dummies])
         
@@ -685,29 +726,79 @@ class barra_base(object):
         constant.name = 'country_factor'
         self.bb_data.factor_expo = pd.concat([self.bb_data.factor_expo, constant])
 
+    # 风格因子计算的依赖图，每个风格因子为一个节点，节点的输入输出以'panel名.数据名'表示，temp_hsigma为beta中算出的hsigma
+    # 节点的输入只包括真正用到的数据，需要过滤uninv数据的因子在计算中只过滤自己用到的数据，不改写其他数据
+    def build_style_factor_graph(self):
+        graph = factor_graph(self.merge_graph_outputs, n_jobs=self.n_jobs)
+        # 节点名，计算方法，输入，输出，节点名即为因子名
+        node_specs = [
+            ('lncap', 'get_lncap', ['stock_price.FreeMarketValue'], ['factor.lncap']),
+            ('beta', 'get_beta', ['stock_price.daily_excess_return', 'stock_price.FreeMarketValue'],
+             ['factor.beta', 'temp_hsigma']),
+            ('momentum', 'get_momentum', ['stock_price.daily_excess_return'], ['factor.momentum']),
+            ('rv', 'get_residual_volatility', ['factor.lncap', 'factor.beta', 'temp_hsigma',
+             'stock_price.daily_excess_return', 'stock_price.FreeMarketValue'],
+             ['factor.rv', 'raw_data.dastd', 'raw_data.cmra', 'raw_data.hsigma']),
+            ('nls', 'get_nonlinear_size', ['factor.lncap', 'stock_price.FreeMarketValue'], ['factor.nls']),
+            ('bp', 'get_pb', ['raw_data.PB'], ['factor.bp']),
+            ('liquidity', 'get_liquidity', ['factor.lncap', 'stock_price.Volume', 'stock_price.FreeShares',
+             'stock_price.FreeMarketValue'], ['factor.liquidity', 'raw_data.stom', 'raw_data.stoq',
+             'raw_data.stoa']),
+            ('ey', 'get_earnings_yeild', ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_fy2',
+             'raw_data.CashEarnings_ttm', 'raw_data.PE_ttm', 'stock_price.FreeMarketValue'],
+             ['factor.ey', 'raw_data.epfwd', 'raw_data.cetop', 'raw_data.etop']),
+            ('growth', 'get_growth', ['raw_data.NetIncome_fy1', 'raw_data.NetIncome_fy2',
+             'raw_data.NetIncome_ttm', 'raw_data.NetIncome_ttm_growth_8q', 'raw_data.Revenue_ttm_growth_8q',
+             'stock_price.FreeMarketValue'], ['factor.growth', 'raw_data.egrlf', 'raw_data.egrsf',
+             'raw_data.egro', 'raw_data.sgro']),
+            ('leverage', 'get_leverage', ['raw_data.TotalLiability', 'raw_data.TotalAssets'], ['factor.leverage'])]
+        for name, method_name, inputs, outputs in node_specs:
+            graph.add_node(name, functools.partial(self.run_graph_node, method_name, outputs),
+                           inputs=inputs, outputs=outputs,
+                           load_cache=functools.partial(self.load_graph_cache, name, method_name))
+        return graph
+
+    # 在子进程中计算一个节点，返回节点的输出
+    def run_graph_node(self, method_name, outputs):
+        getattr(self, method_name)()
+        return {output_name: self.get_named_data(output_name) for output_name in outputs
+                if self.has_named_data(output_name)}
+
+    # 将节点的输出合并回当前对象
+    def merge_graph_outputs(self, node_outputs):
+        for output_name, output_data in node_outputs.items():
+            self.set_named_data(output_name, output_data)
+
+    # 节点的缓存是否有效，有效时在当前进程中读取缓存，跳过节点的计算
+    # 增量更新时，已经在截取数据之前计算好的因子（lncap，beta，momentum）也直接跳过
+    # 因子文件已经覆盖当前数据时，直接读取因子文件，与增量更新共用同一个储存，因子缓存只用于因子文件中没有的部分
+    def load_graph_cache(self, factor_name, method_name):
+        if self.is_update and factor_name in self.bb_data.factor.items:
+            return True
+        stored_factor = self.read_stored_factor(factor_name)
+        if type(stored_factor) != str:
+            self.set_named_data('factor.' + factor_name, stored_factor)
+            return True
+        if type(self.factor_cache) != str and self.factor_cache.has(self.get_cache_entry(factor_name)):
+            # 计算方法中有有效缓存时会直接读取缓存
+            getattr(self, method_name)()
+            return True
+        return False
+
+    # 用依赖图计算所有风格因子，相互独立的因子同时计算，计算后因子的顺序与之前顺序计算时一致
+    def get_style_factors(self):
+        graph = self.build_style_factor_graph()
+        graph.run()
+        self.style_factor_run_record = graph.run_record
+        self.bb_data.factor = self.bb_data.factor.reindex(items=list(graph.nodes.keys()))
+
     # 构建barra base的所有风格因子和行业因子
     def construct_barra_base(self, *, if_save=False):
         # 读取数据，更新数据则不用读取，因为已经存在
         if not self.is_update:
             self.read_original_data()
-        # 创建风格因子
-        self.get_lncap()
-        self.get_beta_parallel()
-        print('get beta completed...\n')
-        self.get_momentum()
-        print('get momentum completed...\n')
-        self.get_residual_volatility()
-        print('get rv completed...\n')
-        self.get_nonlinear_size()
-        print('get nls completed...\n')
-        self.get_pb()
-        self.get_liquidity()
-        print('get liquidity completed...\n')
-        self.get_earnings_yeild()
-        print('get ey completed...\n')
-        self.get_growth()
-        self.get_leverage()
-        print('get leverage completed...\n')
+        # 创建风格因子，增量更新时，lncap，beta和momentum已经在截取数据之前计算好了
+        self.get_style_factors()
         # 计算风格因子暴露之前再过滤一次
         self.bb_data.discard_uninv_data()
         # 计算风格因子暴露
@@ -720,6 +811,9 @@ class barra_base(object):
         self.add_country_factor()
         # 计算的最后，过滤数据
         self.bb_data.discard_uninv_data()
+        # 按精度策略转换数据类型
+        if type(self.precision_policy) != str:
+            self.precision_policy.apply(self.bb_data)
 
         # 如果显示指定了储存数据且股票池为所有股票，则储存因子值数据
         # 注意，即便显示指定了储存数据，但股票池不是所有股票，仍不会进行储存
@@ -732,90 +826,135 @@ class barra_base(object):
         if not self.is_update:
             self.read_original_data()
         # 创建风格因子
-        self.get_lncap()
-        self.get_beta_parallel()
-        print('get beta completed...\n')
-        self.get_momentum()
-        print('get momentum completed...\n')
-        self.get_residual_volatility()
-        print('get rv completed...\n')
-        self.get_nonlinear_size()
-        print('get nls completed...\n')
-        self.get_pb()
-        self.get_liquidity()
-        print('get liquidity completed...\n')
-        self.get_earnings_yeild()
-        print('get ey completed...\n')
-        self.get_growth()
-        self.get_leverage()
-        print('get leverage completed...\n')
+        self.get_style_factors()
         # 计算风格因子暴露之前再过滤一次
         self.bb_data.discard_uninv_data()
 
     # 仅计算barra base的因子暴露，主要用于对与不同股票池，可以在不重新建立新对象的情况下，根据已有因子值算不同的因子暴露
+    # 如果已经用get_multi_pool_style_factor_expo算好了当前股票池的风格因子暴露，则直接使用
     def just_get_factor_expo(self):
         self.bb_data.discard_uninv_data()
-        self.get_style_factor_exposure()
+        if self.bb_data.stock_pool in self.pool_style_expo:
+            self.bb_data.factor_expo = self.pool_style_expo[self.bb_data.stock_pool].copy()
+        else:
+            self.get_style_factor_exposure()
         self.get_industry_factor()
         self.add_country_factor()
         self.bb_data.discard_uninv_data()
 
-    # 回归计算各个基本因子的因子收益
-    def get_bb_factor_return(self):
-        # 初始化储存因子收益的dataframe
-        self.bb_factor_return = pd.DataFrame(np.nan, index=self.bb_data.factor_expo.major_axis,
-                                             columns=self.bb_data.factor_expo.items)
+    # 为某个股票池建立一个bb对象，用于在多个股票池下使用同一个已经算好风格因子的bb对象（如多个股票池的单因子测试）
+    # 之后会被原地改写的数据（行情，因子值，可交易标记，基准）各复制一份，只在计算风格因子时用到的原始数据不再复制，
+    # 其余数据与原对象共用，因此比深拷贝整个bb对象节省内存和时间，pool_style_expo为事先算好的该股票池的风格因子暴露
+    def get_pool_copy(self, stock_pool, *, pool_style_expo='Empty'):
+        pool_bb = copy.copy(self)
+        pool_bb.bb_data = copy.copy(self.bb_data)
+        pool_bb.bb_data.stock_price = self.bb_data.stock_price.copy()
+        pool_bb.bb_data.factor = self.bb_data.factor.copy()
+        pool_bb.bb_data.if_tradable = self.bb_data.if_tradable.copy()
+        pool_bb.bb_data.benchmark_price = self.bb_data.benchmark_price.copy()
+        pool_bb.bb_data.raw_data = pd.Panel()
+        pool_bb.bb_data.factor_expo = pd.Panel()
+        pool_bb.bb_factor_return = pd.DataFrame()
+        pool_bb.bb_residual_return = pd.DataFrame()
+        pool_bb.pool_style_expo = {} if type(pool_style_expo) == str else {stock_pool: pool_style_expo}
+        return pool_bb
+
+    # 取回归计算因子收益时用到的数据，即当期的收益，上一期的因子暴露，以及上一期的市值
+    def get_bb_factor_return_input(self):
         # 因子暴露要用上一期的因子暴露，用来加权的市值要用上一期的市值
         lag_factor_expo = self.bb_data.factor_expo.shift(1).reindex(
                           major_axis=self.bb_data.factor_expo.major_axis)
-        lag_mv = self.bb_data.stock_price.ix['FreeMarketValue'].shift(1)
-        # 循环回归，计算因子收益
-        for time, temp_data in self.bb_factor_return.iterrows():
-            outcome = strategy_data.constrained_gls_barra_base(
-                       self.bb_data.stock_price.ix['daily_return', time, :],
-                       lag_factor_expo.ix[:, time, :],
-                       weights = np.sqrt(lag_mv.ix[time, :]),
-                       indus_ret_weights = lag_mv.ix[time, :])
-            self.bb_factor_return.ix[time, :] = outcome[0]
+        lag_mv = self.bb_data.stock_price.ix['FreeMarketValue'].shift(1).reindex(
+                 index=lag_factor_expo.major_axis, columns=lag_factor_expo.minor_axis)
+        daily_return = self.bb_data.stock_price.ix['daily_return'].reindex(index=lag_factor_expo.major_axis,
+                                                                           columns=lag_factor_expo.minor_axis)
+        return [daily_return, lag_factor_expo, lag_mv]
+
+    # 回归计算各个基本因子的因子收益
+    # 所有日期的带约束回归通过kkt方程组批量求解，不再逐日调用二次规划求解器
+    # dates为需要回归的日期，默认为所有日期，可以只回归部分日期（如增量更新因子收益时）
+    def get_bb_factor_return(self, *, dates='default'):
+        daily_return, lag_factor_expo, lag_mv = self.get_bb_factor_return_input()
+        if type(dates) != str:
+            daily_return = daily_return.reindex(index=dates)
+        # 批量回归，计算因子收益以及回归的残差
+        outcome = strategy_data.constrained_gls_barra_base_batch(daily_return, lag_factor_expo,
+                                                                 weights=np.sqrt(lag_mv), indus_ret_weights=lag_mv)
+        self.bb_factor_return = outcome[0]
+        self.bb_residual_return = outcome[1]
         print('get bb factor return completed...\n')
 
-    # 更新数据
+    # 计算所有依赖于历史数据的因子和成分因子，即需要用到计算起点之前的数据作为窗口的部分
+    # 设置了calc_start_date时，只计算计算起点及之后的日期
+    def get_time_series_components(self):
+        self.get_lncap()
+        self.get_beta()
+        print('get beta completed...\n')
+        self.get_momentum()
+        print('get momentum completed...\n')
+        self.get_rv_dastd()
+        self.get_rv_cmra()
+        self.get_rv_hsigma()
+        self.get_liq_stom()
+        self.get_liq_stoq()
+        self.get_liq_stoa()
+        print('get time series components completed...\n')
+
+    # 将所有数据截取到计算起点及之后的日期，之后截面上的计算（暴露，正交化，行业因子等）只在这些日期上进行
+    def trim_to_calc_dates(self):
+        cursor = self.get_calc_start_cursor()
+        self.bb_data.stock_price = self.bb_data.stock_price.iloc[:, cursor:, :]
+        self.bb_data.raw_data = self.bb_data.raw_data.iloc[:, cursor:, :]
+        self.bb_data.factor = self.bb_data.factor.iloc[:, cursor:, :]
+        self.bb_data.if_tradable = self.bb_data.if_tradable.iloc[:, cursor:, :]
+        if not self.bb_data.benchmark_price.empty:
+            self.bb_data.benchmark_price = self.bb_data.benchmark_price.iloc[:, cursor:, :]
+        # 截取之后的所有日期都需要计算
+        self.calc_start_date = 'default'
+
+    # 增量更新数据，只计算因子数据最后一天之后的新日期，之前的原始数据只作为滚动窗口的输入
+    # 新日期的因子值追加到因子文件的末尾，不重写旧数据
+    # 因子数据只有一个储存的地方，即因子文件，更新的起点由因子文件的最后一天决定，更新的结果也只追加到因子文件中，
+    # 之后的构建（如归因，风险模型，单因子测试中的bb对象）通过read_stored_factor从同一个因子文件中读取因子
+    # 更新时不使用因子缓存：只计算新日期的结果以计算起点为键，下次更新时计算起点已经改变，这些条目不会再被读取，
+    # 而全量计算的缓存条目又不包含新日期，因此更新既不读取也不写入缓存，因子文件与缓存不会出现不一致
     def update_barra_base_factor_data(self):
         self.is_update = True
         # 检验stock pool是否为all
         assert self.bb_data.stock_pool == 'all', print('Please make sure stock pool is all when updating factor data.\n')
-        # 首先读取原始数据
-        self.read_original_data()
-        # 读取旧的因子数据
-        old_bb_factor_names = ['lncap', 'beta', 'momentum', 'rv', 'nls', 'bp', 'liquidity', 'ey', 'growth', 'leverage']
-        old_bb_factors = data.read_data(old_bb_factor_names, old_bb_factor_names)
-        # 更新与否取决于原始数据和因子数据，若因子数据的时间轴早于原始数据，则进行更新
-        # 这里对比的数据实际是free mv和lncap，因为barra base的计算是以这两个为基准的
-        last_day = old_bb_factors.major_axis[-1]
-        if last_day == self.bb_data.stock_price.major_axis[-1]:
-            print('The barra base factor data have been up-to-date.\n')
-            return
-        # 找因子数据的最后一天在原始数据中的对应位置
-        last_loc = self.bb_data.stock_price.major_axis.get_loc(last_day)
-        # 将原始数据截取，截取范围从更新的第一天的（即因子数据的最后一天的下一天）前525天到最后一天
-        # 更新前525天的选取是因为t时刻的bb因子值最远需要取到525天前的原始数据，在momentum因子中用到
-        new_start_loc = last_loc + 1 - 525
-        self.bb_data.stock_price = self.bb_data.stock_price.iloc[:, new_start_loc:, :]
-        self.bb_data.raw_data = self.bb_data.raw_data.iloc[:, new_start_loc:, :]
-        self.bb_data.if_tradable = self.bb_data.if_tradable.iloc[:, new_start_loc:, :]
-
-        # 开始计算新的因子值
-        self.construct_barra_base()
-
-        # 将旧因子值的股票索引换成新的因子值的股票索引
-        old_bb_factors = old_bb_factors.reindex(minor_axis=self.bb_data.factor.minor_axis)
-        # 衔接新旧因子值
-        new_factor_data = pd.concat([old_bb_factors, self.bb_data.factor], axis=1)
-        self.bb_data.factor = new_factor_data.groupby(new_factor_data.major_axis).first()
-        # 储存因子值数据
-        data.write_data(self.bb_data.factor)
-
-        self.is_update = False
+        curr_factor_cache = self.factor_cache
+        self.factor_cache = 'Empty'
+        try:
+            # 首先读取原始数据
+            self.read_original_data()
+            # 更新与否取决于原始数据和因子数据，若因子数据的时间轴早于原始数据，则进行更新
+            # 这里对比的数据实际是free mv和lncap，因为barra base的计算是以这两个为基准的，只需读取lncap的时间索引
+            last_day = pd.read_csv('lncap.csv', index_col=0, usecols=[0], parse_dates=True,
+                                   encoding='GB18030').index[-1]
+            if last_day == self.bb_data.stock_price.major_axis[-1]:
+                print('The barra base factor data have been up-to-date.\n')
+                return
+            # 找因子数据的最后一天在原始数据中的对应位置
+            last_loc = self.bb_data.stock_price.major_axis.get_loc(last_day)
+            # 将原始数据截取，截取范围从更新的第一天的（即因子数据的最后一天的下一天）前525天到最后一天
+            # 更新前525天的选取是因为t时刻的bb因子值最远需要取到525天前的原始数据，在momentum因子中用到
+            new_start_loc = max(last_loc + 1 - 525, 0)
+            self.calc_start_date = self.bb_data.stock_price.major_axis[last_loc + 1]
+            self.bb_data.stock_price = self.bb_data.stock_price.iloc[:, new_start_loc:, :]
+            self.bb_data.raw_data = self.bb_data.raw_data.iloc[:, new_start_loc:, :]
+            self.bb_data.if_tradable = self.bb_data.if_tradable.iloc[:, new_start_loc:, :]
+
+            # 先在包含窗口的数据上，只对新的日期计算依赖于历史数据的部分
+            self.get_time_series_components()
+            # 再将数据截取到新的日期上，计算其余的截面上的部分
+            self.trim_to_calc_dates()
+            self.construct_barra_base()
+
+            # 将新日期的因子值追加到因子文件中
+            data.append_data(self.bb_data.factor)
+        finally:
+            self.factor_cache = curr_factor_cache
+            self.is_update = False
 
 if __name__ == '__main__':
     import time
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy import stats
+
+# 批量回归类，对每一期（或每一组）数据分别做加权最小二乘回归，但所有期的回归一次性用矩阵运算完成，
+# 以替代对每一期循环调用statsmodels的方式，结果与statsmodels.WLS(missing='drop')一致
+# 约定：y为期数*样本数的矩阵，x为变量数*期数*样本数的矩阵（与pd.Panel.values的排列一致）
+
+class batch_regression(object):
+    """ This is the class of batched weighted least square regressions.
+
+    foo
+    """
+
+    # 每一期自变量矩阵的秩，与np.linalg.matrix_rank的默认容忍度一致，其中样本数只算参与回归的样本
+    # 注意不能用gram矩阵的特征值开方来算，其精度只有sqrt(eps)，共线的情况会被误判为满秩
+    @staticmethod
+    def get_rank(mat, n_obs):
+        singular_values = np.linalg.svd(mat, compute_uv=False)
+        tol = singular_values.max(axis=-1, keepdims=True) * np.maximum(n_obs, mat.shape[-1])[:, np.newaxis] * \
+              np.finfo(np.float64).eps
+        return (singular_values > tol).sum(axis=-1)
+
+    @staticmethod
+    def batch_wls(y, x, *, weights='default', add_constant=False, min_obs=1, chunksize=250):
+        """ Do weighted least square regression for each period in one batch.
+
+        :param y: (np.ndarray) periods*samples array of dependent variables
+        :param x: (np.ndarray) variables*periods*samples array of independent variables
+        :param weights: (np.ndarray) periods*samples array of regression weights, 'default' means equal weights
+        :param add_constant: (bool) whether to add constant as the first variable
+        :param min_obs: (int) periods with no more than min_obs valid samples are not regressed, and get nan
+        :param chunksize: (int) number of periods solved in one batch, which controls the peak memory
+        :return: (list) [resid, params, t_stats, p_values, rsquared, rsquared_adj], resid is periods*samples array of
+            unweighted residuals (nan for samples not in regression), params, t_stats and p_values are
+            periods*variables arrays (constant is the first variable if added), rsquared and rsquared_adj are
+            periods arrays
+        """
+        y = np.asarray(y, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        n_periods, n_samples = y.shape
+        if type(weights) == str:
+            weights = np.ones(y.shape)
+        weights = np.asarray(weights, dtype=np.float64)
+        n_vars = x.shape[0] + int(add_constant)
+
+        resid = np.empty((n_periods, n_samples)) * np.nan
+        params = np.empty((n_periods, n_vars)) * np.nan
+        t_stats = np.empty((n_periods, n_vars)) * np.nan
+        p_values = np.empty((n_periods, n_vars)) * np.nan
+        rsquared = np.empty(n_periods) * np.nan
+        rsquared_adj = np.empty(n_periods) * np.nan
+
+        for start in range(0, n_periods, chunksize):
+            end = min(start + chunksize, n_periods)
+            # 期数*样本数*变量数
+            curr_x = x[:, start:end, :].transpose(1, 2, 0)
+            if add_constant:
+                curr_x = np.concatenate((np.ones(curr_x.shape[:2] + (1,)), curr_x), axis=2)
+            curr_y = y[start:end]
+            curr_w = weights[start:end]
+            # 与missing='drop'一致，y，x，权重中任意一个为nan的样本不参与回归
+            valid = np.logical_and(np.logical_not(np.isnan(curr_y)), np.logical_not(np.isnan(curr_x).any(2)))
+            valid = np.logical_and(valid, np.logical_not(np.isnan(curr_w)))
+            n_obs = valid.sum(1)
+            enough = n_obs > min_obs
+            valid = np.logical_and(valid, enough[:, np.newaxis])
+            if not enough.any():
+                continue
+
+            x_filled = np.where(valid[:, :, np.newaxis], curr_x, 0.0)
+            y_filled = np.where(valid, curr_y, 0.0)
+            w_filled = np.where(valid, curr_w, 0.0)
+            sqrt_w = np.sqrt(w_filled)
+            wx = x_filled * sqrt_w[:, :, np.newaxis]
+            wy = y_filled * sqrt_w
+
+            # 正规方程，与statsmodels一致用伪逆求解，共线的情况也能得到最小范数解
+            gram = np.einsum('ijk,ijl->ikl', wx, wx)
+            inv_gram = np.linalg.pinv(gram)
+            curr_params = np.einsum('ikl,il->ik', inv_gram, np.einsum('ijk,ij->ik', wx, wy))
+
+            # 残差为不加权的残差，与statsmodels中的resid一致
+            fitted = np.einsum('ijk,ik->ij', x_filled, curr_params)
+            curr_resid = np.where(valid, curr_y - fitted, np.nan)
+            weighted_resid = wy - np.einsum('ijk,ik->ij', wx, curr_params)
+            ssr = (weighted_resid ** 2).sum(1)
+            rank = batch_regression.get_rank(wx, n_obs)
+            df_resid = n_obs - rank
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = ssr / df_resid
+                bse = np.sqrt(np.diagonal(inv_gram, axis1=1, axis2=2) * scale[:, np.newaxis])
+                curr_t = curr_params / bse
+                curr_p = 2 * stats.t.sf(np.abs(curr_t), df_resid[:, np.newaxis])
+
+                # 判断是否有截距项（包括隐含的截距项，如行业虚拟变量之和为1），与statsmodels一致：
+                # 加入一列1之后，自变量的秩不变，则认为有截距项
+                augmented_x = np.concatenate((valid.astype(np.float64)[:, :, np.newaxis], x_filled), axis=2)
+                k_constant = (batch_regression.get_rank(augmented_x, n_obs) ==
+                              batch_regression.get_rank(x_filled, n_obs)).astype(int)
+
+                # 有截距项时用去均值的总平方和，否则用不去均值的总平方和
+                weighted_mean = (w_filled * y_filled).sum(1) / w_filled.sum(1)
+                centered_tss = (w_filled * (y_filled - weighted_mean[:, np.newaxis]) ** 2 * valid).sum(1)
+                uncentered_tss = (w_filled * y_filled ** 2).sum(1)
+                tss = np.where(k_constant == 1, centered_tss, uncentered_tss)
+                curr_rsquared = 1 - ssr / tss
+                curr_rsquared_adj = 1 - (n_obs - k_constant) / df_resid * (1 - curr_rsquared)
+
+            resid[start:end] = curr_resid
+            params[start:end] = np.where(enough[:, np.newaxis], curr_params, np.nan)
+            t_stats[start:end] = np.where(enough[:, np.newaxis], curr_t, np.nan)
+            p_values[start:end] = np.where(enough[:, np.newaxis], curr_p, np.nan)
+            rsquared[start:end] = np.where(enough, curr_rsquared, np.nan)
+            rsquared_adj[start:end] = np.where(enough, curr_rsquared_adj, np.nan)
+
+        return [resid, params, t_stats, p_values, rsquared, rsquared_adj]
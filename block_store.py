@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+
+# 按块读写的二进制数据仓库，每个数据（一个时间*股票的矩阵）储存为一个.npy文件，索引和列名储存在同名的.axes.pkl文件中
+# 读取时用内存映射打开文件，只有读取的那一块日期或股票的数据会进入内存，因此可以按股票块做时间序列上的计算，
+# 按日期块做截面上的计算，而不需要把整个矩阵读入内存
+# 计算的中间结果也写入仓库，供之后的计算按块读取
+
+class block_store(object):
+    """ This is the class of binary data store which can be read and written by blocks.
+
+    store_dir (str): directory of store files
+    """
+    def __init__(self, *, store_dir='block_store'):
+        self.store_dir = store_dir
+
+    def get_data_path(self, name):
+        return os.path.join(self.store_dir, name + '.npy')
+
+    def get_axes_path(self, name):
+        return os.path.join(self.store_dir, name + '.axes.pkl')
+
+    def has(self, name):
+        return os.path.isfile(self.get_data_path(name)) and os.path.isfile(self.get_axes_path(name))
+
+    # 数据的索引和列名
+    def get_axes(self, name):
+        return pd.read_pickle(self.get_axes_path(name))
+
+    # 新建一个数据，返回可写的内存映射数组，初始值为nan，之后可以按块写入
+    def create(self, name, index, columns, *, dtype=np.float64):
+        os.makedirs(self.store_dir, exist_ok=True)
+        values = np.lib.format.open_memmap(self.get_data_path(name), mode='w+', dtype=dtype,
+                                           shape=(len(index), len(columns)))
+        if np.issubdtype(values.dtype, np.floating):
+            values[:] = np.nan
+        pd.to_pickle([pd.Index(index), pd.Index(columns)], self.get_axes_path(name))
+        return values
+
+    # 写入一整个dataframe
+    def write(self, name, written_data, *, dtype=np.float64):
+        values = self.create(name, written_data.index, written_data.columns, dtype=dtype)
+        values[:] = written_data.values
+        values.flush()
+
+    # 将数据写入已有数据的一块，rows和columns为块的位置（slice）
+    def write_block(self, name, block_data, *, rows=slice(None), columns=slice(None)):
+        values = np.load(self.get_data_path(name), mmap_mode='r+')
+        values[rows, columns] = np.asarray(block_data)
+        values.flush()
+
+    # 读取数据的一块，rows和columns为块的位置（slice），返回dataframe
+    def read(self, name, *, rows=slice(None), columns=slice(None)):
+        """ Read a block of data from the store.
+
+        :param name: (str) name of the data
+        :param rows: (slice) positions of dates to read
+        :param columns: (slice) positions of stocks to read
+        :return: (pd.DataFrame) block of data
+        """
+        index, all_columns = self.get_axes(name)
+        values = np.load(self.get_data_path(name), mmap_mode='r')
+        return pd.DataFrame(np.array(values[rows, columns]), index=index[rows], columns=all_columns[columns])
+
+    # 将csv数据文件导入仓库，like为标准的数据名，导入的数据按照其索引和列名对齐，对齐时没有的数据为fill_value
+    # csv文件按行分块读入，每一块对齐后直接写入内存映射的数组，因此导入时的内存占用只有chunksize行数据的大小
+    def import_csv(self, file_name, *, item_name='default', like='Empty', fill_value=np.nan, dtype=np.float64,
+                   chunksize=250):
+        item_name = file_name if item_name == 'default' else item_name
+        file_path = str(os.path.abspath('.'))+'/'+file_name+'.csv'
+        if like != 'Empty':
+            index, columns = self.get_axes(like)
+        else:
+            # 不需要对齐时，索引和列名即为文件的索引和列名，只读取第一列和表头
+            index = pd.read_csv(file_path, index_col=0, usecols=[0], parse_dates=True, encoding='GB18030').index
+            columns = pd.read_csv(file_path, index_col=0, nrows=0, encoding='GB18030').columns
+        values = self.create(item_name, index, columns, dtype=dtype)
+        if not (np.issubdtype(values.dtype, np.floating) and np.isnan(fill_value)):
+            values[:] = fill_value
+        cursor = 0
+        for chunk in pd.read_csv(file_path, index_col=0, parse_dates=True, encoding='GB18030', chunksize=chunksize):
+            chunk_values = chunk.reindex(columns=columns, fill_value=fill_value).values
+            if like != 'Empty':
+                # 文件中有而标准数据中没有的日期不导入
+                locs = index.get_indexer(chunk.index)
+                values[locs[locs >= 0]] = chunk_values[locs >= 0]
+            else:
+                values[cursor:cursor + chunk_values.shape[0]] = chunk_values
+            cursor += chunk_values.shape[0]
+        values.flush()
+
+    # 将仓库中的数据按日期块写入csv文件，与data.write_data写出的文件格式一致
+    def export_csv(self, name, *, file_name='default', chunksize=250):
+        file_name = name if file_name == 'default' else file_name
+        index, columns = self.get_axes(name)
+        for start in range(0, len(index), chunksize):
+            block = self.read(name, rows=slice(start, start + chunksize))
+            if start == 0:
+                block.to_csv(file_name+'.csv', index_label='datetime', na_rep='NaN', encoding='GB18030')
+            else:
+                block.to_csv(file_name+'.csv', mode='a', header=False, na_rep='NaN', encoding='GB18030')
+
+    def remove(self, name):
+        for path in [self.get_data_path(name), self.get_axes_path(name)]:
+            if os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+import multiprocessing as mp
+
+from strategy_data import strategy_data
+from barra_base import barra_base
+from block_store import block_store
+
+# 分块计算barra base，使得计算时的内存占用不超过给定的预算
+# 风格因子的计算分为两部分：依赖于历史数据的时间序列部分（beta，momentum，dastd等滚动窗口的计算），在股票之间相互独立，
+# 按股票分块计算，每一块包含所有日期；其余的截面部分（标准化，正交化，因子的合成等），在日期之间相互独立，按日期分块计算，
+# 每一块包含所有股票。这与增量更新时先算时间序列部分，再截取日期算截面部分的做法一致
+# 原始数据先导入二进制的数据仓库，中间结果与最终结果都写入仓库，每一块只从仓库中读取需要的部分
+# 数据在仓库中的名字与barra base中一样，为'panel名.数据名'，如'stock_price.FreeMarketValue'，'factor_expo.beta'
+
+class chunked_barra_base(object):
+    """ This is the class for barra base construction by blocks within a memory budget.
+
+    foo
+    """
+    # 需要导入的原始数据
+    stock_price_items = ['FreeMarketValue', 'ClosePrice_adj', 'Volume', 'FreeShares']
+    raw_data_items = ['PB', 'NetIncome_fy1', 'NetIncome_fy2', 'CashEarnings_ttm', 'PE_ttm', 'NetIncome_ttm',
+                      'NetIncome_ttm_growth_8q', 'Revenue_ttm_growth_8q', 'TotalAssets', 'TotalLiability']
+    if_tradable_items = ['is_enlisted', 'is_delisted', 'is_suspended']
+    # 时间序列部分算出的数据
+    ts_outputs = ['factor.lncap', 'factor.beta', 'factor.momentum', 'raw_data.dastd', 'raw_data.cmra',
+                  'raw_data.hsigma', 'raw_data.stom', 'raw_data.stoq', 'raw_data.stoa']
+    # 每一块中同时在内存中的矩阵个数的粗略估计（包括输入，输出以及计算中的临时数据），用来根据内存预算确定块的大小
+    # 截面部分中，父进程中的输入与输出为所有子进程共用，而依赖图的每个子进程还有自己的临时数据，
+    # 因此截面部分每块的矩阵个数为共用的个数加上每个子进程的个数乘以子进程数
+    ts_arrays_per_block = 40
+    cs_shared_arrays = 60
+    cs_arrays_per_worker = 20
+
+    def __init__(self, *, memory_budget_mb=4096, store_dir='block_store', stock_pool='all', n_jobs='default'):
+        self.store = block_store(store_dir=store_dir)
+        self.memory_budget_mb = memory_budget_mb
+        self.stock_pool = stock_pool
+        # 截面部分用依赖图计算风格因子时，进程池中的进程数
+        self.n_jobs = n_jobs
+        # 所有股票的市值加权收益，beta回归的自变量
+        self.cap_wgt_universe_return = pd.Series()
+        # 最终得到的风格因子名
+        self.style_factor_names = []
+
+    # 截面部分用依赖图计算时，同时计算的进程数
+    def get_n_workers(self):
+        return max(mp.cpu_count() if self.n_jobs == 'default' else self.n_jobs, 1)
+
+    # 根据内存预算确定一块的大小，n_rows为块中每个矩阵的另一维度的长度
+    def get_block_size(self, n_rows, arrays_per_block):
+        block_size = int(self.memory_budget_mb * 1024 ** 2 / (n_rows * arrays_per_block * 8))
+        return max(block_size, 1)
+
+    # 将原始数据导入数据仓库，所有数据按照市值数据的索引对齐，与barra base中读取数据时的对齐方式一致
+    def import_original_data(self):
+        self.store.import_csv('FreeMarketValue', item_name='stock_price.FreeMarketValue')
+        like = 'stock_price.FreeMarketValue'
+        for item in chunked_barra_base.stock_price_items[1:]:
+            self.store.import_csv(item, item_name='stock_price.'+item, like=like)
+        for item in chunked_barra_base.raw_data_items:
+            self.store.import_csv(item, item_name='raw_data.'+item, like=like)
+        # 没有上市，退市，停牌数据的股票为不可交易
+        for item in chunked_barra_base.if_tradable_items:
+            self.store.import_csv(item, item_name='if_tradable.'+item, like=like, fill_value=0)
+        if self.stock_pool != 'all':
+            self.store.import_csv('Weight_'+self.stock_pool, item_name='benchmark_price.Weight_'+self.stock_pool,
+                                  like=like)
+        # 行业数据在所有日期上一次编码，与barra base中生成行业虚拟变量时一致，储存编码，没有行业数据的编码为-1
+        industry = pd.read_csv(str(os.path.abspath('.'))+'/Industry.csv', index_col=0, parse_dates=True,
+                               encoding='GB18030')
+        codes, industry_names = strategy_data.encode_labels(industry)
+        index, columns = self.store.get_axes(like)
+        codes = pd.DataFrame(codes, index=industry.index, columns=industry.columns).reindex(
+            index=index, columns=columns, fill_value=-1)
+        self.store.write('industry_codes', codes, dtype=np.int32)
+        pd.to_pickle(industry_names, os.path.join(self.store.store_dir, 'industry_names.pkl'))
+
+    # 无风险利率，与barra base中一致，没有数据时为0
+    def get_risk_free(self, index):
+        if os.path.isfile('const_data.csv'):
+            const_data = pd.read_csv('const_data.csv', index_col=0, parse_dates=True, encoding='GB18030')
+            if 'risk_free' in const_data.columns:
+                return const_data['risk_free']
+        return pd.Series(0, index=index)
+
+    # 从仓库中读取一块数据，建立这一块上的barra base对象，可交易与可投资的标记与barra base中的生成方式一致
+    def get_block_bb(self, *, rows=slice(None), columns=slice(None), items=[]):
+        block_bb = barra_base(stock_pool=self.stock_pool, n_jobs=self.n_jobs)
+        # 每一块的数据不同，不使用因子缓存
+        block_bb.factor_cache = 'Empty'
+        block_data = {}
+        for data_name in items + ['if_tradable.'+item for item in chunked_barra_base.if_tradable_items]:
+            panel_name, item = data_name.split('.', 1)
+            block_data.setdefault(panel_name, {})[item] = self.store.read(data_name, rows=rows, columns=columns)
+        for panel_name, panel_data in block_data.items():
+            setattr(block_bb.bb_data, panel_name, pd.Panel(panel_data))
+        if_tradable = block_bb.bb_data.if_tradable
+        if_tradable['if_tradable'] = (if_tradable.ix['is_enlisted'] * np.logical_not(if_tradable.ix['is_delisted']) *
+            np.logical_not(if_tradable.ix['is_suspended'].fillna(0))).astype(np.bool)
+        if self.stock_pool != 'all':
+            block_bb.bb_data.benchmark_price = pd.Panel({'Weight_'+self.stock_pool: self.store.read(
+                'benchmark_price.Weight_'+self.stock_pool, rows=rows, columns=columns)})
+        block_bb.bb_data.handle_stock_pool()
+        return block_bb
+
+    # 第一步，按股票分块计算日超额收益，同时累加每一期所有股票的市值加权收益
+    def get_daily_excess_return(self):
+        index, columns = self.store.get_axes('stock_price.FreeMarketValue')
+        risk_free = self.get_risk_free(index)
+        self.store.create('stock_price.daily_excess_return', index, columns)
+        weighted_return_sum = np.zeros(len(index))
+        lag_mv_sum = np.zeros(len(index))
+        n_weighted_return = np.zeros(len(index))
+        n_lag_mv = np.zeros(len(index))
+        block_size = self.get_block_size(len(index), chunked_barra_base.ts_arrays_per_block)
+        for start in range(0, len(columns), block_size):
+            curr_columns = slice(start, start + block_size)
+            block_bb = self.get_block_bb(columns=curr_columns, items=['stock_price.FreeMarketValue',
+                                                                      'stock_price.ClosePrice_adj'])
+            stock_price = block_bb.bb_data.stock_price
+            daily_return = np.log(stock_price.ix['ClosePrice_adj'].div(stock_price.ix['ClosePrice_adj'].shift(1)))
+            daily_excess_return = daily_return.sub(risk_free, axis=0)
+            # 与barra base中一样，计算完收益后，过滤掉不可交易的数据
+            if_tradable = block_bb.bb_data.if_tradable.ix['if_tradable']
+            daily_excess_return = daily_excess_return.where(if_tradable, np.nan)
+            lag_mv = stock_price.ix['FreeMarketValue'].where(if_tradable, np.nan).shift(1)
+            weighted_return = daily_excess_return.mul(lag_mv)
+            weighted_return_sum += weighted_return.fillna(0).values.sum(1)
+            n_weighted_return += weighted_return.notnull().values.sum(1)
+            lag_mv_sum += lag_mv.fillna(0).values.sum(1)
+            n_lag_mv += lag_mv.notnull().values.sum(1)
+            self.store.write_block('stock_price.daily_excess_return', daily_excess_return.values, columns=curr_columns)
+        # 没有任何有效数据的一期，市值加权收益为nan，与在所有股票上一次计算时一致
+        with np.errstate(divide='ignore', invalid='ignore'):
+            universe_return = np.where(np.logical_and(n_weighted_return > 0, n_lag_mv > 0),
+                                       weighted_return_sum / lag_mv_sum, np.nan)
+        self.cap_wgt_universe_return = pd.Series(universe_return, index=index)
+
+    # 第二步，按股票分块计算时间序列部分，计算顺序以及过滤数据的时机与依赖图中的计算一致
+    def get_time_series_components(self):
+        index, columns = self.store.get_axes('stock_price.FreeMarketValue')
+        for data_name in chunked_barra_base.ts_outputs:
+            self.store.create(data_name, index, columns)
+        block_size = self.get_block_size(len(index), chunked_barra_base.ts_arrays_per_block)
+        for start in range(0, len(columns), block_size):
+            curr_columns = slice(start, start + block_size)
+            block_bb = self.get_block_bb(columns=curr_columns, items=['stock_price.FreeMarketValue',
+                'stock_price.daily_excess_return', 'stock_price.Volume', 'stock_price.FreeShares'])
+            block_bb.bb_data.discard_untradable_data()
+            block_bb.cap_wgt_universe_return = self.cap_wgt_universe_return
+            block_bb.get_lncap()
+            block_bb.get_beta()
+            block_bb.get_momentum()
+            block_bb.get_rv_dastd()
+            block_bb.get_rv_cmra()
+            block_bb.get_rv_hsigma()
+            # liquidity的成分因子在过滤了uninv的数据上计算，stom在计算中只过滤自己用到的数据
+            block_bb.get_liq_stom()
+            block_bb.get_liq_stoq()
+            block_bb.get_liq_stoa()
+            for data_name in chunked_barra_base.ts_outputs:
+                self.store.write_block(data_name, block_bb.get_named_data(data_name).values, columns=curr_columns)
+            print('time series components of stocks {0} to {1} completed...\n'.format(
+                start, min(start + block_size, len(columns)) - 1))
+
+    # 第三步，按日期分块计算截面部分，得到风格因子及其暴露
+    # 每一块上的计算与增量更新时截取日期后的计算一致，即时间序列部分已经算好，只计算其余部分
+    def get_cross_section_factors(self):
+        index, columns = self.store.get_axes('stock_price.FreeMarketValue')
+        block_size = self.get_block_size(len(columns), chunked_barra_base.cs_shared_arrays +
+                                         chunked_barra_base.cs_arrays_per_worker * self.get_n_workers())
+        items = ['stock_price.FreeMarketValue', 'stock_price.daily_excess_return', 'stock_price.Volume',
+                 'stock_price.FreeShares'] + ['raw_data.'+item for item in chunked_barra_base.raw_data_items] + \
+                chunked_barra_base.ts_outputs
+        for start in range(0, len(index), block_size):
+            curr_rows = slice(start, start + block_size)
+            block_bb = self.get_block_bb(rows=curr_rows, items=items)
+            block_bb.is_update = True
+            block_bb.bb_data.discard_untradable_data()
+            block_bb.get_style_factors()
+            block_bb.bb_data.discard_uninv_data()
+            block_bb.get_style_factor_exposure()
+            # 第一块算完后才知道因子名，此时建立储存结果的数据
+            if start == 0:
+                self.style_factor_names = list(block_bb.bb_data.factor.items)
+                for item in self.style_factor_names:
+                    self.store.create('factor.'+item, index, columns)
+                    self.store.create('factor_expo.'+item, index, columns)
+            for item in self.style_factor_names:
+                self.store.write_block('factor.'+item, block_bb.bb_data.factor.ix[item].values, rows=curr_rows)
+                self.store.write_block('factor_expo.'+item, block_bb.bb_data.factor_expo.ix[item].values,
+                                       rows=curr_rows)
+            print('cross section factors of dates {0} to {1} completed...\n'.format(
+                index[start].strftime('%Y-%m-%d'), index[min(start + block_size, len(index)) - 1].strftime('%Y-%m-%d')))
+
+    # 分块构建barra base的所有风格因子及其暴露，结果储存在数据仓库中
+    def construct_barra_base(self, *, if_import=True):
+        if if_import:
+            self.import_original_data()
+        self.get_daily_excess_return()
+        print('get daily excess return completed...\n')
+        self.get_time_series_components()
+        print('get time series components completed...\n')
+        self.get_cross_section_factors()
+        print('get cross section factors completed...\n')
+
+    # 读取一段日期的全部因子暴露，包括风格因子，行业因子和国家因子，与barra base中的factor_expo一致
+    def read_factor_expo(self, *, rows=slice(None)):
+        """ Read factor exposures of a block of dates from the store.
+
+        :param rows: (slice) positions of dates to read
+        :return: (pd.Panel) style, industry and country factor exposures, same as bb_data.factor_expo of barra_base
+        """
+        block_bb = self.get_block_bb(rows=rows, items=['factor_expo.'+item for item in self.style_factor_names])
+        factor_expo = block_bb.bb_data.factor_expo.reindex(items=self.style_factor_names)
+        industry_names = pd.read_pickle(os.path.join(self.store.store_dir, 'industry_names.pkl'))
+        codes = self.store.read('industry_codes', rows=rows).values
+        industry_dummies = pd.Panel(strategy_data.get_dummies_from_codes(codes, industry_names.size),
+                                    items=['Industry_'+str(name) for name in industry_names],
+                                    major_axis=factor_expo.major_axis, minor_axis=factor_expo.minor_axis)
+        constant = pd.Panel({'country_factor': pd.DataFrame(1.0, index=factor_expo.major_axis,
+                                                            columns=factor_expo.minor_axis)})
+        block_bb.bb_data.factor_expo = pd.concat([factor_expo, industry_dummies, constant])
+        block_bb.bb_data.discard_uninv_data()
+        return block_bb.bb_data.factor_expo
+
+    # 将风格因子值写入csv文件，与barra base储存的因子文件格式一致
+    def write_factor_data(self):
+        for item in self.style_factor_names:
+            self.store.export_csv('factor.'+item, file_name=item)
+
+if __name__ == '__main__':
+    import time
+    start_time = time.time()
+    cbb = chunked_barra_base(memory_budget_mb=4096)
+    cbb.construct_barra_base()
+    cbb.write_factor_data()
+    print("time: {0} seconds\n".format(time.time()-start_time))
@@ -81,7 +81,46 @@ class data(object):
             for cursor, item_name in enumerate(written_data.items):
                 written_data.ix[cursor].to_csv(file_name[cursor]+'.csv', index_label='datetime', na_rep='NaN',
                                                encoding='GB18030')
-        
+
+    # 向已有的数据文件中追加数据的函数，只在文件末尾写入新的日期，不重写旧数据
+    # 如果文件不存在，或新数据中有文件中没有的股票，或新数据中有不晚于文件最后一天的日期，则将新旧数据合并后重写
+    @staticmethod
+    def append_data(written_data, *, file_name='default'):
+        """ Append the data to existing csv file, only rows of new dates are written.
+
+        :param written_data: (pd.Panel) data to be appended to csv file, dates as major axis
+        :param file_name: (list) list of strings containing names of csv files, see write_data
+        """
+        for cursor, item_name in enumerate(written_data.items):
+            if file_name == 'default':
+                curr_file = str(item_name)+'.csv'
+            else:
+                curr_file = file_name[cursor]+'.csv'
+            new_data = written_data.ix[cursor]
+            # 没有文件，则直接写入
+            if not os.path.isfile(curr_file):
+                new_data.to_csv(curr_file, index_label='datetime', na_rep='NaN', encoding='GB18030')
+                continue
+            # 只读取文件的表头和时间索引，判断能否直接追加
+            old_columns = pd.read_csv(curr_file, index_col=0, nrows=0, encoding='GB18030').columns
+            old_index = pd.read_csv(curr_file, index_col=0, usecols=[0], parse_dates=True,
+                                    encoding='GB18030').index
+            new_columns = new_data.columns.astype(str)
+            if new_columns.isin(old_columns).all() and (old_index.empty or new_data.index.min() > old_index.max()):
+                # 新数据的列按照文件中的列排列，文件中有而新数据中没有的股票为nan
+                new_data = new_data.copy()
+                new_data.columns = new_columns
+                new_data = new_data.reindex(columns=old_columns)
+                new_data.to_csv(curr_file, mode='a', header=False, na_rep='NaN', encoding='GB18030')
+            else:
+                old_data = pd.read_csv(curr_file, index_col=0, parse_dates=True, encoding='GB18030')
+                new_data = new_data.copy()
+                new_data.columns = new_columns
+                # 新旧数据重合的日期，以新数据为准
+                old_data = old_data.drop(old_data.index.intersection(new_data.index), axis=0)
+                combined_data = pd.concat([old_data, new_data], axis=0).sort_index()
+                combined_data.to_csv(curr_file, index_label='datetime', na_rep='NaN', encoding='GB18030')
+
     # 重新对齐索引的函数
     @staticmethod
     def align_index(standard, raw_data, *, axis = 'both'):
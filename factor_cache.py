@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+import json
+import hashlib
+import argparse
+from datetime import datetime
+
+# 按内容寻址的因子缓存，每个计算出的因子以其输入数据的版本（数据内容的哈希值），参数（如半衰期，窗口长度）以及股票池的哈希值为键
+# 输入数据或参数改变时键随之改变，旧的缓存自然失效，不再需要手动删除文件
+# 每个缓存条目为两个文件：<键>.pkl储存因子数据，<键>.json储存条目的信息（因子名，股票池，参数，输入数据版本，创建时间）
+# 条目之间没有共用的索引文件，因此多个进程（如依赖图中的子进程）可以同时写入缓存
+# 在命令行中可以列出，查看和清理缓存：python factor_cache.py list / inspect <键> / prune --keep-latest 1
+
+class factor_cache(object):
+    """ This is the class of content-addressed cache of computed factors.
+
+    cache_dir (str): directory of cache files
+    """
+    def __init__(self, *, cache_dir='factor_cache'):
+        self.cache_dir = cache_dir
+
+    # 数据的版本，即索引，列名与数据内容的md5哈希值
+    @staticmethod
+    def get_data_version(input_data):
+        data_hash = hashlib.md5()
+        if isinstance(input_data, (pd.DataFrame, pd.Series)):
+            data_hash.update(','.join(str(item) for item in input_data.index).encode('utf-8'))
+            if isinstance(input_data, pd.DataFrame):
+                data_hash.update(','.join(str(item) for item in input_data.columns).encode('utf-8'))
+            values = input_data.values
+        else:
+            values = np.asarray(input_data)
+        data_hash.update(str(values.dtype).encode('utf-8'))
+        if values.dtype == object:
+            data_hash.update(','.join(str(item) for item in values.ravel()).encode('utf-8'))
+        else:
+            data_hash.update(np.ascontiguousarray(values).tobytes())
+        return data_hash.hexdigest()
+
+    # 根据因子名，输入数据，参数以及股票池生成缓存条目的信息，键为这些信息的哈希值
+    @staticmethod
+    def get_entry(name, *, inputs, params={}, stock_pool='all'):
+        """ Get cache entry information of a factor.
+
+        :param name: (str) name of the factor
+        :param inputs: (dict) input data of the factor, names as keys, pd.DataFrame or np.ndarray as values
+        :param params: (dict) parameters of the factor calculation, values are converted to string
+        :param stock_pool: (str) stock pool of the factor
+        :return: (dict) entry information, the key of the entry is entry['key']
+        """
+        input_versions = {input_name: factor_cache.get_data_version(input_data)
+                          for input_name, input_data in inputs.items()}
+        str_params = {param_name: str(param_value) for param_name, param_value in params.items()}
+        entry = {'name': name, 'stock_pool': stock_pool, 'params': str_params, 'inputs': input_versions}
+        entry['key'] = hashlib.md5(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()
+        return entry
+
+    def get_data_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    # 缓存中是否有这个条目
+    def has(self, entry):
+        return os.path.isfile(self.get_data_path(entry['key'])) and os.path.isfile(self.get_entry_path(entry['key']))
+
+    def load(self, entry):
+        return pd.read_pickle(self.get_data_path(entry['key']))
+
+    # 储存条目，先写入临时文件再改名，避免读到写了一半的文件
+    def save(self, entry, cached_data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key = entry['key']
+        pd.to_pickle(cached_data, self.get_data_path(key) + '.tmp')
+        os.replace(self.get_data_path(key) + '.tmp', self.get_data_path(key))
+        entry = dict(entry, created=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        with open(self.get_entry_path(key) + '.tmp', 'w', encoding='utf-8') as entry_file:
+            json.dump(entry, entry_file, sort_keys=True)
+        os.replace(self.get_entry_path(key) + '.tmp', self.get_entry_path(key))
+
+    # 列出缓存中所有条目，按因子名，股票池和创建时间排序
+    def list_entries(self):
+        columns = ['name', 'stock_pool', 'created', 'size_mb', 'params']
+        if not os.path.isdir(self.cache_dir):
+            return pd.DataFrame(columns=columns)
+        entries = {}
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.json'):
+                continue
+            key = file_name[:-5]
+            with open(self.get_entry_path(key), encoding='utf-8') as entry_file:
+                entry = json.load(entry_file)
+            data_path = self.get_data_path(key)
+            size_mb = os.path.getsize(data_path) / 1024 ** 2 if os.path.isfile(data_path) else np.nan
+            entries[key] = [entry['name'], entry['stock_pool'], entry['created'], size_mb,
+                            json.dumps(entry['params'], sort_keys=True)]
+        entry_table = pd.DataFrame.from_dict(entries, orient='index')
+        if entry_table.empty:
+            return pd.DataFrame(columns=columns)
+        entry_table.columns = columns
+        entry_table.index.name = 'key'
+        return entry_table.sort_values(['name', 'stock_pool', 'created'])
+
+    # 查看一个条目，key可以只是键的开头部分
+    def inspect(self, key):
+        matched = [file_name[:-5] for file_name in os.listdir(self.cache_dir)
+                   if file_name.endswith('.json') and file_name.startswith(key)]
+        assert len(matched) == 1, 'Key {0} matches {1} entries in the cache!'.format(key, len(matched))
+        with open(self.get_entry_path(matched[0]), encoding='utf-8') as entry_file:
+            entry = json.load(entry_file)
+        cached_data = self.load(entry)
+        if isinstance(cached_data, (list, tuple)):
+            entry['data'] = [type(item).__name__ + str(getattr(item, 'shape', '')) for item in cached_data]
+        else:
+            entry['data'] = type(cached_data).__name__ + str(getattr(cached_data, 'shape', ''))
+        return entry
+
+    # 清理缓存，name为只清理某个因子，older_than为清理创建时间早于这个天数的条目，
+    # keep_latest为同一因子同一股票池同一参数只保留最新的若干个条目（输入数据改变后的旧条目即被清理）
+    def prune(self, *, name='default', older_than='default', keep_latest='default', by_params=True):
+        """ Prune entries in the cache.
+
+        :param name: (str) only prune entries of this factor, 'default' means all factors
+        :param older_than: (float) prune entries created more than older_than days ago
+        :param keep_latest: (int) keep only the latest keep_latest entries of the same factor, stock pool and params
+        :param by_params: (bool) if False, keep_latest counts entries of the same factor and stock pool regardless
+            of params
+        :return: (list) keys of pruned entries
+        """
+        entry_table = self.list_entries()
+        if name != 'default':
+            entry_table = entry_table[entry_table['name'] == name]
+        to_prune = pd.Series(False, index=entry_table.index)
+        if older_than != 'default':
+            created = pd.to_datetime(entry_table['created'])
+            to_prune = to_prune | (created < pd.Timestamp(datetime.now()) - pd.Timedelta(days=float(older_than)))
+        if keep_latest != 'default':
+            # 组内按创建时间从新到旧的排名，超过keep_latest的清理
+            group_keys = ['name', 'stock_pool', 'params'] if by_params else ['name', 'stock_pool']
+            rank = entry_table.groupby(group_keys)['created'].rank(method='first', ascending=False)
+            to_prune = to_prune | (rank > int(keep_latest))
+        pruned_keys = list(to_prune.index[to_prune])
+        for key in pruned_keys:
+            for path in [self.get_data_path(key), self.get_entry_path(key)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+        return pruned_keys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List, inspect and prune the factor cache.')
+    parser.add_argument('--cache-dir', default='factor_cache', help='directory of cache files')
+    subparsers = parser.add_subparsers(dest='command')
+    list_parser = subparsers.add_parser('list', help='list all cached factors')
+    list_parser.add_argument('--name', default='default', help='only list entries of this factor')
+    inspect_parser = subparsers.add_parser('inspect', help='show information of a cached factor')
+    inspect_parser.add_argument('key', help='key (or beginning of key) of the entry')
+    prune_parser = subparsers.add_parser('prune', help='remove cached factors')
+    prune_parser.add_argument('--name', default='default', help='only prune entries of this factor')
+    prune_parser.add_argument('--older-than', default='default', help='prune entries older than these days')
+    prune_parser.add_argument('--keep-latest', default='default',
+                              help='keep only the latest entries of the same factor, stock pool and params')
+    args = parser.parse_args()
+
+    cache = factor_cache(cache_dir=args.cache_dir)
+    if args.command == 'list':
+        entry_table = cache.list_entries()
+        if args.name != 'default':
+            entry_table = entry_table[entry_table['name'] == args.name]
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(entry_table)
+        print('{0} entries, {1:.1f} MB in total.'.format(entry_table.shape[0], entry_table['size_mb'].sum()))
+    elif args.command == 'inspect':
+        print(json.dumps(cache.inspect(args.key), indent=2, sort_keys=True))
+    elif args.command == 'prune':
+        if args.older_than == 'default' and args.keep_latest == 'default':
+            parser.error('prune needs --older-than or --keep-latest')
+        pruned_keys = cache.prune(name=args.name, older_than=args.older_than, keep_latest=args.keep_latest)
+        print('{0} entries pruned.'.format(len(pruned_keys)))
+    else:
+        parser.print_help()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+import time
+from collections import OrderedDict
+
+# 因子计算的依赖图，每个因子（或一组因子）为一个节点，声明其输入与输出，一个节点的输入为其他节点的输出时，即依赖于那些节点
+# 按照依赖关系将节点分层，同一层的节点之间相互独立，用进程池同时计算
+# 进程池用fork的方式创建，子进程直接继承父进程中已有的数据（写时复制），不需要把输入数据传给子进程，只有节点的输出需要传回
+# 每一层计算完后，将输出合并回父进程，再为下一层创建新的进程池，使得下一层的节点能看到之前各层的输出
+# 不支持fork的系统上，以及只用一个进程时，所有节点在当前进程中按层依次计算，结果与多进程计算时一致
+
+# 正在运行的依赖图，fork出的子进程通过它找到节点的计算函数，因为函数（如对象的方法）不一定能被pickle
+_running_graph = None
+
+# 在子进程中计算一个节点，返回节点的输出和计算时间
+def _run_node_in_child(name):
+    start_time = time.time()
+    outputs = _running_graph.nodes[name]['func']()
+    return [name, outputs, time.time() - start_time]
+
+class factor_graph(object):
+    """ This is the class of dependency graph of factor calculations.
+
+    merge_func (function): function called in parent process to merge outputs of a node, takes dict of outputs
+    n_jobs (int): number of processes in process pool, 'default' means number of cpus
+    nodes (OrderedDict): nodes of the graph, each node has func, inputs, outputs and load_cache
+    run_record (pd.DataFrame): level, status and running time of each node in last run
+    """
+    def __init__(self, merge_func, *, n_jobs='default'):
+        self.merge_func = merge_func
+        self.n_jobs = n_jobs
+        self.nodes = OrderedDict()
+        self.run_record = pd.DataFrame(columns=['level', 'status', 'run_time'])
+
+    # 添加一个节点
+    def add_node(self, name, func, *, inputs=[], outputs=[], load_cache='default'):
+        """ Add a node into the graph.
+
+        :param name: (str) name of the node
+        :param func: (function) function with no argument which does the calculation and returns dict of outputs
+        :param inputs: (list) names of inputs, inputs that are not outputs of any node are taken as raw data
+        :param outputs: (list) names of outputs
+        :param load_cache: (function) function with no argument called in parent process before calculation,
+            returns True if the cached outputs are valid and have been loaded, then the node is skipped,
+            'default' means no cache
+        """
+        assert name not in self.nodes, 'Node {0} has already been in the graph!'.format(name)
+        self.nodes[name] = {'func': func, 'inputs': list(inputs), 'outputs': list(outputs),
+                            'load_cache': load_cache}
+
+    # 每个节点依赖的节点
+    def get_dependencies(self):
+        output_owner = {}
+        for name, node in self.nodes.items():
+            for output in node['outputs']:
+                assert output not in output_owner, 'Output {0} has more than one node!'.format(output)
+                output_owner[output] = name
+        return {name: set(output_owner[item] for item in node['inputs'] if item in output_owner) - {name}
+                for name, node in self.nodes.items()}
+
+    # 将节点按照依赖关系分层，每一层的节点只依赖于之前各层的节点，层内节点的顺序与添加的顺序一致
+    def get_levels(self):
+        dependencies = self.get_dependencies()
+        levels = []
+        done = set()
+        while len(done) < len(self.nodes):
+            curr_level = [name for name in self.nodes if name not in done and dependencies[name] <= done]
+            assert len(curr_level) > 0, 'There is a cycle in the graph among nodes: {0}'.\
+                format(', '.join(name for name in self.nodes if name not in done))
+            levels.append(curr_level)
+            done.update(curr_level)
+        return levels
+
+    # 按层计算所有节点
+    def run(self):
+        global _running_graph
+        start_time = time.time()
+        self.run_record = pd.DataFrame(columns=['level', 'status', 'run_time'])
+        for level, level_nodes in enumerate(self.get_levels()):
+            # 缓存有效的节点直接跳过
+            to_run = []
+            for name in level_nodes:
+                node_start_time = time.time()
+                load_cache = self.nodes[name]['load_cache']
+                if type(load_cache) != str and load_cache():
+                    self.run_record.ix[name] = [level, 'cached', time.time() - node_start_time]
+                else:
+                    to_run.append(name)
+            if len(to_run) == 0:
+                continue
+
+            n_jobs = mp.cpu_count() if self.n_jobs == 'default' else self.n_jobs
+            n_jobs = max(min(n_jobs, len(to_run)), 1)
+            # 先设置正在运行的图再创建进程池，子进程才能继承
+            _running_graph = self
+            try:
+                # 只用一个进程，或者系统不支持fork（如windows）时，在当前进程中依次计算，不创建进程池
+                if n_jobs == 1 or 'fork' not in mp.get_all_start_methods():
+                    results = [_run_node_in_child(name) for name in to_run]
+                else:
+                    with mp.get_context('fork').Pool(n_jobs) as pool:
+                        results = pool.map(_run_node_in_child, to_run, chunksize=1)
+            finally:
+                _running_graph = None
+            # 按照节点添加的顺序合并输出
+            for name, outputs, run_time in results:
+                self.merge_func(outputs)
+                self.run_record.ix[name] = [level, 'computed', run_time]
+
+        print('Factor graph completed in {0:.2f} seconds, {1} nodes computed, {2} nodes cached.\n'.format(
+            time.time() - start_time, int(np.sum(self.run_record['status'] == 'computed')),
+            int(np.sum(self.run_record['status'] == 'cached'))))
+        print(self.run_record)
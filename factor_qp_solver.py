@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import time
+
+# 结构化协方差矩阵下的二次规划求解器，用于纯因子组合等优化问题
+# 优化问题为：min 1/2 * h' (X F X' + D) h - q' h, s.t. A h = b, h >= lb
+# 做多的限制直接作为变量的下界，不需要构建限制条件矩阵，用原始对偶内点法（mehrotra预测校正）求解
+# 每次迭代的牛顿方程中，矩阵为X F X' + D + diag(s/w)，即对角阵加低秩矩阵，用woodbury恒等式和舒尔补求解，
+# 每次迭代的计算量为O(N*(K+M)^2)，不需要任何N*N的矩阵
+# 连续求解多个日期时，用上一期的解作为初始值（warm start），由于相邻两期的股票和解都很相近，能减少迭代次数
+
+class factor_qp_solver(object):
+    """ This is the class of interior point solver of quadratic programming with factor structured covariance matrix.
+
+    tol (float): tolerance of primal residual, dual residual and complementarity gap, relative to problem scale
+    max_iter (int): maximum number of iterations
+    warm_start (bool): whether to use the solution of last solving as initial point
+    solve_record (pd.DataFrame): solving time, number of iterations and status of each solving
+    """
+    def __init__(self, *, tol=1e-8, max_iter=100, warm_start=True):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.warm_start = warm_start
+        # 上一次求解的结果，用作下一次求解的初始值
+        self.prev_h = pd.Series()
+        self.prev_s = pd.Series()
+        self.solve_record = pd.DataFrame(columns=['solve_time', 'iterations', 'status'])
+
+    # 预先计算解方程组[X F X' + diag(d), A'; A, 0][h; nu] = [r; p]需要的矩阵
+    # 用woodbury恒等式计算M = X F X' + diag(d)的逆乘以向量，再用舒尔补A M^(-1) A'解出nu
+    @staticmethod
+    def factorize(x, factor_cov, diag, a):
+        inv_d = 1 / diag
+        inv_d_x = inv_d[:, np.newaxis] * x
+        # woodbury中的k*k矩阵，这种写法不需要F可逆
+        inner = np.eye(x.shape[1]) + np.dot(np.dot(x.T, inv_d_x), factor_cov)
+        # M^(-1) z = D^(-1) z - D^(-1) X F inner^(-1) X' D^(-1) z，这里把D^(-1) X F inner^(-1)预先算好
+        correction = np.dot(inv_d_x, np.dot(factor_cov, np.linalg.pinv(inner)))
+        factors = {'inv_d': inv_d, 'x': x, 'correction': correction}
+        factors['inv_m_at'] = factor_qp_solver.inv_m_dot(factors, a.T)
+        # 舒尔补，限制条件可能冗余（如某些行业暴露完全共线），因此用伪逆
+        factors['schur_inv'] = np.linalg.pinv(np.dot(a, factors['inv_m_at']))
+        return factors
+
+    @staticmethod
+    def inv_m_dot(factors, z):
+        inv_d_z = factors['inv_d'].reshape((-1,) + (1,) * (z.ndim - 1)) * z
+        return inv_d_z - np.dot(factors['correction'], np.dot(factors['x'].T, inv_d_z))
+
+    @staticmethod
+    def kkt_solve(factors, a, r, p):
+        inv_m_r = factor_qp_solver.inv_m_dot(factors, r)
+        nu = np.dot(factors['schur_inv'], np.dot(a, inv_m_r) - p)
+        return [inv_m_r - np.dot(factors['inv_m_at'], nu), nu]
+
+    # 保持w和s为正的最大步长
+    @staticmethod
+    def max_step(v, dv):
+        is_neg = dv < 0
+        if not is_neg.any():
+            return 1.0
+        return min(1.0, np.min(-v[is_neg] / dv[is_neg]))
+
+    # 求解一个优化问题，所有参数均为pd.Series或pd.DataFrame，以股票代码为索引，以便用上一期的结果作为初始值
+    def solve(self, *, q, spec_var, a, b, x='Empty', factor_cov='Empty', lb=0.0, record_name='default'):
+        """ Solve the quadratic programming problem.
+
+        :param q: (pd.Series) linear term of objective function, stocks as index
+        :param spec_var: (pd.Series) diagonal part of covariance matrix, stocks as index, has to be positive
+        :param a: (pd.DataFrame) equality constraint matrix, stocks as index, constraints as columns
+        :param b: (pd.Series) target of equality constraints, constraints as index
+        :param x: (pd.DataFrame) factor exposures of covariance matrix, stocks as index, 'Empty' means no factor part
+        :param factor_cov: (pd.DataFrame) factor covariance matrix of covariance matrix
+        :param lb: (float) lower bound of variables, 0 means long only, -np.inf means no lower bound
+        :param record_name: name of this solving in solve_record, usually the date
+        :return: (pd.Series) solution, stocks as index
+        """
+        start_time = time.time()
+        stocks = q.index
+        q_np = q.values
+        d_np = spec_var.reindex(stocks).values
+        a_np = a.reindex(stocks).values.T
+        b_np = b.values
+        if type(x) != str:
+            x_np = x.reindex(stocks).values
+            f_np = factor_cov.values
+        else:
+            x_np = np.zeros((stocks.size, 0))
+            f_np = np.zeros((0, 0))
+
+        # 先求只有等式约束时的解，没有下界时即为最优解
+        factors = factor_qp_solver.factorize(x_np, f_np, d_np, a_np)
+        h, nu = factor_qp_solver.kkt_solve(factors, a_np, q_np, b_np)
+        if not np.isfinite(lb):
+            self.record(record_name, time.time() - start_time, 1, 'optimal')
+            self.prev_h = pd.Series(h, index=stocks)
+            return pd.Series(h, index=stocks)
+
+        # 初始值，有上一期的解时用上一期的解，否则用只有等式约束的解，然后平移到可行域内部
+        if self.warm_start and not self.prev_h.empty:
+            w = self.prev_h.reindex(stocks).fillna(lb).values - lb
+            s = self.prev_s.reindex(stocks).fillna(0.0).values
+        else:
+            w = h - lb
+            s = np.zeros(stocks.size)
+        w_shift = max(np.mean(np.abs(w)), 1e-8)
+        s_shift = max(np.mean(np.abs(q_np)), 1e-8)
+        w = np.maximum(w, 0.0) + 0.1 * w_shift
+        s = np.maximum(s, 0.0) + 0.1 * s_shift
+        nu = np.zeros(b_np.size)
+
+        status = 'max_iter'
+        scale_p = 1 + np.max(np.abs(b_np)) if b_np.size > 0 else 1.0
+        scale_d = 1 + np.max(np.abs(q_np))
+        for iteration in range(1, self.max_iter+1):
+            h = w + lb
+            v_h = d_np * h + np.dot(x_np, np.dot(f_np, np.dot(x_np.T, h)))
+            # 对偶残差，原始残差，互补间隙
+            r_d = v_h - q_np + np.dot(a_np.T, nu) - s
+            r_p = np.dot(a_np, h) - b_np
+            mu = np.dot(w, s) / stocks.size
+            if np.max(np.abs(r_d)) <= self.tol * scale_d and \
+                    (r_p.size == 0 or np.max(np.abs(r_p)) <= self.tol * scale_p) and \
+                    mu <= self.tol * (1 + abs(np.dot(q_np, h))) / stocks.size:
+                status = 'optimal'
+                break
+
+            # 牛顿方程中的矩阵为X F X' + D + diag(s/w)，预测步和校正步共用
+            factors = factor_qp_solver.factorize(x_np, f_np, d_np + s / w, a_np)
+            # 预测步
+            dh_aff, dnu_aff = factor_qp_solver.kkt_solve(factors, a_np, -r_d - s, -r_p)
+            ds_aff = - s - s / w * dh_aff
+            alpha_aff = min(factor_qp_solver.max_step(w, dh_aff), factor_qp_solver.max_step(s, ds_aff))
+            mu_aff = np.dot(w + alpha_aff * dh_aff, s + alpha_aff * ds_aff) / stocks.size
+            sigma = (mu_aff / mu) ** 3
+            # 校正步
+            r_c = w * s + dh_aff * ds_aff - sigma * mu
+            dh, dnu = factor_qp_solver.kkt_solve(factors, a_np, -r_d - r_c / w, -r_p)
+            ds = (- r_c - s * dh) / w
+            alpha = 0.99 * min(factor_qp_solver.max_step(w, dh), factor_qp_solver.max_step(s, ds))
+            alpha = min(alpha, 1.0)
+            w = w + alpha * dh
+            nu = nu + alpha * dnu
+            s = s + alpha * ds
+
+        h = w + lb
+        self.record(record_name, time.time() - start_time, iteration, status)
+        # 储存本次结果，用于下一次求解的初始值
+        self.prev_h = pd.Series(h, index=stocks)
+        self.prev_s = pd.Series(s, index=stocks)
+        return pd.Series(h, index=stocks)
+
+    def record(self, record_name, solve_time, iterations, status):
+        if record_name == 'default':
+            record_name = self.solve_record.shape[0]
+        self.solve_record.ix[record_name] = [solve_time, iterations, status]
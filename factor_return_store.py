@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+import hashlib
+
+from data import data
+
+# barra base因子收益库，按股票池储存回归得到的因子收益与残差，并记录每一天的因子收益是由哪个版本的数据回归得到的
+# 更新时只对库中没有的日期，以及数据版本已经改变（如因子暴露被重新计算过）的日期进行回归
+
+class factor_return_store(object):
+    """ This is the class of versioned storage of barra base factor returns.
+
+    stock_pool (str): stock pool of the barra base whose factor returns are stored
+    factor_return (pd.DataFrame): stored factor returns, dates as index, factors as columns
+    residual_return (pd.DataFrame): stored residuals of the regressions, dates as index, stocks as columns
+    data_version (pd.Series): version of the data that each date of factor returns was computed from
+    """
+    def __init__(self, *, stock_pool='all'):
+        self.stock_pool = stock_pool
+        self.factor_return = pd.DataFrame()
+        self.residual_return = pd.DataFrame()
+        self.data_version = pd.Series()
+        # 文件名，因子收益的文件名与之前储存因子收益的文件一致
+        self.factor_return_name = 'bb_factor_return_' + stock_pool
+        self.residual_return_name = 'bb_residual_return_' + stock_pool
+        self.data_version_name = 'bb_factor_return_version_' + stock_pool
+
+    # 计算每一天回归所用数据的版本，即当天实际参与回归的股票的代码、收益、上一期因子暴露和上一期市值的哈希值
+    # 只用实际参与回归的股票，是为了新上市的股票加入股票索引时，不会改变此前日期的数据版本
+    @staticmethod
+    def get_data_version(asset_return, lag_expo, lag_mv):
+        """ Get the version of data used in regression of each date.
+
+        :param asset_return: (pd.DataFrame) return of asset universe, dates as index, stocks as columns
+        :param lag_expo: (pd.Panel) lagged barra base factor exposures, which has the same major and minor axis as
+            asset_return
+        :param lag_mv: (pd.DataFrame) lagged market value, which has the same index and columns as asset_return
+        :return: (pd.Series) hash values of the data of each date
+        """
+        return_values = asset_return.values
+        # 日期*股票*因子
+        expo_values = lag_expo.values.transpose(1, 2, 0)
+        mv_values = lag_mv.values
+        # 与回归中一样，只要有na，这只股票就不参与当期的回归
+        valid = np.logical_and(np.logical_not(np.isnan(return_values)),
+                               np.logical_not(np.isnan(expo_values).any(2)))
+        valid = np.logical_and(valid, np.logical_not(np.isnan(mv_values)))
+        stock_codes = np.array([str(code) for code in asset_return.columns])
+
+        # 因子名称作为所有日期共同的部分
+        base_hash = hashlib.md5(','.join([str(item) for item in lag_expo.items]).encode('utf-8'))
+        data_version = pd.Series('', index=asset_return.index)
+        for cursor in range(asset_return.shape[0]):
+            curr_valid = valid[cursor]
+            curr_hash = base_hash.copy()
+            curr_hash.update(','.join(stock_codes[curr_valid]).encode('utf-8'))
+            curr_hash.update(np.ascontiguousarray(return_values[cursor, curr_valid]).tobytes())
+            curr_hash.update(np.ascontiguousarray(expo_values[cursor, curr_valid, :]).tobytes())
+            curr_hash.update(np.ascontiguousarray(mv_values[cursor, curr_valid]).tobytes())
+            data_version.iloc[cursor] = curr_hash.hexdigest()
+        return data_version
+
+    # 读取库中已有的因子收益，残差以及数据版本
+    def read_store(self):
+        if os.path.isfile(self.factor_return_name + '.csv'):
+            self.factor_return = data.read_data([self.factor_return_name], ['pa_returns'])['pa_returns']
+        if os.path.isfile(self.residual_return_name + '.csv'):
+            self.residual_return = data.read_data([self.residual_return_name], ['residuals'])['residuals']
+        # 没有版本文件的日期（如之前直接储存的因子收益），都认为需要重新回归
+        if os.path.isfile(self.data_version_name + '.csv'):
+            self.data_version = pd.read_csv(self.data_version_name + '.csv', index_col=0, parse_dates=True,
+                                            encoding='GB18030').ix[:, 'data_version']
+
+    # 找出需要回归的日期，即库中没有的日期，以及数据版本和库中记录不一致的日期
+    def get_stale_dates(self, data_version):
+        stored_version = self.data_version.reindex(data_version.index)
+        return data_version.index[np.logical_not(stored_version == data_version)]
+
+    # 更新因子收益库，bb为已经计算好因子暴露的barra base对象
+    # refresh_all为True时，不管数据版本，重新回归所有日期
+    def update(self, bb, *, refresh_all=False):
+        self.read_store()
+        daily_return, lag_factor_expo, lag_mv = bb.get_bb_factor_return_input()
+        curr_version = factor_return_store.get_data_version(daily_return, lag_factor_expo, lag_mv)
+        if refresh_all:
+            stale_dates = curr_version.index
+        else:
+            stale_dates = self.get_stale_dates(curr_version)
+
+        if stale_dates.size == 0:
+            print('The barra base factor returns of stock pool {0} have been up-to-date.\n'.format(self.stock_pool))
+        else:
+            # 只对需要的日期进行回归
+            bb.get_bb_factor_return(dates=stale_dates)
+            new_factor_return = bb.bb_factor_return
+            new_residual_return = bb.bb_residual_return
+            # 将新的结果写入库中，能追加的则只追加新的日期
+            data.append_data(pd.Panel({self.factor_return_name: new_factor_return}))
+            data.append_data(pd.Panel({self.residual_return_name: new_residual_return}))
+            # 更新内存中的结果
+            self.factor_return = self.combine_data(self.factor_return, new_factor_return)
+            self.residual_return = self.combine_data(self.residual_return, new_residual_return)
+            self.data_version = self.combine_data(self.data_version, curr_version.ix[stale_dates])
+            self.data_version.to_frame('data_version').to_csv(self.data_version_name + '.csv',
+                                                              index_label='datetime', encoding='GB18030')
+            print('The barra base factor returns of stock pool {0} have been updated, {1} dates regressed.\n'.
+                  format(self.stock_pool, stale_dates.size))
+
+        # 以当前barra base的时间为准，返回因子收益与残差
+        self.factor_return = self.factor_return.reindex(index=curr_version.index)
+        self.residual_return = self.residual_return.reindex(index=curr_version.index)
+        bb.bb_factor_return = self.factor_return
+        bb.bb_residual_return = self.residual_return
+
+    # 将新的数据与旧数据合并，重合的日期以新数据为准
+    @staticmethod
+    def combine_data(old_data, new_data):
+        if old_data.empty:
+            return new_data.sort_index()
+        old_data = old_data.drop(old_data.index.intersection(new_data.index), axis=0)
+        return pd.concat([old_data, new_data], axis=0).sort_index()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+import copy
+import shutil
+
+from data import data
+from strategy_data import strategy_data
+from position import position
+from strategy import strategy
+from backtest import backtest
+from single_factor_strategy import single_factor_strategy
+from batch_regression import batch_regression
+from rank_kernel import rank_kernel
+
+# 批量因子筛选，用于一次测试成百上千个候选因子（如wq101中的因子）
+# 市值，价格，可交易标记等所有因子共用的数据只读取一次，调仓日的收益及其排序也只计算一次，
+# 候选因子逐个从数据文件中读取，计算完指标后即丢弃，因此内存中始终只有一个候选因子
+# 每个因子的指标（IC，因子收益，t统计量，分位数组合收益差，换手率）都用向量化的函数一次算出所有调仓日的结果，
+# 所有因子的指标汇总成一张排行榜，只有排名靠前的因子才做完整的单因子测试（回测，画图）
+
+class factor_screening(object):
+    """ This is the class of batch screening of candidate factors.
+
+    stock_pool (str): stock pool in which factors are screened
+    holding_freq (str): frequency of holding days
+    no_of_groups (int): number of quantile groups
+    leaderboard (pd.DataFrame): screening statistics of all factors, factor names as index
+    factor_source (dict or function): source of candidate factors in last screening, dict with factor names as keys,
+        or function which takes a factor name and returns the factor data
+    """
+    def __init__(self, *, stock_pool='all', holding_freq='w', start='default', end='default', no_of_groups=5):
+        self.stock_pool = stock_pool
+        self.holding_freq = holding_freq
+        self.start = start
+        self.end = end
+        self.no_of_groups = no_of_groups
+        self.strategy_data = strategy_data()
+        self.holding_days = pd.Series()
+        self.leaderboard = pd.DataFrame()
+        # 候选因子的来源，筛选时记录下来，之后对排名靠前的因子做回测时从同一来源取因子
+        self.factor_source = factor_screening.read_factor
+
+    # 读取所有因子共用的数据，并计算调仓日的收益，收益的排序和回归权重，只需要做一次
+    def prepare_market_data(self):
+        self.strategy_data.generate_if_tradable(shift=True)
+        self.strategy_data.stock_price = data.read_data(['FreeMarketValue', 'ClosePrice_adj'],
+                                                        ['FreeMarketValue', 'ClosePrice_adj'], shift=True)
+        self.strategy_data.stock_pool = self.stock_pool
+        self.strategy_data.handle_stock_pool(shift=True)
+        # 调仓日，与单因子测试中计算IC和因子收益的方式一致
+        holding_days = strategy.resample_tradingdays(self.strategy_data.stock_price.ix['FreeMarketValue', :, 0],
+                                                     freq=self.holding_freq)
+        if self.start != 'default':
+            holding_days = holding_days[self.start:]
+        if self.end != 'default':
+            holding_days = holding_days[:self.end]
+        self.holding_days = holding_days
+
+        # 可投资的标记，全市场时为可交易的标记
+        if self.stock_pool == 'all':
+            self.inv_mask = self.strategy_data.if_tradable.ix['if_tradable']
+        else:
+            self.inv_mask = self.strategy_data.if_tradable.ix['if_inv']
+        holding_day_price = self.strategy_data.stock_price.ix['ClosePrice_adj', holding_days, :]
+        self.holding_day_return = np.log(holding_day_price.div(holding_day_price.shift(1)))
+        self.return_score = rank_kernel.get_row_ranks(self.holding_day_return.values, ascending=True)
+        self.holding_day_mv = self.strategy_data.stock_price.ix['FreeMarketValue', holding_days, :].where(
+            self.inv_mask.ix[holding_days, :], np.nan)
+        self.reg_weights = np.sqrt(self.holding_day_mv).values
+
+    # 一个因子的筛选指标，因子值用前一个调仓日的值，收益为两个调仓日之间的对数收益
+    # IC为秩相关系数，因子收益为对市值加权标准化的暴露做截面回归的系数，分位数组合收益差与换手率以IC的方向为准，
+    # 即IC为正时做多因子值最大的一组，做空因子值最小的一组，换手率为做多的一组中每期新调入的股票的比例
+    def get_factor_stats(self, factor):
+        """ Get screening statistics of one factor.
+
+        :param factor: (pd.DataFrame) factor data, dates*stocks
+        :return: (pd.Series) screening statistics of the factor
+        """
+        holding_days = self.holding_days.index
+        columns = self.holding_day_return.columns
+        factor = factor.reindex(index=holding_days, columns=columns).where(
+            self.inv_mask.ix[holding_days, columns], np.nan)
+
+        # IC
+        lag_factor = factor.shift(1)
+        factor_score = rank_kernel.get_row_ranks(lag_factor.values, ascending=True)
+        ic = pd.Series(rank_kernel.get_row_corr(factor_score, self.return_score), index=holding_days)
+        ic_mean = ic.mean()
+        direction = '+' if not ic_mean < 0 else '-'
+
+        # 因子收益与t统计量
+        factor_expo = strategy_data.get_cap_wgt_exposure(factor, self.holding_day_mv).shift(1)
+        params, t_stats = batch_regression.batch_wls(self.holding_day_return.values,
+            factor_expo.reindex(columns=columns).values[np.newaxis, :, :], weights=self.reg_weights,
+            add_constant=True, min_obs=0)[1:3]
+        factor_return = pd.Series(params[:, 1], index=holding_days)
+        t_stats = pd.Series(t_stats[:, 1], index=holding_days)
+
+        # 分位数分组，标签为0的组在IC的方向上最有利
+        labels = rank_kernel.get_qcut_labels(lag_factor.values, self.no_of_groups, ascending=(direction == '-'))
+        codes = np.where(np.isnan(labels), -1, labels).astype(int)
+        group_sums, group_counts = rank_kernel.get_group_sums(self.holding_day_return.values, codes,
+                                                              n_groups=self.no_of_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            group_return = group_sums / group_counts
+        long_short = pd.Series(group_return[:, 0] - group_return[:, -1], index=holding_days)
+        # 做多组的换手率
+        long_group = codes == 0
+        n_long = long_group.sum(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            turnover = 1 - np.logical_and(long_group[1:], long_group[:-1]).sum(1) / n_long[1:]
+        turnover = pd.Series(turnover, index=holding_days[1:])
+        turnover = turnover[np.logical_and(n_long[1:] > 0, n_long[:-1] > 0)]
+
+        stats = pd.Series({'direction': direction, 'n_periods': ic.count(), 'ic_mean': ic_mean,
+                           'ic_ir': ic_mean / ic.std(), 'factor_return': factor_return.mean(),
+                           't_stats_mean': t_stats.mean(),
+                           't_stats_sig_ratio': (np.abs(t_stats) >= 2).sum() / t_stats.count()
+                                                if t_stats.count() > 0 else np.nan,
+                           'long_short_return': long_short.mean(), 'long_short_ir': long_short.mean() / long_short.std(),
+                           'turnover': turnover.mean()})
+        return stats[['direction', 'n_periods', 'ic_mean', 'ic_ir', 'factor_return', 't_stats_mean',
+                      't_stats_sig_ratio', 'long_short_return', 'long_short_ir', 'turnover']]
+
+    # 从同名文件中读取候选因子，为默认的因子来源
+    @staticmethod
+    def read_factor(name):
+        return data.read_data([name], [name], shift=True)[name]
+
+    # 从筛选时的因子来源中取一个候选因子
+    def get_factor(self, name):
+        if isinstance(self.factor_source, dict):
+            return self.factor_source[name]
+        return self.factor_source(name)
+
+    # 逐个读取候选因子并计算筛选指标，factors为因子名的列表，也可以是以因子名为键，因子数据为值的dict
+    # 因子名的列表中的因子由loader读取，默认从同名文件中读取
+    # 排行榜按sort_by的绝对值降序排列，并写入文件
+    def screen(self, factors, *, loader='default', sort_by='ic_ir', file_name='default'):
+        """ Screen candidate factors and get the leaderboard.
+
+        :param factors: (list) names of factors, or dict with factor names as keys and pd.DataFrame as values
+        :param loader: (function) function which takes a factor name and returns pd.DataFrame, used when factors is
+            a list, 'default' means reading the file of the same name
+        :param sort_by: (str) statistic by whose absolute value the leaderboard is sorted
+        :param file_name: (str) file name of the leaderboard, 'default' means leaderboard_<stock_pool>
+        :return: (pd.DataFrame) leaderboard, factor names as index
+        """
+        if self.holding_days.empty:
+            self.prepare_market_data()
+        if isinstance(factors, dict):
+            self.factor_source = factors
+        else:
+            self.factor_source = factor_screening.read_factor if type(loader) == str else loader
+        all_stats = {}
+        for name in factors:
+            factor = self.get_factor(name)
+            all_stats[name] = self.get_factor_stats(factor)
+            print('Factor ' + str(name) + ' has been screened, ic_ir: {0:.4f}\n'.format(all_stats[name]['ic_ir']))
+            del factor
+        leaderboard = pd.DataFrame(all_stats).T
+        leaderboard = leaderboard.ix[leaderboard[sort_by].astype(np.float64).abs().sort_values(
+            ascending=False, na_position='last').index]
+        self.leaderboard = leaderboard
+
+        file_name = 'leaderboard_' + self.stock_pool if file_name == 'default' else file_name
+        leaderboard.to_csv(str(os.path.abspath('.')) + '/' + file_name + '.csv', index_label='factor',
+                           encoding='GB18030')
+        return leaderboard
+
+    # 对排行榜中排名靠前的因子做完整的单因子测试，回测对象（以及bb对象）只建立一次，每个因子的结果移到以因子名命名的文件夹中
+    # 因子从筛选时的同一来源中取出，因此筛选时传入的dict中的因子也可以回测
+    def backtest_top_factors(self, *, top_n=5, bkt_start='default', bkt_end='default', bb_obj='Empty',
+                             select_method=0, do_pa=False, do_active_pa=False):
+        cp_adj = data.read_data(['ClosePrice_adj'])
+        bkt_obj = backtest(position(cp_adj['ClosePrice_adj']), bkt_start=bkt_start, bkt_end=bkt_end,
+                           buy_cost=1.5/1000, sell_cost=1.5/1000)
+        for name in self.leaderboard.index[:top_n]:
+            factor = self.get_factor(name)
+            curr_sf = single_factor_strategy()
+            curr_sf.single_factor_test(factor=factor, direction=self.leaderboard.ix[name, 'direction'],
+                                       bkt_obj=copy.deepcopy(bkt_obj),
+                                       bb_obj=copy.deepcopy(bb_obj) if type(bb_obj) != str else bb_obj,
+                                       bkt_start=bkt_start, bkt_end=bkt_end, stock_pool=self.stock_pool,
+                                       holding_freq=self.holding_freq, select_method=select_method,
+                                       do_pa=do_pa, do_active_pa=do_active_pa)
+            # 单因子测试的结果都写在股票池的文件夹中，将其移到当前因子的文件夹中，避免被下一个因子覆盖
+            result_dir = str(os.path.abspath('.')) + '/screening_' + self.stock_pool + '/' + str(name)
+            if os.path.exists(result_dir):
+                shutil.rmtree(result_dir)
+            os.makedirs(os.path.dirname(result_dir), exist_ok=True)
+            shutil.move(str(os.path.abspath('.')) + '/' + self.stock_pool, result_dir)
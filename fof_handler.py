@@ -19,6 +19,7 @@ from backtest import backtest
 from barra_base import barra_base
 from performance import performance
 from performance_attribution import performance_attribution
+from batch_regression import batch_regression
 
 # 处理净值表的类
 class fof_handler(object):
@@ -91,18 +92,17 @@ class fof_handler(object):
         # factor_return = pd.concat([factor_return, bi_return, cfi_return], axis=1)
         factor_return = pd.concat([factor_return['country_factor'], bi_return.iloc[:, 0]], axis=1)
 
-        # 进行回归
-        y = self.nav_return * 1
-        x = sm.add_constant(factor_return)
-        # x = factor_return
-        model = sm.OLS(y, x, missing='drop')
-        results = model.fit()
+        # 进行回归，时间序列回归即为只有一期的批量回归，样本为日期，截距项为第一个变量
+        y = np.asarray(self.nav_return).reshape(1, -1)
+        x = factor_return.values.T[:, np.newaxis, :]
+        params, t_stats, p_values = batch_regression.batch_wls(y, x, add_constant=True)[1:4]
+        reg_factors = ['const'] + list(factor_return.columns)
         # 储存回归系数
-        results.params.to_csv(self.full_dir + 'ts_reg.csv', index_label='factor', na_rep='NaN',
-                              encoding='GB18030')
+        pd.Series(params[0], index=reg_factors).to_csv(self.full_dir + 'ts_reg.csv', index_label='factor',
+                                                        na_rep='NaN', encoding='GB18030')
         # 储存回归pvalues
-        results.pvalues.to_csv(self.full_dir + 'ts_reg_p.csv', index_label='factor', na_rep='NaN',
-                              encoding='GB18030')
+        pd.Series(p_values[0], index=reg_factors).to_csv(self.full_dir + 'ts_reg_p.csv', index_label='factor',
+                                                          na_rep='NaN', encoding='GB18030')
         pass
 
 
@@ -16,6 +16,7 @@ import os
 from data import data
 from backtest_data import backtest_data
 from position import position
+from trading_calendar import trading_calendar
 
 # 表现类，即根据账户的时间序列，计算各种业绩指标，以及进行画图
 class performance(object):
@@ -78,7 +79,8 @@ class performance(object):
             # 超额净值的算法为，每个调仓周期之内的超额净值序列为exp（策略累计收益序列）- exp（基准累计收益序列）
             # 不同调仓周期之间的净值为：这个调仓周期内的超额净值序列加上上一个调仓周期的最后一天的净值
             return_data = pd.DataFrame({'log_return': self.log_return, 'log_return_bench': self.log_return_bench})
-            return_data['mark'] = self.holding_days.asof(return_data.index).replace(pd.tslib.NaT, account_value.index[0])
+            return_data['mark'] = trading_calendar.get_asof_days(self.holding_days.values, return_data.index).fillna(
+                account_value.index[0])
             grouped = return_data.groupby('mark')
             # 每个调仓周期内用周期内净值相减的方法
             intra_holding = grouped.apply(lambda x:
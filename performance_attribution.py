@@ -18,6 +18,7 @@ from data import data
 from strategy_data import strategy_data
 from position import position
 from barra_base import barra_base
+from factor_return_store import factor_return_store
 
 # 业绩归因类，对策略中的股票收益率（注意：并非策略收益率）进行归因
 
@@ -73,28 +74,20 @@ class performance_attribution(object):
     # 用discard_factor可以定制用来归因的因子，将不需要的因子的名字或序号以list写入即可
     # 注意，只能用来删除风格因子，不能用来删除行业因子或country factor
     def get_pa_return(self, *, discard_factor=[], enable_reading_pa_return=True):
-        # 如果有储存的因子收益, 且没有被丢弃的因子, 则读取储存在本地的因子
-        if os.path.isfile('bb_factor_return_'+self.bb.bb_data.stock_pool+'.csv') and \
-                        len(discard_factor) == 0 and enable_reading_pa_return:
-            bb_factor_return = data.read_data(['bb_factor_return_'+self.bb.bb_data.stock_pool], ['pa_returns'])
-            self.pa_returns = bb_factor_return['pa_returns']
-            print('Barra base factor returns successfully read from local files! \n')
+        # 将被删除的风格因子的暴露全部设置为0
+        self.bb.bb_data.factor_expo.ix[discard_factor, :, :] = 0
+        # 再次将不能交易的值设置为nan
+        self.bb.bb_data.discard_uninv_data()
+        if len(discard_factor) == 0:
+            # 没有被丢弃的因子时, 使用本地的因子收益库, 只对新的日期以及数据有变化的日期进行回归
+            # 如果不允许读取本地的因子收益, 则重新回归所有日期, 并覆盖库中的结果
+            store = factor_return_store(stock_pool=self.bb.bb_data.stock_pool)
+            store.update(self.bb, refresh_all=not enable_reading_pa_return)
         else:
-            # 将被删除的风格因子的暴露全部设置为0
-            self.bb.bb_data.factor_expo.ix[discard_factor, :, :] = 0
-            # 再次将不能交易的值设置为nan
-            self.bb.bb_data.discard_uninv_data()
-            # 建立储存因子收益的dataframe
-            self.pa_returns = pd.DataFrame(0, index=self.bb.bb_data.factor_expo.major_axis,
-                                           columns = self.bb.bb_data.factor_expo.items)
-            # 计算barra base因子的因子收益
+            # 有被丢弃的因子时, 因子收益与库中的不同, 直接计算, 且不储存
             self.bb.get_bb_factor_return()
-            # barra base因子的因子收益即是归因的因子收益
-            self.pa_returns = self.bb.bb_factor_return
-
-            # 将回归得到的因子收益储存在本地, 每次更新了新的数据都要重新回归后储存一次
-            self.pa_returns.to_csv('bb_factor_return_'+self.bb.bb_data.stock_pool+'.csv',
-                                   index_label='datetime', na_rep='NaN', encoding='GB18030')
+        # barra base因子的因子收益即是归因的因子收益
+        self.pa_returns = self.bb.bb_factor_return
 
         # 将pa_returns的时间轴改为业绩归因的时间轴（而不是bb的时间轴）
         self.pa_returns = self.pa_returns.reindex(self.pa_position.holding_matrix.index)
@@ -128,12 +121,20 @@ class performance_attribution(object):
         # 注意, 由于计算组合收益的时候, 组合暴露要用上一期的暴露, 因此第一期统一没有因子收益
         # 这一部分收益会被归到residual return中去, 从而提升residual return
         # 而fillna是为了确保这部分收益会到residual中去, 否则residual会变成nan, 从而丢失这部分收益
+        # 按照因子名字区分风格因子，行业因子和国家因子，行业因子为以Industry开头的因子，国家因子为最后一个因子
+        # 行业的个数取决于行业数据中出现过的所有行业，因此不能按照固定的位置来区分
+        factor_names = self.port_pa_returns.columns
+        is_indus = np.array([str(item).startswith('Industry') for item in factor_names])
+        self.country_factor_name = factor_names[-1]
+        self.indus_factor_names = factor_names[is_indus]
+        self.style_factor_names = factor_names[np.logical_and(np.logical_not(is_indus),
+                                                              factor_names != self.country_factor_name)]
         # 风格因子收益
-        self.style_factor_returns = self.port_pa_returns.ix[:, 0:10].sum(1)
+        self.style_factor_returns = self.port_pa_returns.ix[:, self.style_factor_names].sum(1)
         # 行业因子收益
-        self.industry_factor_returns = self.port_pa_returns.ix[:, 10:38].sum(1)
+        self.industry_factor_returns = self.port_pa_returns.ix[:, self.indus_factor_names].sum(1)
         # 国家因子收益
-        self.country_factor_return = self.port_pa_returns.ix[:, 38].fillna(0.0)
+        self.country_factor_return = self.port_pa_returns.ix[:, self.country_factor_name].fillna(0.0)
 
         # 残余收益，即alpha收益，为组合收益减去之前那些因子的收益
         # 注意下面会提到，缺失数据会使得残余收益变大
@@ -210,11 +211,11 @@ class performance_attribution(object):
         # 第二张图分解组合的累计风格收益
         f2 = plt.figure()
         ax2 = f2.add_subplot(1,1,1)
-        plt.plot((self.port_pa_returns.ix[:, 0:10].cumsum(0)*100))
+        plt.plot((self.port_pa_returns.ix[:, self.style_factor_names].cumsum(0)*100))
         ax2.set_xlabel('Time')
         ax2.set_ylabel('Cumulative Log Return (%)')
         ax2.set_title('The Cumulative Log Return of Style Factors')
-        ax2.legend(self.port_pa_returns.columns[0:10], loc='best', bbox_to_anchor=(1, 1))
+        ax2.legend(self.style_factor_names, loc='best', bbox_to_anchor=(1, 1))
         plt.xticks(rotation=30)
         plt.grid()
         plt.savefig(str(os.path.abspath('.')) + '/' + foldername + '/PA_CumRetStyle.png', dpi=1200,
@@ -225,7 +226,7 @@ class performance_attribution(object):
         # 第三张图分解组合的累计行业收益
         # 行业图示只给出最大和最小的5个行业
         # 当前的有效行业数
-        valid_indus = self.pa_returns.iloc[:, 10:38].dropna(axis=1, how='all').shape[1]
+        valid_indus = self.pa_returns.ix[:, self.indus_factor_names].dropna(axis=1, how='all').shape[1]
         if valid_indus<=10:
             qualified_rank = [i for i in range(1, valid_indus+1)]
         else:
@@ -234,8 +235,8 @@ class performance_attribution(object):
             qualified_rank = part1+part2
         f3 = plt.figure()
         ax3 = f3.add_subplot(1, 1, 1)
-        indus_rank = self.port_pa_returns.ix[:, 10:38].cumsum(0).ix[-1].rank(ascending=False)
-        for i, j in enumerate(self.port_pa_returns.ix[:, 10:38].columns):
+        indus_rank = self.port_pa_returns.ix[:, self.indus_factor_names].cumsum(0).ix[-1].rank(ascending=False)
+        for i, j in enumerate(self.port_pa_returns.ix[:, self.indus_factor_names].columns):
             if indus_rank[j] in qualified_rank:
                 plt.plot((self.port_pa_returns.ix[:, j].cumsum(0) * 100), label=j+str(indus_rank[j]))
             else:
@@ -254,11 +255,11 @@ class performance_attribution(object):
         # 第四张图画组合的累计风格暴露
         f4 = plt.figure()
         ax4 = f4.add_subplot(1, 1, 1)
-        plt.plot(self.port_expo.ix[:, 0:10].cumsum(0))
+        plt.plot(self.port_expo.ix[:, self.style_factor_names].cumsum(0))
         ax4.set_xlabel('Time')
         ax4.set_ylabel('Cumulative Factor Exposures')
         ax4.set_title('The Cumulative Style Factor Exposures of the Portfolio')
-        ax4.legend(self.port_expo.columns[0:10], loc='best', bbox_to_anchor=(1, 1))
+        ax4.legend(self.style_factor_names, loc='best', bbox_to_anchor=(1, 1))
         plt.xticks(rotation=30)
         plt.grid()
         plt.savefig(str(os.path.abspath('.'))+'/'+foldername+'/PA_CumExpoStyle.png', dpi=1200,
@@ -270,8 +271,8 @@ class performance_attribution(object):
         f5 = plt.figure()
         ax5 = f5.add_subplot(1, 1, 1)
         # 累计暴露最大和最小的5个行业
-        indus_rank = self.port_expo.ix[:, 10:38].cumsum(0).ix[-1].rank(ascending=False)
-        for i, j in enumerate(self.port_expo.ix[:, 10:38].columns):
+        indus_rank = self.port_expo.ix[:, self.indus_factor_names].cumsum(0).ix[-1].rank(ascending=False)
+        for i, j in enumerate(self.port_expo.ix[:, self.indus_factor_names].columns):
             if indus_rank[j] in qualified_rank:
                 plt.plot((self.port_expo.ix[:, j].cumsum(0)), label=j+str(indus_rank[j]))
             else:
@@ -290,11 +291,11 @@ class performance_attribution(object):
         # 第六张图画组合的每日风格暴露
         f6 = plt.figure()
         ax6 = f6.add_subplot(1, 1, 1)
-        plt.plot(self.port_expo.ix[:, 0:10])
+        plt.plot(self.port_expo.ix[:, self.style_factor_names])
         ax6.set_xlabel('Time')
         ax6.set_ylabel('Factor Exposures')
         ax6.set_title('The Style Factor Exposures of the Portfolio')
-        ax6.legend(self.port_expo.columns[0:10], loc='best', bbox_to_anchor=(1, 1))
+        ax6.legend(self.style_factor_names, loc='best', bbox_to_anchor=(1, 1))
         plt.xticks(rotation=30)
         plt.grid()
         plt.savefig(str(os.path.abspath('.'))+'/'+foldername+'/PA_ExpoStyle.png', dpi=1200,
@@ -306,8 +307,8 @@ class performance_attribution(object):
         f7 = plt.figure()
         ax7 = f7.add_subplot(1, 1, 1)
         # 平均暴露最大和最小的5个行业
-        indus_rank = self.port_expo.ix[:, 10:38].mean(0).rank(ascending=False)
-        for i, j in enumerate(self.port_expo.ix[:, 10:38].columns):
+        indus_rank = self.port_expo.ix[:, self.indus_factor_names].mean(0).rank(ascending=False)
+        for i, j in enumerate(self.port_expo.ix[:, self.indus_factor_names].columns):
             if indus_rank[j] in qualified_rank:
                 plt.plot((self.port_expo.ix[:, j] * 100), label=j+str(indus_rank[j]))
             else:
@@ -326,11 +327,11 @@ class performance_attribution(object):
         # 第八张图画用于归因的bb的风格因子的纯因子收益率，即回归得到的因子收益率，仅供参考
         f8 = plt.figure()
         ax8 = f8.add_subplot(1, 1, 1)
-        plt.plot(self.pa_returns.ix[:, 0:10].cumsum(0)*100)
+        plt.plot(self.pa_returns.ix[:, self.style_factor_names].cumsum(0)*100)
         ax8.set_xlabel('Time')
         ax8.set_ylabel('Cumulative Log Return (%)')
         ax8.set_title('The Cumulative Log Return of Pure Style Factors Through Regression')
-        ax8.legend(self.pa_returns.columns[0:10], loc='best', bbox_to_anchor=(1, 1))
+        ax8.legend(self.style_factor_names, loc='best', bbox_to_anchor=(1, 1))
         plt.xticks(rotation=30)
         plt.grid()
         plt.savefig(str(os.path.abspath('.')) + '/' + foldername + '/PA_PureStyleFactorRet.png', dpi=1200,
@@ -13,6 +13,9 @@ from pandas import Series, DataFrame, Panel
 from datetime import datetime
 import os
 
+from strategy_data import strategy_data
+from rank_kernel import rank_kernel
+
 # 储存持仓的持仓类
 
 class position(object):
@@ -36,70 +39,115 @@ class position(object):
         foo
         """
         self.holding_matrix = self.holding_matrix.mul(weights, fill_value = 0)
-        self.to_percentage()
+        # 相乘得到的是新的dataframe，因此直接在其数据上归一，不再复制
+        self.to_percentage(copy=False)
         pass
 
     # 根据行业标签，进行分行业加权，可以选择行业内如何加权，以及行业间如何加权
+    # 所有持仓日所有行业的组内求和一次完成，不再对每个持仓日做groupby().apply()，没有行业数据的股票持仓为0
     def weighted_holding_indus(self, industry, *, inner_weights=0, outter_weights=0):
-        # 定义行业内加权的函数
-        def inner_weighting(grouped_data):
-            new_holding = grouped_data['holding'].mul(grouped_data['inner_weights'], fill_value=0)
-            if not (new_holding==0).all():
-                new_holding = new_holding.div(new_holding.sum())
-            return new_holding
+        industry = industry.reindex(index=self.holding_matrix.index)
+        # 行业数据在所有股票（包括行业间权重中的股票）上统一编码
+        if type(outter_weights) == int and outter_weights == 0:
+            all_stocks = self.holding_matrix.columns
+        else:
+            all_stocks = self.holding_matrix.columns.union(outter_weights.columns)
+        codes, industry_names = strategy_data.encode_labels(industry.reindex(columns=all_stocks))
+        codes = pd.DataFrame(codes, index=industry.index, columns=all_stocks)
+        holding_codes = codes.reindex(columns=self.holding_matrix.columns).values
+        n_groups = industry_names.size
+
+        # 进行行业内加权，持仓与行业内权重相乘，两者中有一个为nan时当作0，行业内的持仓不全为0时，行业内归一
+        holding = self.holding_matrix.values
         # 如果行业内权重为0，则为行业内等权
         if type(inner_weights) == int and inner_weights == 0:
-            inner_weights = pd.DataFrame(1, index=self.holding_matrix.index, columns=self.holding_matrix.columns)
-        # 根据持仓日循环
-        for time, curr_holding in self.holding_matrix.iterrows():
-            curr_data = pd.DataFrame({'holding':curr_holding,
-                                      'inner_weights':inner_weights.ix[time]})
-            # 处理行业数据最后一天可能全是nan的特殊情况（易在取数据时出现）
-            if industry.ix[time].isnull().all():
-                continue
-            grouped = curr_data.groupby(industry.ix[time])
-            # 进行行业内加权
-            after_inner = grouped.apply(inner_weighting).reset_index(level=0, drop=True)
-            # 对行业间加权数据进行求和
-            # 如果行业间权重为0，则为行业间等权，即每个行业的总权重为1，（注意不是每个股票的权重为1）
-            if type(outter_weights) == int and outter_weights == 0:
-                outter_weights_sum = pd.Series(1, index=after_inner.index)
-            else:
-                outter_weights_sum = outter_weights.ix[time].groupby(industry.ix[time]).transform('sum')
-            after_outter = after_inner.mul(outter_weights_sum).fillna(0)
-            self.holding_matrix.ix[time] = after_outter
+            inner = np.ones(holding.shape)
+        else:
+            inner = inner_weights.reindex(index=self.holding_matrix.index,
+                                          columns=self.holding_matrix.columns).values
+        new_holding = np.where(np.logical_and(np.isnan(holding), np.isnan(inner)), np.nan,
+                               np.where(np.isnan(holding), 0, holding) * np.where(np.isnan(inner), 0, inner))
+        holding_sum = rank_kernel.get_group_sums(new_holding, holding_codes, n_groups=n_groups)[0]
+        group_size = rank_kernel.get_group_sums(np.ones(holding.shape), holding_codes, n_groups=n_groups)[1]
+        zero_count = rank_kernel.get_group_sums((new_holding == 0).astype(np.float64), holding_codes,
+                                                n_groups=n_groups)[0]
+        all_zero = rank_kernel.take_group_values(zero_count == group_size, holding_codes) == 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            after_inner = np.where(all_zero, new_holding,
+                                   new_holding / rank_kernel.take_group_values(holding_sum, holding_codes))
+        after_inner = np.where(holding_codes >= 0, after_inner, np.nan)
+
+        # 对行业间加权数据进行求和
+        # 如果行业间权重为0，则为行业间等权，即每个行业的总权重为1，（注意不是每个股票的权重为1）
+        if type(outter_weights) == int and outter_weights == 0:
+            outter_weights_sum = np.ones(holding.shape)
+        else:
+            outter_weights = outter_weights.reindex(index=self.holding_matrix.index)
+            outter_codes = codes.reindex(columns=outter_weights.columns).values
+            outter_sum = rank_kernel.get_group_sums(outter_weights.values, outter_codes, n_groups=n_groups)[0]
+            # 行业间权重中没有的股票，行业间权重的和为nan
+            outter_weights_sum = np.where(self.holding_matrix.columns.isin(outter_weights.columns),
+                                          rank_kernel.take_group_values(outter_sum, holding_codes), np.nan)
+        after_outter = after_inner * outter_weights_sum
+        after_outter = np.where(np.isnan(after_outter), 0, after_outter)
+
+        # 处理行业数据最后一天可能全是nan的特殊情况（易在取数据时出现），这样的持仓日不加权
+        has_industry = industry.notnull().any(1).values
+        self.holding_matrix = self.holding_matrix.where(
+            np.broadcast_to(np.logical_not(has_industry)[:, np.newaxis], self.holding_matrix.shape),
+            pd.DataFrame(after_outter, index=self.holding_matrix.index, columns=self.holding_matrix.columns))
         self.holding_matrix = self.holding_matrix.fillna(0)
         self.to_percentage()
         pass
 
-    # 定义归一化的要apply的函数
+    # 按行归一化的核心函数，直接作用在时间*股票的np.ndarray上，一次完成所有行的归一，结果与对每一行做归一一致：
+    # 全为0的行不改动，行的和小于infinitesimal时，多头部分和空头部分分别归一，其余的行直接除以行的和，nan仍为nan
     # infinitesimal为在做空情况下，多空组合的和可能非常接近于0，当多空组合的和小于这个值的时候，分多空的方法归一
+    # infinitesimal为-np.inf时不分多空归一，不全为0的行都直接除以行的和
+    # 注意传入float64的数组时，直接在传入的数组上归一，不再复制
     @staticmethod
-    def to_percentage_func(input_series, *, infinitesimal=1e-4):
-        # 注意如果一期持仓全是0，则不改动
-        if (input_series == 0).all():
-            return input_series
-        # 当组合的和小于设定的无穷小量时，采用多空分别归一的方法归一
-        elif input_series.sum() < infinitesimal:
-            positive_part = input_series[input_series > 0]
-            positive_part = positive_part.div(positive_part.sum())
-            negative_part = input_series[input_series < 0]
-            negative_part = negative_part.div(np.abs(negative_part.sum()))
-            input_series[positive_part.index] = positive_part
-            input_series[negative_part.index] = negative_part
-            return input_series
-        # 一般情况下，直接归一
-        else:
-            input_series = input_series.div(input_series.sum())
-            return input_series
+    def normalize_rows(values, *, infinitesimal=1e-4):
+        """ Normalize each row of the array.
 
-    # 将持仓归一化，成为加总为1的百分比数
-    def to_percentage(self):
-        # apply函数
-        self.holding_matrix = self.holding_matrix.apply(position.to_percentage_func, axis=1)
+        :param values: (np.ndarray) T*N array, normalized in place if its dtype is float64
+        :param infinitesimal: (float) rows whose sums are less than it are normalized by long and short parts
+        :return: (np.ndarray) T*N array of normalized values
+        """
+        values = np.asarray(values, dtype=np.float64)
+        is_zero_row = (values == 0).all(1)
+        with np.errstate(invalid='ignore'):
+            is_positive = values > 0
+            is_negative = values < 0
+        row_sum = np.nansum(values, axis=1)
+        positive_sum = np.where(is_positive, values, 0).sum(1)
+        negative_sum = np.abs(np.where(is_negative, values, 0).sum(1))
+        # 多空分别归一的行，多头除以多头的和，空头除以空头和的绝对值，0和nan不变
+        is_split = np.logical_and(np.logical_not(is_zero_row), row_sum < infinitesimal)
+        divisor = np.where(is_split[:, np.newaxis],
+                           np.where(is_positive, positive_sum[:, np.newaxis],
+                                    np.where(is_negative, negative_sum[:, np.newaxis], 1.0)),
+                           row_sum[:, np.newaxis])
+        divisor[is_zero_row, :] = 1.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(values, divisor, out=values)
+        return values
+
+    # 对一期持仓归一化，不改动传入的持仓
+    @staticmethod
+    def to_percentage_func(input_series, *, infinitesimal=1e-4):
+        normalized = position.normalize_rows(input_series.values.astype(np.float64)[np.newaxis, :],
+                                             infinitesimal=infinitesimal)[0]
+        return pd.Series(normalized, index=input_series.index, name=input_series.name)
+
+    # 将持仓归一化，成为加总为1的百分比数，所有持仓日一次完成
+    # copy为False时，直接在持仓矩阵的数据上归一，用于持仓矩阵是刚计算出来的新dataframe的情况
+    def to_percentage(self, *, copy=True):
+        values = position.normalize_rows(self.holding_matrix.values.astype(np.float64, copy=copy))
         # 防止无持仓的变成nan
-        self.holding_matrix = self.holding_matrix.fillna(0.0)
-        
+        values[np.isnan(values)] = 0.0
+        self.holding_matrix = pd.DataFrame(values, index=self.holding_matrix.index,
+                                           columns=self.holding_matrix.columns)
+
     # 添加持股的函数，即，将选出的股票加入到对应时间点的持仓中去
     def add_holding(self, time, to_be_added):
         """ Add the holding matrix with newly selected(or bought) stocks.
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+# 数据的精度策略，为每个panel（或panel中的某个数据）指定计算和储存时使用的数据类型
+# 规则的键为panel名，如'factor_expo'，或'panel名.数据名'，如'stock_price.daily_return'，后者优先
+# 默认规则中，因子值，因子暴露和收益用float32，可交易等标记用bool，价格，市值，成交量保持float64
+# 精度策略只用于因子相关的数据（如barra base中的bb_data），回测中的价格，金额和持仓数量不做转换，始终为float64
+# 注意：行业虚拟变量和风格因子暴露放在一起，且不可投资的股票要设为nan，因此在factor_expo中与其他暴露一样为float32，
+# 单独生成虚拟变量时（strategy_data.get_dummies_from_codes）可以用int8
+
+class precision_policy(object):
+    """ This is the class of precision policy of data.
+
+    rules (dict): panel names or 'panel_name.item_name' as keys, dtypes as values
+    """
+    default_rules = {'factor': np.float32, 'factor_expo': np.float32, 'raw_data': np.float32,
+                     'stock_price': np.float64, 'stock_price.daily_return': np.float32,
+                     'stock_price.daily_excess_return': np.float32, 'benchmark_price': np.float64,
+                     'if_tradable': np.bool_}
+
+    def __init__(self, *, rules='default'):
+        self.rules = dict(precision_policy.default_rules)
+        if type(rules) != str:
+            self.rules.update(rules)
+
+    # 某个数据的数据类型，没有规则的数据为float64
+    def get_dtype(self, panel_name, item='Empty'):
+        if item != 'Empty' and panel_name + '.' + str(item) in self.rules:
+            return self.rules[panel_name + '.' + str(item)]
+        return self.rules.get(panel_name, np.float64)
+
+    # 按规则转换一个panel中每个数据的数据类型，bool类型的数据中的nan视为False
+    def cast_panel(self, panel, panel_name):
+        if panel.empty:
+            return panel
+        cast_data = {}
+        for item, df in panel.iteritems():
+            dtype = self.get_dtype(panel_name, item)
+            if dtype == np.bool_:
+                cast_data[item] = df.fillna(False).astype(np.bool_)
+            else:
+                cast_data[item] = df.astype(dtype)
+        return pd.Panel(cast_data, items=panel.items)
+
+    # 按规则转换数据类（如strategy_data）中所有panel的数据类型，panels为要转换的panel名
+    def apply(self, data_obj, *, panels=['stock_price', 'raw_data', 'factor', 'factor_expo']):
+        for panel_name in panels:
+            if hasattr(data_obj, panel_name):
+                setattr(data_obj, panel_name, self.cast_panel(getattr(data_obj, panel_name), panel_name))
+
+    # 数据类中各panel占用的内存，单位为MB
+    @staticmethod
+    def get_memory_usage(data_obj, *, panels=['stock_price', 'raw_data', 'factor', 'factor_expo']):
+        usage = {}
+        for panel_name in panels:
+            panel = getattr(data_obj, panel_name)
+            usage[panel_name] = np.sum([df.values.nbytes for item, df in panel.iteritems()]) / 1024 ** 2
+        return pd.Series(usage)
+
+    # 精度的验证报告，比较用低精度计算的数据与用float64计算的数据，给出每个数据的最大绝对偏差，最大相对偏差
+    # （相对于float64数据的最大绝对值），以及nan位置不一致的个数
+    @staticmethod
+    def get_deviation_report(reference, candidate, *, panels=['factor', 'factor_expo']):
+        """ Get the report of deviation of low precision data against float64 data.
+
+        :param reference: (data) data object computed in float64, such as strategy_data
+        :param candidate: (data) data object computed with precision policy
+        :param panels: (list) names of panels to compare
+        :return: (pd.DataFrame) dtype, max absolute deviation, max relative deviation and number of mismatched nans
+            of each item, 'panel_name.item_name' as index
+        """
+        report = {}
+        for panel_name in panels:
+            reference_panel = getattr(reference, panel_name)
+            candidate_panel = getattr(candidate, panel_name)
+            for item in reference_panel.items.intersection(candidate_panel.items):
+                reference_values = reference_panel.ix[item].values.astype(np.float64)
+                candidate_df = candidate_panel.ix[item].reindex(index=reference_panel.major_axis,
+                                                                columns=reference_panel.minor_axis)
+                candidate_values = candidate_df.values.astype(np.float64)
+                both_valid = np.logical_and(np.isfinite(reference_values), np.isfinite(candidate_values))
+                if both_valid.any():
+                    max_abs = np.abs(reference_values - candidate_values)[both_valid].max()
+                    scale = np.abs(reference_values[both_valid]).max()
+                    max_rel = max_abs / scale if scale > 0 else 0.0
+                else:
+                    max_abs, max_rel = np.nan, np.nan
+                nan_mismatch = int(np.sum(np.isnan(reference_values) != np.isnan(candidate_values)))
+                report[panel_name + '.' + str(item)] = [str(candidate_df.values.dtype), max_abs, max_rel,
+                                                        nan_mismatch]
+        report = pd.DataFrame.from_dict(report, orient='index')
+        report.columns = ['dtype', 'max_abs_deviation', 'max_rel_deviation', 'nan_mismatch']
+        return report
+
+    # 用barra base验证精度策略，分别用float64和精度策略构建barra base，返回偏差报告和内存占用
+    def validate_barra_base(self, *, stock_pool='all'):
+        from barra_base import barra_base
+        reference = barra_base(stock_pool=stock_pool)
+        reference.construct_barra_base()
+        candidate = barra_base(stock_pool=stock_pool)
+        candidate.precision_policy = self
+        candidate.construct_barra_base()
+        report = precision_policy.get_deviation_report(reference.bb_data, candidate.bb_data)
+        memory_usage = pd.DataFrame({'float64': precision_policy.get_memory_usage(reference.bb_data),
+                                     'policy': precision_policy.get_memory_usage(candidate.bb_data)})
+        print(report)
+        print(memory_usage)
+        return [report, memory_usage]
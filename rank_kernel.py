@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# 截面排序（以及分组排序，分组求和）的核心函数，所有函数都直接作用在时间*股票的np.ndarray上，一次算出所有日期的结果，
+# 以替代对每一期的数据做rank，或groupby().apply()的计算方式
+# 约定：排序与pd.Series.rank的默认方式一致，即秩从1开始，并列的取平均秩，nan不参与排序，其秩为nan
+
+class rank_kernel(object):
+    """ This is the class of vectorized cross-sectional ranking on dates*stocks arrays.
+
+    foo
+    """
+
+    # 对每一行排序，结果与对每一行做pd.Series.rank(ascending=ascending)一致
+    @staticmethod
+    def get_row_ranks(values, *, ascending=True, pct=False):
+        """ Get ranks of each row, ties get average ranks and nans are kept as nan.
+
+        :param values: (np.ndarray) T*N array
+        :param ascending: (bool) whether the smallest value gets rank 1
+        :param pct: (bool) whether to return ranks divided by number of valid values in the row
+        :return: (np.ndarray) T*N array of ranks
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not ascending:
+            values = -values
+        n_cols = values.shape[1]
+        # 稳定排序，nan排在每一行的最后
+        order = np.argsort(values, axis=1, kind='mergesort')
+        sorted_values = np.take_along_axis(values, order, axis=1)
+        # 每一个并列组的开始与结束位置，nan与任何值都不相等，因此每个nan单独成组，之后再设为nan
+        is_start = np.ones(values.shape, dtype=bool)
+        is_start[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+        is_end = np.ones(values.shape, dtype=bool)
+        is_end[:, :-1] = is_start[:, 1:]
+        positions = np.arange(n_cols)
+        group_start = np.maximum.accumulate(np.where(is_start, positions, 0), axis=1)
+        group_end = np.minimum.accumulate(np.where(is_end, positions, n_cols)[:, ::-1], axis=1)[:, ::-1]
+        ranks = np.empty(values.shape)
+        np.put_along_axis(ranks, order, (group_start + group_end) / 2 + 1, axis=1)
+        ranks[np.isnan(values)] = np.nan
+        if pct:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ranks = ranks / np.logical_not(np.isnan(values)).sum(1)[:, np.newaxis]
+        return ranks
+
+    # 每一行两组数据的pearson相关系数，只用两者都有数据的位置，与对每一行做pd.Series.corr一致，有效数据少于2个的行为nan
+    # 两组数据为get_row_ranks的结果时，即为每一行的秩相关系数
+    @staticmethod
+    def get_row_corr(x, y):
+        """ Get pearson correlation of each row of two arrays with pairwise complete observations.
+
+        :param x: (np.ndarray) T*N array
+        :param y: (np.ndarray) T*N array
+        :return: (np.ndarray) T array of correlations
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        valid = np.logical_and(np.logical_not(np.isnan(x)), np.logical_not(np.isnan(y)))
+        n_valid = valid.sum(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_demeaned = np.where(valid, x - np.where(valid, x, 0).sum(1)[:, np.newaxis] / n_valid[:, np.newaxis], 0)
+            y_demeaned = np.where(valid, y - np.where(valid, y, 0).sum(1)[:, np.newaxis] / n_valid[:, np.newaxis], 0)
+            corr = (x_demeaned * y_demeaned).sum(1) / np.sqrt((x_demeaned ** 2).sum(1) * (y_demeaned ** 2).sum(1))
+        corr[n_valid < 2] = np.nan
+        return corr
+
+    # 按比例选股的标记，每一行中秩在[floor(n*select_ratio[0]), floor(n*select_ratio[1])]之间的为True，n为有效数据个数
+    # ranks可以是get_row_ranks的结果，也可以是分组排序的结果（此时n为组内的有效数据个数）
+    @staticmethod
+    def get_select_mask(ranks, select_ratio, *, n_valid='default'):
+        """ Get mask of selected stocks by ranks.
+
+        :param ranks: (np.ndarray) T*N array of ranks
+        :param select_ratio: (list) lower and upper ratio of ranks to be selected
+        :param n_valid: (np.ndarray) number of valid values each rank is compared with, T*N or T*1 array,
+            'default' means number of valid ranks in the row
+        :return: (np.ndarray) T*N array of bool
+        """
+        if type(n_valid) == str:
+            n_valid = np.logical_not(np.isnan(ranks)).sum(1)[:, np.newaxis]
+        lower_bound = np.floor(n_valid * select_ratio[0])
+        upper_bound = np.floor(n_valid * select_ratio[1])
+        with np.errstate(invalid='ignore'):
+            return np.logical_and(ranks >= lower_bound, ranks <= upper_bound)
+
+    # 按百分比排序分组，每一行中pct rank在(i/n, (i+1)/n]中的标签为i，标签从0开始，nan的标签为nan
+    # 与pd.qcut不同，按秩分组不会因为重复的分位点报错，有效数据少于min_valid的行，所有标签都为nan
+    @staticmethod
+    def get_qcut_labels(values, no_of_groups, *, ascending=True, min_valid=1):
+        """ Get quantile group labels of each row by percentile ranks.
+
+        :param values: (np.ndarray) T*N array
+        :param no_of_groups: (int) number of groups
+        :param ascending: (bool) whether the smallest values get label 0
+        :param min_valid: (int) minimum number of valid values in a row to be grouped
+        :return: (np.ndarray) T*N array of labels, from 0 to no_of_groups-1
+        """
+        pct_rank = rank_kernel.get_row_ranks(values, ascending=ascending, pct=True)
+        edges = np.array([float(i) / no_of_groups for i in range(no_of_groups + 1)])
+        labels = np.where(np.isnan(pct_rank), np.nan, np.searchsorted(edges, pct_rank, side='left') - 1)
+        labels[np.logical_not(np.isnan(pct_rank)).sum(1) < min_valid, :] = np.nan
+        return labels
+
+    # 对每一行中的每一组分别排序，codes为组的编码（如行业编码），-1为不属于任何组，
+    # 结果与对每一期做groupby(codes).rank(ascending=ascending)一致，不属于任何组的，以及nan的秩为nan
+    # 所有日期所有组一次完成：按(行, 组编码, 值)的复合键稳定排序，每个元素在组内的位置即为组内的秩
+    @staticmethod
+    def get_group_ranks(values, codes, *, ascending=True):
+        """ Get ranks within groups of each row, ties get average ranks.
+
+        :param values: (np.ndarray) T*N array
+        :param codes: (np.ndarray) T*N integer array of group codes, -1 means no group
+        :param ascending: (bool) whether the smallest value in the group gets rank 1
+        :return: (np.ndarray) T*N array of ranks within groups
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not ascending:
+            values = -values
+        valid = np.logical_and(np.logical_not(np.isnan(values)), codes >= 0)
+        rows, cols = np.nonzero(valid)
+        ranks = np.full(values.shape, np.nan)
+        if rows.size == 0:
+            return ranks
+        # 按复合键排序，lexsort中最后一个键为第一排序键
+        order = np.lexsort((values[rows, cols], codes[rows, cols], rows))
+        rows, cols = rows[order], cols[order]
+        sorted_values = values[rows, cols]
+        sorted_codes = codes[rows, cols]
+        # 新的一组，以及新的并列组开始的位置
+        is_group_start = np.ones(rows.size, dtype=bool)
+        is_group_start[1:] = np.logical_or(rows[1:] != rows[:-1], sorted_codes[1:] != sorted_codes[:-1])
+        is_tie_start = is_group_start.copy()
+        is_tie_start[1:] |= sorted_values[1:] != sorted_values[:-1]
+        is_tie_end = np.ones(rows.size, dtype=bool)
+        is_tie_end[:-1] = is_tie_start[1:]
+        positions = np.arange(rows.size)
+        group_start = np.maximum.accumulate(np.where(is_group_start, positions, 0))
+        tie_start = np.maximum.accumulate(np.where(is_tie_start, positions, 0))
+        tie_end = np.minimum.accumulate(np.where(is_tie_end, positions, rows.size)[::-1])[::-1]
+        ranks[rows, cols] = (tie_start + tie_end) / 2 - group_start + 1
+        return ranks
+
+    # 每一行中每一组的和以及有效数据的个数，忽略nan，没有有效数据的组的和为nan
+    @staticmethod
+    def get_group_sums(values, codes, *, n_groups='default'):
+        """ Get sums within groups of each row.
+
+        :param values: (np.ndarray) T*N array
+        :param codes: (np.ndarray) T*N integer array of group codes, -1 means no group
+        :param n_groups: (int) number of groups, 'default' means max code plus 1
+        :return: (list) [sums, counts], T*G arrays of sums and numbers of valid values of each group
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if type(n_groups) == str:
+            n_groups = int(codes.max()) + 1 if codes.size > 0 else 0
+        valid = np.logical_and(np.logical_not(np.isnan(values)), codes >= 0)
+        rows, cols = np.nonzero(valid)
+        # 每一行每一组在结果中的位置
+        flat_loc = rows * n_groups + codes[rows, cols]
+        size = values.shape[0] * n_groups
+        sums = np.bincount(flat_loc, weights=values[rows, cols], minlength=size).reshape(values.shape[0], n_groups)
+        counts = np.bincount(flat_loc, minlength=size).reshape(values.shape[0], n_groups)
+        sums = np.where(counts > 0, sums, np.nan)
+        return [sums, counts]
+
+    # 将每一行每一组的值（如get_group_sums的结果）赋给组内的每个元素，不属于任何组的为nan
+    @staticmethod
+    def take_group_values(group_values, codes):
+        group_values = np.asarray(group_values, dtype=np.float64)
+        taken = np.take_along_axis(group_values, np.maximum(codes, 0), axis=1) if group_values.shape[1] > 0 \
+            else np.full(codes.shape, np.nan)
+        return np.where(codes >= 0, taken, np.nan)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import os
+import json
+
+from data import data
+from factor_cache import factor_cache
+
+# 风险模型类，用barra base的因子收益与回归的残差，估计股票收益的协方差矩阵
+# 协方差矩阵为结构化的形式，即V = X F X' + D，其中X为因子暴露，F为因子收益的协方差矩阵，D为股票特质收益的方差（对角矩阵）
+# 因此只储存F和D，而不储存股票*股票的协方差矩阵
+# 注意：某一天的F和D，是在这一天开始时可以得到的预测，即只用到了前一天及以前的因子收益和特质收益，
+# 与之对应的因子暴露为前一天的因子暴露，这样在策略中使用时不会用到未来数据
+
+class risk_model(object):
+    """ This is the class of factor risk model built on barra base.
+
+    stock_pool (str): stock pool of the barra base on which the risk model is built
+    factor_cov (pd.Panel): covariance matrices of factor returns, dates as items, factors as major and minor axis
+    specific_var (pd.DataFrame): specific variance of stocks, dates as index, stocks as columns
+    factor_expo (pd.Panel): factor exposures corresponding to factor_cov, i.e. lagged barra base exposures
+    var_half_life (int): half life of exponential weights when estimating factor volatilities
+    corr_half_life (int): half life of exponential weights when estimating factor correlations
+    spec_half_life (int): half life of exponential weights when estimating specific variance
+    nw_lags (int): number of lags in Newey-West adjustment, 0 means no adjustment
+    min_periods (int): minimum number of observations needed to estimate covariance or specific variance
+    """
+    def __init__(self, *, stock_pool='all', var_half_life=84, corr_half_life=504, spec_half_life=84, nw_lags=2,
+                 min_periods=63):
+        self.stock_pool = stock_pool
+        self.factor_cov = pd.Panel()
+        self.specific_var = pd.DataFrame()
+        self.factor_expo = pd.Panel()
+        self.var_half_life = var_half_life
+        self.corr_half_life = corr_half_life
+        self.spec_half_life = spec_half_life
+        self.nw_lags = nw_lags
+        self.min_periods = min_periods
+        # 储存的文件名
+        self.factor_cov_name = 'bb_factor_cov_' + stock_pool
+        self.specific_var_name = 'bb_specific_var_' + stock_pool
+        # 储存的风险模型的版本信息文件，记录计算时的参数以及因子收益和特质收益的数据版本
+        self.version_name = 'bb_risk_model_' + stock_pool
+
+    # 递归计算指数加权的协方差矩阵，以及newey west调整所需的滞后协方差矩阵
+    # 每一天只需要做O(K^2)的更新，返回的第t天的结果只用到了第t-1天及之前的数据
+    # 注意：日收益的均值很小，这里按照barra的做法，计算协方差时不减去均值
+    @staticmethod
+    def get_ewma_cov(returns, half_life, *, nw_lags=0, min_periods=63):
+        """ Get exponentially weighted covariance matrices with Newey-West adjustment recursively.
+
+        :param returns: (np.ndarray) T*K array of returns, rows with all nan are skipped, other nans are taken as 0
+        :param half_life: (int) half life of exponential weights
+        :param nw_lags: (int) number of lags in Newey-West adjustment
+        :param min_periods: (int) minimum number of observations, before which covariance is nan
+        :return: (np.ndarray) T*K*K array of covariance matrices, the t-th one uses data before t
+        """
+        n_periods, n_factors = returns.shape
+        exp_lambda = 0.5 ** (1 / half_life)
+        # 滞后0到nw_lags期的加权协方差之和，以及权重之和
+        lag_sum = np.zeros((nw_lags+1, n_factors, n_factors))
+        weight_sum = 0.0
+        n_obs = 0
+        # 之前的收益，用于计算滞后协方差，最近的在最前
+        past_returns = []
+        # newey west调整中的bartlett权重
+        nw_weights = 1 - np.arange(1, nw_lags+1) / (nw_lags+1)
+        cov = np.empty((n_periods, n_factors, n_factors)) * np.nan
+
+        for cursor in range(n_periods):
+            # 先记录当天开始时的预测，再用当天的收益更新
+            if n_obs >= min_periods:
+                curr_cov = lag_sum[0] / weight_sum
+                for lag in range(1, nw_lags+1):
+                    lag_cov = lag_sum[lag] / weight_sum
+                    curr_cov = curr_cov + nw_weights[lag-1] * (lag_cov + lag_cov.T)
+                cov[cursor] = curr_cov
+            curr_return = returns[cursor]
+            # 当天没有因子收益，则不更新
+            if np.isnan(curr_return).all():
+                continue
+            curr_return = np.where(np.isnan(curr_return), 0.0, curr_return)
+            lag_sum *= exp_lambda
+            lag_sum[0] += np.outer(curr_return, curr_return)
+            for lag in range(1, min(nw_lags, len(past_returns))+1):
+                lag_sum[lag] += np.outer(curr_return, past_returns[lag-1])
+            weight_sum = exp_lambda * weight_sum + 1
+            n_obs += 1
+            past_returns.insert(0, curr_return)
+            del past_returns[nw_lags:]
+        return cov
+
+    # 计算因子收益的协方差矩阵，波动率和相关系数分别用不同的半衰期计算
+    def get_factor_cov(self, factor_return):
+        returns = factor_return.values
+        var_cov = risk_model.get_ewma_cov(returns, self.var_half_life, nw_lags=self.nw_lags,
+                                          min_periods=self.min_periods)
+        if self.corr_half_life == self.var_half_life:
+            corr_cov = var_cov
+        else:
+            corr_cov = risk_model.get_ewma_cov(returns, self.corr_half_life, nw_lags=self.nw_lags,
+                                               min_periods=self.min_periods)
+        # 用相关系数的协方差矩阵计算相关系数，再乘以波动率的协方差矩阵中的波动率
+        vol = np.sqrt(np.diagonal(var_cov, axis1=1, axis2=2))
+        corr_vol = np.sqrt(np.diagonal(corr_cov, axis1=1, axis2=2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(corr_vol > 0, vol / corr_vol, 0.0)
+        factor_cov = corr_cov * scale[:, :, np.newaxis] * scale[:, np.newaxis, :]
+        self.factor_cov = pd.Panel(factor_cov, items=factor_return.index, major_axis=factor_return.columns,
+                                   minor_axis=factor_return.columns)
+
+    # 递归计算股票的特质收益方差，每只股票只用其有特质收益的日期，每一天的更新为O(N)
+    def get_specific_var(self, specific_return):
+        returns = specific_return.values
+        n_periods, n_stocks = returns.shape
+        exp_lambda = 0.5 ** (1 / self.spec_half_life)
+        lag_sum = np.zeros((self.nw_lags+1, n_stocks))
+        weight_sum = np.zeros(n_stocks)
+        n_obs = np.zeros(n_stocks)
+        past_returns = []
+        nw_weights = 1 - np.arange(1, self.nw_lags+1) / (self.nw_lags+1)
+        specific_var = np.empty((n_periods, n_stocks)) * np.nan
+
+        for cursor in range(n_periods):
+            enough_obs = n_obs >= self.min_periods
+            with np.errstate(divide='ignore', invalid='ignore'):
+                raw_var = lag_sum[0] / weight_sum
+                adjusted_var = raw_var + 2 * np.dot(nw_weights, lag_sum[1:] / weight_sum)
+            # newey west调整后的方差不为正时，用调整前的方差
+            curr_var = np.where(adjusted_var > 0, adjusted_var, raw_var)
+            specific_var[cursor] = np.where(enough_obs, curr_var, np.nan)
+
+            curr_return = returns[cursor]
+            is_valid = np.logical_not(np.isnan(curr_return))
+            curr_return = np.where(is_valid, curr_return, 0.0)
+            lag_sum *= exp_lambda
+            lag_sum[0] += curr_return ** 2
+            # 之前的收益中，没有数据的日期已经被记为0，因此不会影响滞后协方差
+            for lag in range(1, min(self.nw_lags, len(past_returns))+1):
+                lag_sum[lag] += curr_return * past_returns[lag-1]
+            weight_sum = exp_lambda * weight_sum + is_valid
+            n_obs += is_valid
+            past_returns.insert(0, curr_return)
+            del past_returns[self.nw_lags:]
+        self.specific_var = pd.DataFrame(specific_var, index=specific_return.index, columns=specific_return.columns)
+
+    # 取计算风险模型的输入，即因子收益，股票的特质收益以及上一期的因子暴露
+    # bb为计算好因子暴露的barra base对象，如果bb还没有因子收益，则先计算因子收益
+    def get_risk_model_input(self, bb):
+        daily_return, lag_factor_expo, lag_mv = bb.get_bb_factor_return_input()
+        if bb.bb_factor_return.empty:
+            bb.get_bb_factor_return()
+        factor_return = bb.bb_factor_return.reindex(index=daily_return.index, columns=lag_factor_expo.items)
+        # 股票的特质收益，即收益中不能被因子解释的部分
+        # 注意这里不直接用回归的残差，因为回归的残差是加权后的残差
+        expo_values = lag_factor_expo.values
+        explained_return = np.einsum('ijk,ji->jk', np.where(np.isnan(expo_values), 0.0, expo_values),
+                                     factor_return.fillna(0.0).values)
+        # 有任何因子暴露为nan的股票，没有特质收益
+        has_expo = np.logical_not(np.isnan(expo_values).any(0))
+        specific_return = (daily_return - explained_return).where(has_expo)
+        return [factor_return, specific_return, lag_factor_expo]
+
+    # 风险模型的版本信息，包括所有参数，以及因子收益和特质收益的数据版本，任何一项改变时，储存的风险模型失效
+    def get_version(self, factor_return, specific_return):
+        return factor_cache.get_entry('risk_model', inputs={'factor_return': factor_return,
+                                                            'specific_return': specific_return},
+                                      params={'var_half_life': self.var_half_life,
+                                              'corr_half_life': self.corr_half_life,
+                                              'spec_half_life': self.spec_half_life,
+                                              'nw_lags': self.nw_lags, 'min_periods': self.min_periods},
+                                      stock_pool=self.stock_pool)
+
+    # 计算风险模型
+    def construct_risk_model(self, bb):
+        factor_return, specific_return, lag_factor_expo = self.get_risk_model_input(bb)
+        self.get_factor_cov(factor_return)
+        self.get_specific_var(specific_return)
+        self.factor_expo = lag_factor_expo
+
+    # 取风险模型，储存过的风险模型的版本信息与当前的参数和输入数据一致时，直接读取，否则重新计算并储存
+    def get_risk_model(self, bb, *, enable_reading=True):
+        factor_return, specific_return, lag_factor_expo = self.get_risk_model_input(bb)
+        version = self.get_version(factor_return, specific_return)
+        if enable_reading and os.path.isfile(self.factor_cov_name + '.csv') and \
+                os.path.isfile(self.specific_var_name + '.csv') and os.path.isfile(self.version_name + '.json'):
+            with open(self.version_name + '.json', encoding='utf-8') as version_file:
+                stored_version = json.load(version_file)
+            if stored_version.get('key') == version['key']:
+                self.read_risk_model()
+                self.factor_cov = self.factor_cov.reindex(items=lag_factor_expo.major_axis)
+                self.factor_cov.major_axis = lag_factor_expo.items
+                self.factor_cov.minor_axis = lag_factor_expo.items
+                self.specific_var = self.specific_var.reindex(index=lag_factor_expo.major_axis,
+                                                              columns=lag_factor_expo.minor_axis)
+                self.factor_expo = lag_factor_expo
+                print('Risk model of stock pool {0} successfully read from local files! \n'.format(self.stock_pool))
+                return
+        self.get_factor_cov(factor_return)
+        self.get_specific_var(specific_return)
+        self.factor_expo = lag_factor_expo
+        self.write_risk_model(version=version)
+        print('Risk model of stock pool {0} has been constructed. \n'.format(self.stock_pool))
+
+    # 储存风险模型，因子协方差矩阵每一天展开为一行，列为(因子, 因子)的多重索引
+    # version为风险模型的版本信息，会写入版本信息文件，不写入版本信息文件时，下次取风险模型会重新计算
+    def write_risk_model(self, *, version='default'):
+        if os.path.isfile(self.version_name + '.json'):
+            os.remove(self.version_name + '.json')
+        n_factors = self.factor_cov.major_axis.size
+        factor_cov_flat = pd.DataFrame(self.factor_cov.values.reshape(-1, n_factors * n_factors),
+                                       index=self.factor_cov.items, columns=pd.MultiIndex.from_product(
+                                       [self.factor_cov.major_axis, self.factor_cov.minor_axis]))
+        factor_cov_flat.to_csv(self.factor_cov_name + '.csv', index_label='datetime', na_rep='NaN',
+                               encoding='GB18030')
+        data.write_data(pd.Panel({self.specific_var_name: self.specific_var}))
+        # 版本信息最后写入，风险模型写了一半时不会被当作有效的风险模型读取
+        if version != 'default':
+            with open(self.version_name + '.json', 'w', encoding='utf-8') as version_file:
+                json.dump(version, version_file, sort_keys=True)
+
+    def read_risk_model(self):
+        factor_cov_flat = pd.read_csv(self.factor_cov_name + '.csv', index_col=0, header=[0, 1], parse_dates=True,
+                                      encoding='GB18030')
+        factors = factor_cov_flat.columns.get_level_values(0).unique()
+        self.factor_cov = pd.Panel(factor_cov_flat.values.reshape(-1, factors.size, factors.size),
+                                   items=factor_cov_flat.index, major_axis=factors, minor_axis=factors)
+        self.specific_var = data.read_data([self.specific_var_name], ['specific_var']).ix['specific_var']
+
+    # 取某一天的结构化协方差矩阵，返回因子暴露X，因子协方差矩阵F，特质方差D
+    def get_structured_cov(self, time):
+        return [self.factor_expo.ix[:, time, :], self.factor_cov.ix[time], self.specific_var.ix[time]]
+
+    # 用woodbury恒等式计算协方差矩阵的逆乘以向量，即(X F X' + D)^(-1) z，不需要计算股票*股票的矩阵
+    # (X F X' + D)^(-1) z = D^(-1) z - D^(-1) X F (I + X' D^(-1) X F)^(-1) X' D^(-1) z
+    # 这种写法不需要F可逆，计算量为O(N*K^2)
+    @staticmethod
+    def inv_cov_dot(x, factor_cov, spec_var, z):
+        """ Get the product of the inverse of structured covariance matrix and z by Woodbury identity.
+
+        :param x: (np.ndarray) N*K array of factor exposures
+        :param factor_cov: (np.ndarray) K*K covariance matrix of factor returns
+        :param spec_var: (np.ndarray) N array of specific variance, stocks whose specific variance is not positive or
+            nan are treated as having infinite variance, i.e. their rows in the outcome are 0
+        :param z: (np.ndarray) N array or N*M array to be multiplied
+        :return: (np.ndarray) array of the same shape as z
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_d = np.where(spec_var > 0, 1 / spec_var, 0.0)
+        inv_d = np.where(np.isnan(inv_d), 0.0, inv_d)
+        z_2d = z.reshape(z.shape[0], -1)
+        inv_d_z = inv_d[:, np.newaxis] * z_2d
+        inv_d_x = inv_d[:, np.newaxis] * x
+        inner = np.eye(x.shape[1]) + np.dot(np.dot(x.T, inv_d_x), factor_cov)
+        try:
+            temp = np.linalg.solve(inner, np.dot(x.T, inv_d_z))
+        except np.linalg.LinAlgError:
+            temp = np.dot(np.linalg.pinv(inner), np.dot(x.T, inv_d_z))
+        outcome = inv_d_z - np.dot(inv_d_x, np.dot(factor_cov, temp))
+        return outcome.reshape(z.shape)
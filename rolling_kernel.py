@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# 滚动窗口计算的核心函数，所有函数都直接作用在时间*股票的np.ndarray上，一次算出所有日期所有股票的结果，
+# 以替代对每一期（或每只股票）做rolling().apply()或循环的计算方式
+# 约定：窗口权重的顺序与barra_base.construct_expo_weights一致，即第一个为最早一期的权重，最后一个为最近一期的权重
+# dtype为结果的数据类型（如精度策略中的float32），窗口中的和与矩始终用float64累加，只有结果按dtype储存
+
+class rolling_kernel(object):
+    """ This is the class of vectorized rolling window calculations on dates*stocks arrays.
+
+    foo
+    """
+
+    # 判断窗口权重是否为等比数列（如指数权重），等比数列可以用递推的方式计算窗口和
+    @staticmethod
+    def get_geometric_ratio(weights):
+        if weights.size <= 1 or (weights <= 0).any():
+            return None
+        ratios = weights[1:] / weights[:-1]
+        if np.allclose(ratios, ratios[0], rtol=1e-10, atol=0):
+            return ratios[0]
+        return None
+
+    # 固定权重的滚动窗口加权和，第t行的结果为sum(weights[j] * values[t-L+1+j])，L为窗口长度
+    # values中的nan会被当作0，因此需要在调用前根据需要处理nan（如同时计算有效数据的个数）
+    # 窗口不足L期的行为nan
+    @staticmethod
+    def window_sum(values, weights, *, dtype=np.float64):
+        """ Get rolling window sum with fixed weights.
+
+        :param values: (np.ndarray) T*N array, or T array, nan is taken as 0
+        :param weights: (np.ndarray) L array of weights, the first one is for the oldest data in the window
+        :param dtype: (np.dtype) dtype of the outcome
+        :return: (np.ndarray) array of the same shape as values, first L-1 rows are nan
+        """
+        values = np.where(np.isnan(values), 0.0, values)
+        weights = np.asarray(weights, dtype=np.float64)
+        window = weights.size
+        outcome = np.full(values.shape, np.nan, dtype=dtype)
+        if values.shape[0] < window:
+            return outcome
+        ratio = rolling_kernel.get_geometric_ratio(weights)
+        # 等比且越近的权重越大（或相等）时，用递推计算，每一期的计算量为O(N)
+        # S_t = S_{t-1} / ratio + w_last * x_t - w_first / ratio * x_{t-L}
+        # 除以ratio相当于乘以衰减系数，误差不会累积放大
+        if ratio is not None and ratio >= 1:
+            decay = 1 / ratio
+            curr_sum = np.tensordot(weights, values[:window], axes=(0, 0))
+            outcome[window-1] = curr_sum
+            for cursor in range(window, values.shape[0]):
+                curr_sum = curr_sum * decay + weights[-1] * values[cursor] - \
+                           weights[0] * decay * values[cursor-window]
+                outcome[cursor] = curr_sum
+            return outcome
+        # 一般权重：按照窗口中的每个位置累加，计算量为O(L*T*N)
+        curr_sum = np.zeros((values.shape[0] - window + 1,) + values.shape[1:])
+        for position in range(window):
+            curr_sum += weights[position] * values[position:values.shape[0]-window+1+position]
+        outcome[window-1:] = curr_sum
+        return outcome
+
+    # 滚动窗口中非nan数据的个数
+    @staticmethod
+    def window_count(values, window):
+        return rolling_kernel.window_sum(np.logical_not(np.isnan(values)).astype(np.float64), np.ones(window))
+
+    # 忽略nan的固定权重滚动加权和，与对窗口中的数据乘以权重后做pandas的sum一致，即窗口中全是nan时为nan
+    @staticmethod
+    def window_nansum(values, weights, *, dtype=np.float64):
+        outcome = rolling_kernel.window_sum(values, weights, dtype=dtype)
+        n_valid = rolling_kernel.window_count(values, np.asarray(weights).size)
+        return np.where(n_valid > 0, outcome, np.nan).astype(dtype, copy=False)
+
+    # 忽略nan的固定权重滚动加权标准差，即对窗口中的数据乘以权重后求标准差，与pandas的std一致
+    # 用加权和与权重平方的加权平方和计算：var = (sum(v^2) - sum(v)^2 / n) / (n - ddof)，其中v = weights * values
+    @staticmethod
+    def window_std(values, weights, *, ddof=1, dtype=np.float64):
+        """ Get rolling window std of weighted values, nan is ignored.
+
+        :param values: (np.ndarray) T*N array
+        :param weights: (np.ndarray) L array of weights, the first one is for the oldest data in the window
+        :param ddof: (int) delta degrees of freedom
+        :param dtype: (np.dtype) dtype of the outcome
+        :return: (np.ndarray) array of the same shape as values, first L-1 rows are nan
+        """
+        # 平方和相减时误差会放大，因此低精度的输入也先转为float64
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        sum_v = rolling_kernel.window_sum(values, weights)
+        sum_v2 = rolling_kernel.window_sum(values ** 2, weights ** 2)
+        n_valid = rolling_kernel.window_count(values, weights.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = (sum_v2 - sum_v ** 2 / n_valid) / (n_valid - ddof)
+        return np.where(n_valid > ddof, np.sqrt(np.maximum(var, 0.0)), np.nan).astype(dtype, copy=False)
+
+    # 滚动窗口中，在给定的位置上取窗口内的累计和，再求这些累计和的最大值与最小值
+    # 窗口内第k期的累计和为全局累计和的差，C[t-L+1+k] - C[t-L]，这一期数据为nan时，这一期的累计和为nan，
+    # 与对窗口数据做pandas的cumsum后取这些位置一致
+    @staticmethod
+    def window_cum_max_min(values, window, offsets, *, dtype=np.float64):
+        """ Get max and min of cumulative sums at sampled offsets in rolling windows, nan is ignored.
+
+        :param values: (np.ndarray) T*N array
+        :param window: (int) length of window
+        :param offsets: (np.ndarray) offsets in window where cumulative sums are sampled, 0 is the oldest data
+        :param dtype: (np.dtype) dtype of the outcome
+        :return: (list) [cum_max, cum_min], both are arrays of the same shape as values, first L-1 rows are nan
+        """
+        is_valid = np.logical_not(np.isnan(values))
+        # 在最前面补一行0，使得cum_sum[i]为前i期的和
+        cum_sum = np.concatenate((np.zeros((1,) + values.shape[1:]),
+                                  np.cumsum(np.where(is_valid, values, 0.0), axis=0, dtype=np.float64)), axis=0)
+        n_windows = values.shape[0] - window + 1
+        cum_max = np.full(values.shape, np.nan, dtype=dtype)
+        cum_min = np.full(values.shape, np.nan, dtype=dtype)
+        if n_windows <= 0:
+            return [cum_max, cum_min]
+        base = cum_sum[:n_windows]
+        # 逐个取样点更新最大值与最小值，不同时保存所有取样点的累计和，fmax与fmin忽略nan，全是nan时为nan，与pandas一致
+        curr_max = cum_max[window-1:]
+        curr_min = cum_min[window-1:]
+        for offset in offsets:
+            sampled = cum_sum[offset+1:offset+1+n_windows] - base
+            sampled[np.logical_not(is_valid[offset:offset+n_windows])] = np.nan
+            np.fmax(curr_max, sampled, out=curr_max)
+            np.fmin(curr_min, sampled, out=curr_min)
+        return [cum_max, cum_min]
+
+    # 对每一期，取之前若干期（lags）的数据求均值，忽略nan，全是nan时为nan，与对这些期的数据做pandas的mean一致
+    # 不足max(lags)期的行为nan
+    @staticmethod
+    def sampled_nanmean(values, lags, *, dtype=np.float64):
+        """ Get mean of values lagged by given lags, nan is ignored.
+
+        :param values: (np.ndarray) T*N array
+        :param lags: (np.ndarray) lags of sampled data, 0 means the current data
+        :param dtype: (np.dtype) dtype of the outcome
+        :return: (np.ndarray) array of the same shape as values
+        """
+        max_lag = max(lags)
+        outcome = np.full(values.shape, np.nan, dtype=dtype)
+        if values.shape[0] <= max_lag:
+            return outcome
+        n_rows = values.shape[0] - max_lag
+        sampled_sum = np.zeros((n_rows,) + values.shape[1:])
+        n_valid = np.zeros((n_rows,) + values.shape[1:])
+        for lag in lags:
+            curr_values = values[max_lag-lag:max_lag-lag+n_rows]
+            is_valid = np.logical_not(np.isnan(curr_values))
+            sampled_sum += np.where(is_valid, curr_values, 0.0)
+            n_valid += is_valid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            outcome[max_lag:] = np.where(n_valid > 0, sampled_sum / n_valid, np.nan)
+        return outcome
+
+    # 滚动窗口的加权最小二乘回归y = alpha + beta * x，每只股票分别回归，回归权重为窗口权重
+    # 与statsmodels.WLS(missing='drop')一致，x或y为nan的期数不参与回归
+    # 残差的标准差为(resid * weights)的标准差（ddof=1），与barra base中hsigma的计算方式一致
+    @staticmethod
+    def rolling_wls_beta(y, x, weights, *, min_obs=100, dtype=np.float64):
+        """ Get rolling weighted least square regression coefficients and std of weighted residuals.
+
+        :param y: (np.ndarray) T*N array of dependent variables
+        :param x: (np.ndarray) T array of independent variable, which is the same for all stocks
+        :param weights: (np.ndarray) L array of regression weights, the first one is for the oldest data
+        :param min_obs: (int) stocks which have no more than min_obs non-nan y in the window get nan
+        :param dtype: (np.dtype) dtype of the outcome
+        :return: (list) [beta, hsigma], both are T*N arrays
+        """
+        # 回归的矩相减时误差会放大，因此低精度的输入也先转为float64
+        y = np.asarray(y, dtype=np.float64)
+        x = np.broadcast_to(np.asarray(x, dtype=np.float64)[:, np.newaxis], y.shape)
+        is_valid = np.logical_and(np.logical_not(np.isnan(y)), np.logical_not(np.isnan(x)))
+        # 有效数据置为0后，各项加权和只包含有效数据
+        y_valid = np.where(is_valid, y, 0.0)
+        x_valid = np.where(is_valid, x, 0.0)
+        mask = is_valid.astype(np.float64)
+        squared_weights = weights ** 2
+
+        # 回归需要的加权矩
+        sw = rolling_kernel.window_sum(mask, weights)
+        swx = rolling_kernel.window_sum(x_valid, weights)
+        swy = rolling_kernel.window_sum(y_valid, weights)
+        swxx = rolling_kernel.window_sum(x_valid * x_valid, weights)
+        swxy = rolling_kernel.window_sum(x_valid * y_valid, weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = (sw * swxy - swx * swy) / (sw * swxx - swx ** 2)
+            alpha = (swy - beta * swx) / sw
+
+        # 加权残差的标准差，由于回归的一阶条件，加权残差的和为0，因此只需要加权残差的平方和
+        # sum(w^2 * (y - alpha - beta * x)^2)，展开后用权重平方的加权矩计算
+        s2w = rolling_kernel.window_sum(mask, squared_weights)
+        s2wx = rolling_kernel.window_sum(x_valid, squared_weights)
+        s2wy = rolling_kernel.window_sum(y_valid, squared_weights)
+        s2wxx = rolling_kernel.window_sum(x_valid * x_valid, squared_weights)
+        s2wxy = rolling_kernel.window_sum(x_valid * y_valid, squared_weights)
+        s2wyy = rolling_kernel.window_sum(y_valid * y_valid, squared_weights)
+        ssr = s2wyy + alpha ** 2 * s2w + beta ** 2 * s2wxx - 2 * alpha * s2wy - 2 * beta * s2wxy + \
+              2 * alpha * beta * s2wx
+        n_valid = rolling_kernel.window_sum(mask, np.ones(weights.size))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hsigma = np.sqrt(np.maximum(ssr, 0.0) / (n_valid - 1))
+
+        # y的有效数据不超过min_obs个的，结果为nan
+        n_valid_y = rolling_kernel.window_count(y, weights.size)
+        enough_obs = n_valid_y > min_obs
+        beta = np.where(enough_obs, beta, np.nan).astype(dtype, copy=False)
+        hsigma = np.where(enough_obs, hsigma, np.nan).astype(dtype, copy=False)
+        return [beta, hsigma]
@@ -54,19 +54,22 @@ def sf_test_multiple_pools(factor='default', *, direction='+', bb_obj='Empty', d
     elif bb_obj.bb_data.stock_pool != 'all':
         print('The stockpool of the barra_base obj from outside is NOT "all", be aware of possibile'
               'data loss due to this situation!\n')
+    # 所有股票池的风格因子暴露一次算好，每个股票池的bb对象只带上自己的暴露，不再各自重新标准化
+    pool_style_expo = bb_obj.get_multi_pool_style_factor_expo(stock_pools)
 
     # 根据股票池进行循环
     for stock_pool in stock_pools:
+        curr_bb = bb_obj.get_pool_copy(stock_pool, pool_style_expo=pool_style_expo[stock_pool])
         # 建立单因子测试对象
         # curr_sf = single_factor_strategy()
         from analyst_coverage import analyst_coverage
         curr_sf = analyst_coverage()
 
         # 进行当前股票池下的单因子测试
-        # 注意bb obj进行了一份深拷贝，这是因为在业绩归因的计算中，会根据不同的股票池丢弃数据，导致数据不全，因此不能传引用
-        # 对bkt obj做了同样的处理，尽管这里并不是必要的
+        # 注意bb obj复制了会被改写的数据，这是因为在业绩归因的计算中，会根据不同的股票池丢弃数据，导致数据不全，因此不能传引用
+        # 对bkt obj做了深拷贝，尽管这里并不是必要的
         curr_sf.single_factor_test(factor=factor, direction=direction, bkt_obj=copy.deepcopy(bkt_obj),
-                                   bb_obj=copy.deepcopy(bb_obj), discard_factor=discard_factor,
+                                   bb_obj=curr_bb, discard_factor=discard_factor,
                                    bkt_start=bkt_start, bkt_end=bkt_end, holding_freq=holding_freq,
                                    stock_pool=stock_pool, select_method=select_method,
                                    do_bb_pure_factor=do_bb_pure_factor,
@@ -103,17 +106,20 @@ def sf_test_multiple_pools_parallel(factor='default', *, direction='+', bb_obj='
     elif bb_obj.bb_data.stock_pool != 'all':
         print('The stockpool of the barra_base obj from outside is NOT "all", be aware of possibile'
               'data loss due to this situation!\n')
+    # 所有股票池的风格因子暴露一次算好，每个股票池的bb对象只带上自己的暴露，不再各自重新标准化
+    pool_style_expo = bb_obj.get_multi_pool_style_factor_expo(stock_pools)
 
     def single_task(stock_pool):
+        curr_bb = bb_obj.get_pool_copy(stock_pool, pool_style_expo=pool_style_expo[stock_pool])
         # curr_sf = single_factor_strategy()
         from analyst_coverage import analyst_coverage
         curr_sf = analyst_coverage()
 
         # 进行当前股票池下的单因子测试
-        # 注意bb obj进行了一份深拷贝，这是因为在业绩归因的计算中，会根据不同的股票池丢弃数据，导致数据不全，因此不能传引用
-        # 对bkt obj做了同样的处理，这是因为尽管bkt obj不会被改变，但是多进程同时操作可能出现潜在的问题
+        # 注意bb obj复制了会被改写的数据，这是因为在业绩归因的计算中，会根据不同的股票池丢弃数据，导致数据不全，因此不能传引用
+        # 对bkt obj做了深拷贝，这是因为尽管bkt obj不会被改变，但是多进程同时操作可能出现潜在的问题
         curr_sf.single_factor_test(stock_pool=stock_pool, factor=factor, direction=direction,
-                                   bkt_obj=copy.deepcopy(bkt_obj), bb_obj=copy.deepcopy(bb_obj),
+                                   bkt_obj=copy.deepcopy(bkt_obj), bb_obj=curr_bb,
                                    discard_factor=discard_factor, bkt_start=bkt_start, bkt_end=bkt_end,
                                    select_method=select_method, do_bb_pure_factor=do_bb_pure_factor,
                                    do_active_bb_pure_factor=do_active_bb_pure_factor, holding_freq=holding_freq,
@@ -162,6 +168,13 @@ def sf_test_multiple_pools_parallel(factor='default', *, direction='+', bb_obj='
 # exp_w = barra_base.construct_expo_weights(5, 21)
 # mom21 = -ret.rolling(21).apply(lambda x:(x*exp_w).sum())
 
+# # 批量筛选候选因子, 只对排行榜前5的因子做完整的单因子测试
+# from factor_screening import factor_screening
+# fs = factor_screening(stock_pool='zz500', holding_freq='w', start=pd.Timestamp('2009-04-01'),
+#                       end=pd.Timestamp('2017-03-30'))
+# fs.screen({'mom': mom, 'mom21': mom21, 'wq_f4': wq_f4, 'wq_f4_ma': wq_f4_ma})
+# fs.backtest_top_factors(top_n=5, bkt_start=pd.Timestamp('2009-04-01'), bkt_end=pd.Timestamp('2017-03-30'))
+
 # # 短期流动性因子
 # volume = pd.read_csv('Volume.csv',index_col=0,parse_dates=True)
 # freeshares = pd.read_csv('FreeShares.csv',index_col=0,parse_dates=True)
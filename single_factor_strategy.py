@@ -14,8 +14,9 @@ from datetime import datetime
 import os
 import statsmodels.api as sm
 import copy
+import time
 from matplotlib.backends.backend_pdf import PdfPages
-from cvxopt import solvers, matrix
+from cvxopt import solvers, matrix, spmatrix, spdiag
 
 from data import data
 from strategy_data import strategy_data
@@ -23,6 +24,11 @@ from position import position
 from strategy import strategy
 from backtest import backtest
 from barra_base import barra_base
+from risk_model import risk_model
+from factor_qp_solver import factor_qp_solver
+from batch_regression import batch_regression
+from rank_kernel import rank_kernel
+from factor_cache import factor_cache
 
 
 # 单因子表现测试
@@ -40,6 +46,13 @@ class single_factor_strategy(strategy):
         self.strategy_data.stock_price = data.read_data(['FreeMarketValue'],['FreeMarketValue'],shift = True)
         # 用来画图的pdf对象
         self.pdfs = 'default'
+        # 纯因子组合优化中每一期的求解时间和迭代次数
+        self.qp_solve_record = pd.DataFrame()
+        # 单因子测试中各阶段输出的缓存，设为'Empty'则不使用缓存，以及各阶段的运行记录
+        # 每个阶段在每个股票池下只保留最新的stage_cache_keep个缓存条目，设为'default'则不清理
+        self.stage_cache = factor_cache(cache_dir='stage_cache')
+        self.stage_cache_keep = 5
+        self.stage_record = pd.DataFrame(columns=['status', 'run_time'])
         
     # 读取因子数据的函数
     def read_factor_data(self, file_name, factor_name, *, shift = True):
@@ -63,32 +76,20 @@ class single_factor_strategy(strategy):
     # weight=3 为按照因子值加权, 需注意因子是否进行了标准化
     def select_stocks(self, *, select_ratio = [0.8, 1], direction = '+', weight = 0,
                       use_factor_expo = True, expo_weight = 1):
-        # 对调仓期进行循环
-        for cursor, time in self.holding_days.iteritems():
-            curr_factor_data = self.strategy_data.factor.ix[0, time, :]
-            # 对因子值进行排序，注意这里的秩（rank），类似于得分
-            if direction is '+':
-                factor_score = curr_factor_data.rank(ascending = True)
-            elif direction is '-':
-                factor_score = curr_factor_data.rank(ascending = False)
-            else:
-                print('Please enter ''+'' or ''-'' for direction argument')
-            
-            # 取有效的股票数
-            effective_num = curr_factor_data.dropna().size
-            # 无股票可选，进行下一次循环
-            if effective_num == 0:
-                continue
-            # 选取股票的得分范围
-            lower_bound = np.floor(effective_num * select_ratio[0])
-            upper_bound = np.floor(effective_num * select_ratio[1])
-            # 选取股票
-            selected_stocks = curr_factor_data.ix[np.logical_and(factor_score>=lower_bound, 
-                                                                 factor_score<=upper_bound)].index
-            # 被选取的股票都将持仓调为1
-            self.position.holding_matrix.ix[time, selected_stocks] = 1
-            
-        # 循环结束
+        # 所有调仓日的因子值
+        factor_data = self.get_holding_days_factor()
+        # 对因子值进行排序，注意这里的秩（rank），类似于得分，所有调仓日一次排序
+        if direction is '+':
+            factor_score = rank_kernel.get_row_ranks(factor_data.values, ascending=True)
+        elif direction is '-':
+            factor_score = rank_kernel.get_row_ranks(factor_data.values, ascending=False)
+        else:
+            print('Please enter ''+'' or ''-'' for direction argument')
+        # 每一期选取得分在有效股票数的select_ratio范围内的股票，无股票可选的调仓日不选股
+        selected = rank_kernel.get_select_mask(factor_score, select_ratio)
+        # 被选取的股票都将持仓调为1
+        self.set_selected_holding(pd.DataFrame(selected, index=factor_data.index, columns=factor_data.columns))
+
         if self.strategy_data.stock_pool == 'all':
             # 去除不可交易的股票
             self.filter_untradable()
@@ -116,48 +117,49 @@ class single_factor_strategy(strategy):
             self.position.weighted_holding(factor_weight.ix[self.position.holding_matrix.index, :])
         pass
 
+    # 所有调仓日的因子值，即因子数据中调仓日的行，股票与持仓矩阵一致
+    def get_holding_days_factor(self):
+        return self.strategy_data.factor.ix[0].reindex(index=pd.Index(self.holding_days.values),
+                                                       columns=self.position.holding_matrix.columns)
+
+    # 将选股标记为True的股票持仓调为1，其他股票的持仓不变
+    def set_selected_holding(self, selected):
+        selected = selected.reindex(index=self.position.holding_matrix.index,
+                                    columns=self.position.holding_matrix.columns, fill_value=False)
+        self.position.holding_matrix = self.position.holding_matrix.where(np.logical_not(selected.values), 1)
+
     # 分行业选股，跟上面的选股方式一样，只是在每个行业里选固定比例的股票
     # weight等于0为等权，等于1为直接市值加权，等于2则进行行业内与行业间的不同加权
     # inner与outter weights为0，为行业内，行业间等权，为1为行业内，行业间市值加权
     # outter weights为3，为行业间以指数权重加权（若为全市场，则改为市值加权）
+    # industry为行业数据，默认从行业文件中读取
     def select_stocks_within_indus(self, *, select_ratio = [0.8, 1], direction = '+', weight=0, inner_weights=1,
-                                   outter_weights=1):
+                                   outter_weights=1, industry='default'):
         # 读取行业数据：
-        industry = data.read_data(['Industry'], ['Industry'])
-        industry = industry['Industry']
-        # 定义选股的函数
-        def get_stks(factor_data, *, select_ratio=[0.8, 1], direction='+'):
-            holding = pd.Series(0, index=factor_data.index)
-            # 取有效的股票数
-            effective_num = factor_data.dropna().size
-            # 无股票可选，进行下一次循环
-            if effective_num == 0:
-                return holding
-            # 对因子值进行排序，注意这里的秩（rank），类似于得分
-            if direction is '+':
-                factor_score = factor_data.rank(ascending=True)
-            elif direction is '-':
-                factor_score = factor_data.rank(ascending=False)
-            else:
-                print('Please enter ''+'' or ''-'' for direction argument')
-            # 选取股票的得分范围
-            lower_bound = np.floor(effective_num * select_ratio[0])
-            upper_bound = np.floor(effective_num * select_ratio[1])
-            # 选取股票
-            selected_stocks = factor_score.ix[np.logical_and(factor_score >= lower_bound,
-                                                             factor_score <= upper_bound)].index
-            # 被选取的股票都将持仓调为1
-            holding.ix[selected_stocks] = 1
-            return holding
-        # 对调仓期进行循环
-        for cursor, time in self.holding_days.iteritems():
-            # 当前数据
-            curr_data = pd.DataFrame({'factor':self.strategy_data.factor.ix[0, time, :], 'industry':industry.ix[time]})
-            # 根据行业分类选股
-            curr_holding_matrix = curr_data.groupby('industry')['factor'].apply(get_stks, select_ratio=select_ratio,
-                                                                                direction=direction).fillna(0)
-            self.position.holding_matrix.ix[time] = curr_holding_matrix
-            pass
+        if type(industry) == str:
+            industry = data.read_data(['Industry'], ['Industry'])
+            industry = industry['Industry']
+        # 所有调仓日的因子值，以及对应的行业编码，没有行业数据的编码为-1，不属于任何行业，不会被选中
+        factor_data = self.get_holding_days_factor()
+        codes, industry_names = strategy_data.encode_labels(industry.reindex(index=factor_data.index,
+                                                                             columns=factor_data.columns))
+        # 所有调仓日所有行业一次排序，得到每只股票在其行业内的秩，注意这里的秩（rank），类似于得分
+        if direction is '+':
+            factor_score = rank_kernel.get_group_ranks(factor_data.values, codes, ascending=True)
+        elif direction is '-':
+            factor_score = rank_kernel.get_group_ranks(factor_data.values, codes, ascending=False)
+        else:
+            print('Please enter ''+'' or ''-'' for direction argument')
+        # 每只股票所在行业的有效股票数，选股的得分范围由行业内的有效股票数决定
+        group_counts = rank_kernel.get_group_sums(factor_data.values, codes, n_groups=industry_names.size)[1]
+        effective_num = rank_kernel.take_group_values(group_counts, codes)
+        selected = rank_kernel.get_select_mask(factor_score, select_ratio, n_valid=effective_num)
+        # 调仓日的持仓全部替换为选股结果，被选取的股票持仓为1，其余为0
+        selected = pd.DataFrame(selected.astype(np.float64), index=factor_data.index, columns=factor_data.columns)
+        is_holding_day = self.position.holding_matrix.index.isin(factor_data.index)
+        self.position.holding_matrix = self.position.holding_matrix.where(
+            np.broadcast_to(np.logical_not(is_holding_day)[:, np.newaxis], self.position.holding_matrix.shape),
+            selected.reindex(index=self.position.holding_matrix.index))
         # 对不可交易的股票进行过滤
         if self.strategy_data.stock_pool == 'all':
             # 去除不可交易的股票
@@ -203,24 +205,31 @@ class single_factor_strategy(strategy):
             # 当前的其他因子暴露向量，为n*(k-1)，实际就是barra base因子的暴露
             x_sigma = bb_expo.ix[:, time, :].fillna(0)
 
-            # 有协方差矩阵，优先用协方差矩阵
+            # 有协方差矩阵，优先用协方差矩阵，协方差矩阵为风险模型中结构化的协方差矩阵X F X' + D
+            # 用woodbury恒等式计算V^(-1)乘以暴露，不需要计算股票*股票的矩阵
             if type(cov_matrix) != str:
-                inv_v = np.linalg.pinv(cov_matrix.ix[time].fillna(0))
+                risk_expo, curr_factor_cov, curr_spec_var = cov_matrix.get_structured_cov(time)
+                risk_expo = risk_expo.reindex(index=x_alpha.index)
+                # 没有风险模型暴露的股票，将其特质方差设为nan，即不持有这些股票
+                curr_spec_var = curr_spec_var.reindex(index=x_alpha.index).where(risk_expo.notnull().all(1))
+                inv_v_x = risk_model.inv_cov_dot(risk_expo.fillna(0).values, curr_factor_cov.fillna(0).values,
+                    curr_spec_var.values, np.column_stack((x_sigma.values, x_alpha.values)))
             else:
                 assert type(reg_weight) != str, 'The construction of pure factor portfolio require one of following:\n' \
                                                 'Covariance matrix of factor returns (priority), OR \n' \
                                                 'Regression weight when getting factor return using linear regression.\n'
-                # 取当期的回归权重，每只股票的权重在对角线上
-                # inv_v = np.diag(reg_weight.ix[time].fillna(0))
-                curr_weight = reg_weight.ix[time]
+                # 取当期的回归权重，每只股票的权重即为V^(-1)的对角线
+                curr_weight = reg_weight.ix[time].reindex(index=x_alpha.index)
                 curr_weight = (curr_weight/curr_weight.sum()).fillna(0)
-                inv_v = np.diag(curr_weight)
+                inv_v_x = curr_weight.values[:, np.newaxis] * np.column_stack((x_sigma.values, x_alpha.values))
+            inv_v_x_sigma = inv_v_x[:, :-1]
+            inv_v_x_alpha = inv_v_x[:, -1]
 
             # 通过优化的解析解计算权重，解析解公式见barra, Efficient Replication of Factor Returns, equation (6)
-            temp_1 = np.linalg.pinv(np.dot(np.dot(x_sigma.T, inv_v), x_sigma))
-            temp_2 = np.dot(np.dot(x_sigma.T, inv_v), x_alpha)
-            temp_3 = x_alpha - np.dot(np.dot(x_sigma, temp_1), temp_2)
-            h_star = 1/regulation_lambda * np.dot(inv_v, temp_3)
+            # 由于V^(-1)是线性的，V^(-1)(x_alpha - x_sigma * temp) = V^(-1)x_alpha - V^(-1)x_sigma * temp
+            temp_1 = np.linalg.pinv(np.dot(x_sigma.values.T, inv_v_x_sigma))
+            temp_2 = np.dot(x_sigma.values.T, inv_v_x_alpha)
+            h_star = 1/regulation_lambda * (inv_v_x_alpha - np.dot(inv_v_x_sigma, np.dot(temp_1, temp_2)))
 
             # 加权方式只能为这一种，只是需要归一化一下
             self.position.holding_matrix.ix[time] = h_star
@@ -229,8 +238,9 @@ class single_factor_strategy(strategy):
         pass
 
     # 上一种选股方法的优化解法
+    # use_cvxopt为True时用cvxopt求解，否则用结构化协方差矩阵的内点法求解器，并记录每一期的求解时间和迭代次数
     def select_stocks_pure_factor(self, *, base_expo, cov_matrix='Empty', reg_weight='Empty', direction='+',
-                                  benchmark_weight='Empty', is_long_only=True):
+                                  benchmark_weight='Empty', is_long_only=True, use_cvxopt=False):
         # 计算因子值的暴露
         factor_expo = strategy_data.get_cap_wgt_exposure(self.strategy_data.factor.iloc[0],
                                                          self.strategy_data.stock_price.ix['FreeMarketValue'])
@@ -254,27 +264,30 @@ class single_factor_strategy(strategy):
             benchmark_curr_factor_expo = (adjusted_factor_expo * benchmark_weight).sum(1)
             self.strategy_data.factor_expo.ix['factor_expo'] = factor_expo.sub(benchmark_curr_factor_expo, axis=0)
 
+        # 求解器，连续的调仓日之间用上一期的解作为初始值
+        qp_solver = factor_qp_solver()
         # 循环调仓日
         for cursor, time in self.holding_days.iteritems():
             curr_factor_expo = self.strategy_data.factor_expo.ix['factor_expo', time, :]
             curr_base_expo = base_expo.ix[:, time, :]
 
-            # 有协方差矩阵，优先用协方差矩阵
+            # 有协方差矩阵，优先用协方差矩阵，协方差矩阵为风险模型中结构化的协方差矩阵X F X' + D
             if type(cov_matrix) != str:
-                curr_v = cov_matrix.ix[time]
-                curr_v_diag = curr_v.diagonal()
-                # 去除有nan的数据
-                all_data = pd.concat([curr_v_diag, curr_factor_expo, curr_base_expo], axis=1)
-                all_data = all_data.dropna()
+                risk_expo, curr_factor_cov, curr_spec_var = cov_matrix.get_structured_cov(time)
+                # 去除有nan的数据，以及没有风险模型暴露的股票
+                all_data = pd.concat([curr_spec_var.where(curr_spec_var > 0), curr_factor_expo, curr_base_expo],
+                                     axis=1)
+                all_data = all_data.reindex(index=risk_expo.dropna().index).dropna()
                 # 如果有效数据小于等于1，当期不选股票
                 if all_data.shape[0] <= 1:
                     continue
                 # 指数中选股可能会出现一个行业暴露全是0的情况，所以关于这个行业的限制条件会冗余，于是要进行剔除
                 all_data = all_data.replace(0, np.nan).dropna(axis=1, how='all').fillna(0.0)
-                curr_factor_expo = all_data.ix[:, 0]
-                curr_v_diag = all_data.ix[:, 1]
+                curr_v_diag = all_data.ix[:, 0]
+                curr_factor_expo = all_data.ix[:, 1]
                 curr_base_expo = all_data.ix[:, 2:]
-                curr_v = curr_v.reindex(index=curr_v_diag.index, columns=curr_v_diag.index)
+                risk_expo = risk_expo.reindex(index=all_data.index)
+                curr_factor_cov = curr_factor_cov.fillna(0.0)
             else:
                 assert type(reg_weight) != str, 'The construction of pure factor portfolio require one of following:\n' \
                                                 'Covariance matrix of factor returns (priority), OR \n' \
@@ -292,10 +305,12 @@ class single_factor_strategy(strategy):
                 curr_v_diag = all_data.ix[:, 0]
                 curr_factor_expo = all_data.ix[:, 1]
                 curr_base_expo = all_data.ix[:, 2:]
-                # 将回归权重归一化
+                # 将回归权重归一化，方差为回归权重的倒数，回归权重为0的股票方差为0（与对对角矩阵求伪逆一致）
                 curr_v_diag = curr_v_diag / curr_v_diag.sum()
-                curr_v = np.linalg.pinv(np.diag(curr_v_diag))
-                curr_v = pd.DataFrame(curr_v, index=curr_factor_expo.index, columns=curr_factor_expo.index)
+                curr_v_diag = curr_v_diag.where(curr_v_diag == 0, 1 / curr_v_diag)
+                # 没有因子部分的协方差
+                risk_expo = pd.DataFrame(index=all_data.index)
+                curr_factor_cov = pd.DataFrame()
 
             # 设置其他因子为0的限制条件，在有基准的时候，设置为基准的暴露
             if type(benchmark_weight) != str:
@@ -303,40 +318,67 @@ class single_factor_strategy(strategy):
             else:
                 expo_target = pd.Series(0.0, index=curr_base_expo.columns)
 
-            # 开始设置优化
-            # P = V
-            P = matrix(curr_v.as_matrix())
-            # q = - (factor_expo.T)
-            q = matrix(-curr_factor_expo.as_matrix().transpose())
-
-            # 其他因为暴露为0，或等于基准的限制条件
-            A = matrix(curr_base_expo.as_matrix().transpose())
-            b = matrix(expo_target.as_matrix())
-
-            solvers.options['show_progress'] = False
-
-            # 如果只能做多，则每只股票的比例都必须大于等于0
-            if is_long_only:
-                long_only_constraint = pd.DataFrame(-1.0*np.eye(curr_factor_expo.size), index=curr_factor_expo.index,
-                                                   columns=curr_factor_expo.index)
-                long_only_target = pd.Series(0.0, index=curr_factor_expo.index)
-
-                G = matrix(long_only_constraint.as_matrix())
-                h = matrix(long_only_target.as_matrix())
-
-                # 解优化问题
-                results = solvers.qp(P=P, q=q, A=A, b=b, G=G,  h=h)
+            n_stocks = curr_factor_expo.size
+            n_risk_factors = risk_expo.shape[1]
+            # 默认用结构化协方差矩阵的内点法求解器，做多的限制作为变量的下界，并用上一期的解作为初始值
+            if not use_cvxopt:
+                # 方差为0的股票无法放入求解器，不持有这些股票
+                is_positive_var = curr_v_diag > 0
+                if n_risk_factors > 0:
+                    curr_risk_expo = risk_expo[is_positive_var]
+                else:
+                    curr_risk_expo = 'Empty'
+                results_s = qp_solver.solve(q=curr_factor_expo[is_positive_var],
+                                            spec_var=curr_v_diag[is_positive_var], a=curr_base_expo[is_positive_var],
+                                            b=expo_target, x=curr_risk_expo, factor_cov=curr_factor_cov,
+                                            lb=0.0 if is_long_only else -np.inf, record_name=time)
             else:
-                results = solvers.qp(P=P, q=q, A=A, b=b)
-
-            results_np = np.array(results['x']).squeeze()
-            results_s = pd.Series(results_np, index=curr_factor_expo.index)
+                # 开始设置优化，协方差矩阵为X F X' + D，引入辅助变量y = X' h，变量为(h, y)
+                # 目标函数为1/2 * (h' D h + y' F y) - factor_expo' h，这样P为稀疏的分块对角矩阵，不需要n*n的稠密矩阵
+                # P = diag(D, F)
+                if n_risk_factors > 0:
+                    P = spdiag([spdiag(matrix(curr_v_diag.values)), matrix(curr_factor_cov.values)])
+                else:
+                    P = spdiag(matrix(curr_v_diag.values))
+                # q = - (factor_expo.T, 0)
+                q = matrix(np.concatenate((-curr_factor_expo.values, np.zeros(n_risk_factors))))
+
+                # 其他因为暴露为0，或等于基准的限制条件，以及辅助变量的限制条件X' h - y = 0
+                n_base_factors = curr_base_expo.shape[1]
+                A_np = np.zeros((n_base_factors + n_risk_factors, n_stocks + n_risk_factors))
+                A_np[:n_base_factors, :n_stocks] = curr_base_expo.values.T
+                A_np[n_base_factors:, :n_stocks] = risk_expo.values.T
+                A_np[n_base_factors:, n_stocks:] = - np.eye(n_risk_factors)
+                A = matrix(A_np)
+                b = matrix(np.concatenate((expo_target.values, np.zeros(n_risk_factors))))
+
+                solvers.options['show_progress'] = False
+
+                # 如果只能做多，则每只股票的比例都必须大于等于0，用稀疏矩阵表示-I
+                if is_long_only:
+                    G = spmatrix(-1.0, range(n_stocks), range(n_stocks), (n_stocks, n_stocks + n_risk_factors))
+                    h = matrix(np.zeros(n_stocks))
+
+                    # 解优化问题
+                    results = solvers.qp(P=P, q=q, A=A, b=b, G=G,  h=h)
+                else:
+                    results = solvers.qp(P=P, q=q, A=A, b=b)
+
+                results_np = np.array(results['x']).squeeze()[:n_stocks]
+                results_s = pd.Series(results_np, index=curr_factor_expo.index)
             # 重索引为所有股票代码
             results_s = results_s.reindex(self.strategy_data.stock_price.minor_axis, fill_value=0)
 
             # 股票持仓
             self.position.holding_matrix.ix[time] = results_s
 
+        # 每一期的求解时间和迭代次数
+        if not use_cvxopt:
+            self.qp_solve_record = qp_solver.solve_record
+            print('Pure factor portfolio optimization completed, total time: {0:.2f}s, average iterations: {1:.1f}, '
+                  'not converged: {2}\n'.format(self.qp_solve_record['solve_time'].sum(),
+                  self.qp_solve_record['iterations'].mean(), (self.qp_solve_record['status'] != 'optimal').sum()))
+
         # 循环结束后，进行权重归一化
         self.position.to_percentage()
         pass
@@ -369,26 +411,17 @@ class single_factor_strategy(strategy):
         # 注意因子暴露要用前一期的数据
         holding_day_factor_expo = holding_day_factor_expo.shift(1)
 
-        # 初始化因子收益序列以及估计量的t统计量序列
-        factor_return_series = np.empty(holding_days.size)*np.nan
-        t_stats_series = np.empty(holding_days.size)*np.nan
-        self.factor_return_series = pd.Series(factor_return_series, index=holding_days)
-        self.t_stats_series = pd.Series(t_stats_series, index=holding_days)
-
-        # 进行回归，对调仓日进行循环
-        for cursor, time in holding_days.iteritems():
-
-            y = holding_day_return.ix[time, :]
-            x = holding_day_factor_expo.ix[time, :]
-            if y.isnull().all() or x.isnull().all():
-                continue
-            x = sm.add_constant(x)
-            if weights is 'default':
-                results = sm.WLS(y, x, missing='drop').fit()
-            else:
-                results = sm.WLS(y, x, weights=weights.ix[time], missing='drop').fit()
-            self.factor_return_series.ix[time] = results.params[1]
-            self.t_stats_series.ix[time] = results.tvalues[1]
+        # 进行回归，所有调仓日的回归用批量回归一次完成，第一个变量为截距项
+        if type(weights) != str:
+            reg_weights = weights.reindex(index=holding_days, columns=holding_day_return.columns).values
+        else:
+            reg_weights = 'default'
+        # 没有任何有效数据的调仓日，因子收益和t统计量为nan
+        params, t_stats = batch_regression.batch_wls(holding_day_return.values,
+            holding_day_factor_expo.reindex(columns=holding_day_return.columns).values[np.newaxis, :, :],
+            weights=reg_weights, add_constant=True, min_obs=0)[1:3]
+        self.factor_return_series = pd.Series(params[:, 1], index=holding_days)
+        self.t_stats_series = pd.Series(t_stats[:, 1], index=holding_days)
 
         # 如果方向为负，则将因子收益和t统计量加个负号
         if direction == '-':
@@ -453,33 +486,23 @@ class single_factor_strategy(strategy):
             holding_days = holding_days[start:]
         if end != 'default':
             holding_days = holding_days[:end]
-        # 初始化ic矩阵
-        ic_series = np.empty(holding_days.size)*np.nan
-        self.ic_series = pd.Series(ic_series, index = holding_days)
         # 计算股票对数收益，提取因子值，同样的，因子值要用前一期的因子值
         holding_day_price = self.strategy_data.stock_price.ix['ClosePrice_adj',holding_days,:]
         holding_day_return = np.log(holding_day_price.div(holding_day_price.shift(1)))
         holding_day_factor = self.strategy_data.factor.ix[0, holding_days, :]
         holding_day_factor = holding_day_factor.shift(1)
-        # 对调仓日进行循环
-        for cursor, time in holding_days.iteritems():
-            # 计算因子值的排序
-            curr_factor_data = holding_day_factor.ix[time, :]
-            # 对因子值进行排序，注意这里的秩（rank），类似于得分
-            if direction is '+':
-                factor_score = curr_factor_data.rank(ascending = True)
-            elif direction is '-':
-                factor_score = curr_factor_data.rank(ascending = False)
-            else:
-                print('Please enter ''+'' or ''-'' for direction argument')
-            
-            # 对因子实现的对数收益率进行排序，升序排列，因此同样，秩类似于得分
-            return_score = holding_day_return.ix[time, :].rank(ascending = True)
-            
-            # 计算得分（秩）之间的线性相关系数，就是秩相关系数
-            self.ic_series.ix[time] = factor_score.corr(return_score, method = 'pearson')
-            
-        # 循环结束
+        # 所有调仓日一次计算，对因子值进行排序，注意这里的秩（rank），类似于得分
+        if direction is '+':
+            factor_score = rank_kernel.get_row_ranks(holding_day_factor.values, ascending=True)
+        elif direction is '-':
+            factor_score = rank_kernel.get_row_ranks(holding_day_factor.values, ascending=False)
+        else:
+            print('Please enter ''+'' or ''-'' for direction argument')
+        # 对因子实现的对数收益率进行排序，升序排列，因此同样，秩类似于得分
+        return_score = rank_kernel.get_row_ranks(holding_day_return.values, ascending=True)
+        # 计算得分（秩）之间的线性相关系数，就是秩相关系数
+        self.ic_series = pd.Series(rank_kernel.get_row_corr(factor_score, return_score), index=holding_days)
+
         # 输出结果
         target_str = 'The average IC of this factor: {0:.4f}\n'.format(self.ic_series.mean())
         print(target_str)
@@ -501,39 +524,99 @@ class single_factor_strategy(strategy):
         if type(self.pdfs) != str:
             plt.savefig(self.pdfs, format='pdf')
         
+    # 因子IC的衰减分析，以调仓日为信号日，计算因子值与信号日后lag个交易日开始，horizon个交易日的对数收益之间的秩相关系数
+    # 所有期限的收益都由一次计算得到的累计对数收益相减得到，所有信号日的IC都一次算出，返回平均IC和IC_IR的表，
+    # 表的行为收益的期限，列为延后的交易日数
+    def get_ic_decay(self, *, horizons=[1, 5, 20, 60], lags=[0, 1, 5, 20], holding_freq='m', direction='+',
+                     start='default', end='default'):
+        """ Get the table of IC decay of the factor.
+
+        :param horizons: (list) numbers of trading days of forward returns
+        :param lags: (list) numbers of trading days between signal days and the start of forward returns
+        :param holding_freq: (str) frequency of signal days
+        :param direction: (str) direction of the factor, '+' or '-'
+        :param start: (str) start date of signal days
+        :param end: (str) end date of signal days
+        :return: (list) [ic_mean, ic_ir], horizons*lags dataframes
+        """
+        if 'ClosePrice_adj' not in self.strategy_data.stock_price.items:
+            temp_panel = data.read_data(['ClosePrice_adj'], ['ClosePrice_adj'], shift=True)
+            self.strategy_data.stock_price['ClosePrice_adj'] = temp_panel.ix['ClosePrice_adj']
+        # 信号日，与get_factor_ic一致
+        signal_days = strategy.resample_tradingdays(self.strategy_data.stock_price. \
+                                                    ix['FreeMarketValue', :, 0], freq=holding_freq)
+        if start != 'default':
+            signal_days = signal_days[start:]
+        if end != 'default':
+            signal_days = signal_days[:end]
+        # 所有交易日的累计对数收益，某段时间的对数收益即为两端累计对数收益之差
+        price = self.strategy_data.stock_price.ix['ClosePrice_adj']
+        cum_log_return = np.log(price.values.astype(np.float64))
+        signal_loc = price.index.get_indexer(signal_days)
+        signal_loc = signal_loc[signal_loc >= 0]
+        # 信号日的因子值的秩只需要计算一次
+        factor_value = self.strategy_data.factor.ix[0].reindex(index=price.index, columns=price.columns).values
+        if direction is '+':
+            factor_score = rank_kernel.get_row_ranks(factor_value[signal_loc], ascending=True)
+        elif direction is '-':
+            factor_score = rank_kernel.get_row_ranks(factor_value[signal_loc], ascending=False)
+        else:
+            print('Please enter ''+'' or ''-'' for direction argument')
+
+        ic_mean = pd.DataFrame(np.nan, index=horizons, columns=lags)
+        ic_ir = pd.DataFrame(np.nan, index=horizons, columns=lags)
+        for horizon in horizons:
+            for lag in lags:
+                # 收益期结束超过数据范围的信号日的IC为nan
+                begin_loc = signal_loc + lag
+                end_loc = begin_loc + horizon
+                in_range = end_loc < price.shape[0]
+                forward_return = np.full(factor_score.shape, np.nan)
+                forward_return[in_range] = cum_log_return[end_loc[in_range]] - cum_log_return[begin_loc[in_range]]
+                return_score = rank_kernel.get_row_ranks(forward_return, ascending=True)
+                ic = pd.Series(rank_kernel.get_row_corr(factor_score, return_score))
+                ic_mean.ix[horizon, lag] = ic.mean()
+                ic_ir.ix[horizon, lag] = ic.mean() / ic.std()
+        ic_mean.index.name = 'horizon'
+        ic_mean.columns.name = 'lag'
+        ic_ir.index.name = 'horizon'
+        ic_ir.columns.name = 'lag'
+        self.ic_decay = ic_mean
+
+        target_str = 'The IC decay of this factor:\n{0}\nThe IC_IR decay of this factor:\n{1}\n'.format(
+            ic_mean.to_string(float_format='{0:.4f}'.format), ic_ir.to_string(float_format='{0:.4f}'.format))
+        print(target_str)
+        with open(str(os.path.abspath('.'))+'/'+self.strategy_data.stock_pool+'/performance.txt',
+                  'a', encoding='GB18030') as text_file:
+            text_file.write(target_str)
+        return [ic_mean, ic_ir]
+
+    # 所有调仓日的分位数分组标签，标签从0开始，分组标签越小的总是在最有利的方向上，无因子值的股票标签为nan
+    # 所有分组的标签由一次排序得到，画分位数图时各组选股共用同一个标签
+    def get_qgroup_labels(self, no_of_groups, *, direction='+'):
+        factor_data = self.get_holding_days_factor()
+        # 对因子值的排序进行调整，使得分组标签越小的总是在最有利的方向上
+        if direction is '+':
+            ascending = False
+        elif direction is '-':
+            ascending = True
+        else:
+            print('Please enter ''+'' or ''-'' for direction argument')
+        # # 进行qcut
+        # labeled_factor = pd.qcut(curr_factor_data, no_of_groups, labels = False)
+        # 按pct rank分组，以避免pandas.qcut的unique bin edge error
+        labels = rank_kernel.get_qcut_labels(factor_data.values, no_of_groups, ascending=ascending)
+        return pd.DataFrame(labels, index=factor_data.index, columns=factor_data.columns)
+
     # 根据分位数分组选股，用来画同一因子不同分位数分组之间的收益率对比，以此判断因子的有效性
-    def select_qgroup(self, no_of_groups, group, *, direction = '+', weight = 0):
-        # 对调仓期进行循环
-        for cursor, time in self.holding_days.iteritems():
-            curr_factor_data = self.strategy_data.factor.ix[0, time, :]
-            # 无股票可选，则直接进行下一次循环
-            if curr_factor_data.dropna().empty:
-                continue
-            # 对因子值进行调整，使得其在qcut后，分组标签越小的总是在最有利的方向上
-            if direction is '+':
-                curr_factor_data = -curr_factor_data
-            elif direction is '-':
-                pass
-            else:
-                print('Please enter ''+'' or ''-'' for direction argument')
-                
-            # # 进行qcut
-            # labeled_factor = pd.qcut(curr_factor_data, no_of_groups, labels = False)
-
-            # This is a temporary solution to pandas.qcut's unique bin edge error.
-            # It will be removed when pandas 0.20.0 releases, which gives an additional parameter to handle this problem
-            def pct_rank_qcut(series, n):
-                edges = pd.Series([float(i) / n for i in range(n + 1)])
-                f = lambda x: (edges >= x).argmax()-1
-                return series.rank(pct=1).apply(f).reindex(series.index)
-            labeled_factor = pct_rank_qcut(curr_factor_data.dropna(), no_of_groups).reindex(curr_factor_data.index)
-
-            # 选取指定组的股票，注意标签是0开始，传入参数是1开始，因此需要减1
-            selected_stocks = curr_factor_data.ix[labeled_factor == group-1].index
-            # 被选取股票的持仓调为1
-            self.position.holding_matrix.ix[time, selected_stocks] = 1
-
-        # 循环结束
+    # labels为get_qgroup_labels得到的分组标签，默认为根据当前因子重新计算
+    def select_qgroup(self, no_of_groups, group, *, direction = '+', weight = 0, labels = 'Empty'):
+        if type(labels) == str:
+            labels = self.get_qgroup_labels(no_of_groups, direction=direction)
+        # 选取指定组的股票，注意标签是0开始，传入参数是1开始，因此需要减1
+        # 被选取股票的持仓调为1
+        self.set_selected_holding(labels == group - 1)
+
         if self.strategy_data.stock_pool == 'all':
             # 去除不可交易的股票
             self.filter_untradable()
@@ -551,6 +634,8 @@ class single_factor_strategy(strategy):
     # 定义按因子分位数选股的函数，将不同分位数收益率画到一张图上，同时还会画long-short的图
     # value=1为画净值曲线图，value=2为画对数收益率图，weight=0为等权，=1为市值加权
     def plot_qgroup(self, bkt, no_of_groups, *, direction='+', value=1, weight=0):
+        # 所有分组共用一次排序得到的分组标签
+        labels = self.get_qgroup_labels(no_of_groups, direction=direction)
         # 默认画净值曲线图
         if value == 1:
             # 先初始化图片
@@ -564,12 +649,12 @@ class single_factor_strategy(strategy):
             for group in range(no_of_groups):
                 # 选股
                 self.reset_position()
-                self.select_qgroup(no_of_groups, group + 1, direction=direction, weight=weight)
+                self.select_qgroup(no_of_groups, group + 1, direction=direction, weight=weight, labels=labels)
 
                 # 回测
                 bkt.enable_warning = False
                 bkt.reset_bkt_position(self.position)
-                bkt.execute_backtest()
+                self.execute_cached_backtest(bkt, name='qgroup_backtest_' + str(group + 1))
                 bkt.initialize_performance()
 
                 # 画图，注意，这里画净值曲线图，差异很小时，净值曲线图的差异更明显
@@ -609,12 +694,12 @@ class single_factor_strategy(strategy):
             for group in range(no_of_groups):
                 # 选股
                 self.reset_position()
-                self.select_qgroup(no_of_groups, group + 1, direction=direction, weight=weight)
+                self.select_qgroup(no_of_groups, group + 1, direction=direction, weight=weight, labels=labels)
 
                 # 回测
                 bkt.enable_warning = False
                 bkt.reset_bkt_position(self.position)
-                bkt.execute_backtest()
+                self.execute_cached_backtest(bkt, name='qgroup_backtest_' + str(group + 1))
                 bkt.initialize_performance()
 
                 # 画图，注意，这里画累积对数收益图，当差异很大时，累积对数收益图看起来更容易
@@ -711,12 +796,59 @@ class single_factor_strategy(strategy):
                                      use_factor_expo=use_factor_expo, expo_weight=expo_weight)
 
 
+    # 运行单因子测试中的一个阶段，并记录其用时
+    # inputs不为空时，阶段的输出按输入数据的版本，参数，股票池以及策略类缓存，输入不变时直接读取缓存，不再重新计算
+    # calc_func计算时会直接修改策略的状态，并返回要缓存的输出，读取缓存时，由调用者将输出设置回策略中
+    def run_stage(self, name, calc_func, *, inputs={}, params={}):
+        start_time = time.time()
+        if type(self.stage_cache) == str or len(inputs) == 0:
+            outcome = calc_func()
+            status = 'computed'
+        else:
+            entry = factor_cache.get_entry('stage_' + name, inputs=inputs,
+                                           params=dict(params, strategy=type(self).__name__),
+                                           stock_pool=self.strategy_data.stock_pool)
+            if self.stage_cache.has(entry):
+                outcome = self.stage_cache.load(entry)
+                status = 'cached'
+            else:
+                outcome = calc_func()
+                self.stage_cache.save(entry, outcome)
+                if self.stage_cache_keep != 'default':
+                    self.stage_cache.prune(name='stage_' + name, keep_latest=self.stage_cache_keep, by_params=False)
+                status = 'computed'
+        self.stage_record.ix[name] = [status, time.time() - start_time]
+        return outcome
+
+    # 执行回测，回测结果按目标持仓，基准，回测数据中的所有价格和可交易标记以及回测参数缓存，
+    # 持仓不变时（如只改变了选股方法时的分位数组合）直接读取缓存
+    def execute_cached_backtest(self, bkt, *, name='backtest'):
+        def calc_backtest():
+            bkt.execute_backtest()
+            return [bkt.real_vol_position.holding_matrix, bkt.real_pct_position.holding_matrix, bkt.cash,
+                    bkt.account_value, bkt.benchmark_value, bkt.info_series]
+        inputs = {'tar_holding': bkt.tar_pct_position.holding_matrix, 'benchmark': bkt.benchmark_value}
+        for item in bkt.bkt_data.stock_price.items:
+            inputs['stock_price_' + str(item)] = bkt.bkt_data.stock_price.ix[item]
+        for item in bkt.bkt_data.if_tradable.items:
+            inputs['if_tradable_' + str(item)] = bkt.bkt_data.if_tradable.ix[item]
+        outcome = self.run_stage(name, calc_backtest, inputs=inputs,
+                                 params={'bkt_start': bkt.bkt_start, 'bkt_end': bkt.bkt_end,
+                                         'initial_money': bkt.initial_money, 'trade_ratio': bkt.trade_ratio,
+                                         'buy_cost': bkt.buy_cost, 'sell_cost': bkt.sell_cost})
+        bkt.real_vol_position.holding_matrix, bkt.real_pct_position.holding_matrix, bkt.cash, \
+            bkt.account_value, bkt.benchmark_value, bkt.info_series = outcome
+
     # 根据一个股票池进行一次完整的单因子测试的函数
     # select method为单因子测试策略的选股方式，0为按比例选股，1为分行业按比例选股
     def single_factor_test(self, *, factor='default', direction='+', bkt_obj='Empty', bb_obj='Empty',
                            pa_benchmark_weight='default', discard_factor=[], bkt_start='default', bkt_end='default',
                            stock_pool='all', select_method=0, do_pa=True, do_active_pa=False, do_bb_pure_factor=False,
                            do_active_bb_pure_factor=False, holding_freq='m', do_data_description=False):
+        # 测试分为几个阶段, 记录每个阶段的用时, 提纯, 选股和回测阶段的输出按其输入缓存, 输入不变的阶段不再重新计算
+        self.stage_record = pd.DataFrame(columns=['status', 'run_time'])
+        stage_start_time = time.time()
+
         ###################################################################################################
         # 生成调仓日和生成可投资标记是第一件事, 因为之后包括因子构建的函数都要用到它
 
@@ -789,6 +921,7 @@ class single_factor_strategy(strategy):
             os.makedirs(str(os.path.abspath('.')) + '/' + self.strategy_data.stock_pool + '/')
         # 建立画pdf的对象
         self.pdfs = PdfPages(str(os.path.abspath('.')) + '/' + self.strategy_data.stock_pool + '/allfigs.pdf')
+        self.stage_record.ix['prepare'] = ['computed', time.time() - stage_start_time]
 
         ###################################################################################################
         # 第四部分为, 1. 若各策略类有对原始因子数据的计算等, 可以在data description中进行
@@ -798,7 +931,7 @@ class single_factor_strategy(strategy):
 
         # 如果有对原始数据的表述,则进行原始数据表述
         if do_data_description:
-            self.data_description()
+            self.run_stage('data_description', self.data_description)
             print('Data description completed...\n')
 
         # # 根据某一base, 做当前因子与其他因子的相关性检验
@@ -806,49 +939,82 @@ class single_factor_strategy(strategy):
         #     self.get_factor_corr_test()
 
         # 如果要做基于barra base的纯因子组合，则要对因子进行提纯
+        # 提纯的输出只与因子, bb的因子数据和市值有关, 与选股方法和回测参数无关
         if do_bb_pure_factor:
-            self.get_pure_factor(bb_obj, do_active_bb_pure_factor=do_active_bb_pure_factor)
+            def calc_pure_factor():
+                self.get_pure_factor(bb_obj, do_active_bb_pure_factor=do_active_bb_pure_factor)
+                return self.strategy_data.factor.iloc[0]
+            self.strategy_data.factor.iloc[0] = self.run_stage('pure_factor', calc_pure_factor,
+                inputs={'factor': self.strategy_data.factor.iloc[0], 'bb_factor': bb_obj.bb_data.factor.values,
+                        'mv': self.strategy_data.stock_price.ix['FreeMarketValue']},
+                params={'do_active_bb_pure_factor': do_active_bb_pure_factor})
 
         ###################################################################################################
         # 第五部分为, 1.根据不同的单因子选股策略, 进行选股
         # 2. 对策略选出的股票进行回测, 画图
         # 3. 如果有归因, 则对策略选出的股票进行归因
 
-        # 按策略进行选股
-        if select_method == 0:
-            # 简单分位数选股
-            self.select_stocks(weight=1, direction=direction, select_ratio=[0.8, 1])
-        elif select_method == 1:
-            # 分行业选股
-            self.select_stocks_within_indus(weight=2, direction=direction)
-        elif select_method == 2 or select_method == 3:
-            # 用构造纯因子组合的方法选股，2为组合自己是纯因子组合，3为组合相对基准是纯因子组合
+        # 选股的输出为持仓矩阵, 与因子, 调仓日, 市值, 可交易与可投资标记, 选股方法和方向有关,
+        # 分行业选股时还与行业数据（以及非全市场时的基准权重）有关, 用纯因子组合选股时还与bb的因子数据, 因子暴露以及基准权重有关
+        # 因此行业数据, bb的因子暴露和基准权重在选股之前取出, 与其他输入一起计入选股阶段的缓存
+        if select_method == 1:
+            industry = data.read_data(['Industry'], ['Industry'])
+            industry = industry['Industry']
+        if select_method == 2 or select_method == 3:
             # 首先和计算纯因子一样，要计算bb因子的暴露
             if bb_obj.bb_data.factor_expo.empty:
                 bb_obj.just_get_factor_expo()
-            # 同样需要lag
-            lag_bb_expo = bb_obj.bb_data.factor_expo.shift(1).reindex(major_axis=bb_obj.bb_data.factor_expo.major_axis)
-            # 同样不能有country factor
-            lag_bb_expo_no_cf = lag_bb_expo.drop('country_factor', axis=0)
-            # # 构造纯因子组合，权重使用回归权重，即市值的根号
-            # 初始化temp weight为'Empty'，即如果选股方法是2，则传入默认的benchmark weight
-            temp_weight = 'Empty'
-            if select_method == 2:
-                # self.select_stocks_pure_factor_bb(bb_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
-                #     self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction)
-                self.select_stocks_pure_factor(base_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
-                    self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction,
-                                               benchmark_weight=temp_weight, is_long_only=False)
-            if select_method == 3 and self.strategy_data.stock_pool == 'all':
-                temp_weight = data.read_data(['Weight_zz500'], ['Weight_zz500'], shift=True)
-                temp_weight = temp_weight['Weight_zz500']
-            elif select_method == 3 and self.strategy_data.stock_pool != 'all':
-                # 注意股票池为非全市场时，基准的权重数据已经shift过了
-                temp_weight = self.strategy_data.benchmark_price.ix['Weight_'+self.strategy_data.stock_pool]
-            if select_method == 3:
-                self.select_stocks_pure_factor(base_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
-                    self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction,
-                    benchmark_weight=temp_weight, is_long_only=True)
+        # 初始化temp weight为'Empty'，即如果选股方法是2，则传入默认的benchmark weight
+        temp_weight = 'Empty'
+        if select_method == 3 and self.strategy_data.stock_pool == 'all':
+            temp_weight = data.read_data(['Weight_zz500'], ['Weight_zz500'], shift=True)
+            temp_weight = temp_weight['Weight_zz500']
+        elif select_method == 3 and self.strategy_data.stock_pool != 'all':
+            # 注意股票池为非全市场时，基准的权重数据已经shift过了
+            temp_weight = self.strategy_data.benchmark_price.ix['Weight_'+self.strategy_data.stock_pool]
+
+        def calc_select():
+            # 按策略进行选股
+            if select_method == 0:
+                # 简单分位数选股
+                self.select_stocks(weight=1, direction=direction, select_ratio=[0.8, 1])
+            elif select_method == 1:
+                # 分行业选股
+                self.select_stocks_within_indus(weight=2, direction=direction, industry=industry)
+            elif select_method == 2 or select_method == 3:
+                # 用构造纯因子组合的方法选股，2为组合自己是纯因子组合，3为组合相对基准是纯因子组合
+                # 同样需要lag
+                lag_bb_expo = bb_obj.bb_data.factor_expo.shift(1).reindex(major_axis=bb_obj.bb_data.factor_expo.major_axis)
+                # 同样不能有country factor
+                lag_bb_expo_no_cf = lag_bb_expo.drop('country_factor', axis=0)
+                # # 构造纯因子组合，权重使用回归权重，即市值的根号
+                if select_method == 2:
+                    # self.select_stocks_pure_factor_bb(bb_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
+                    #     self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction)
+                    self.select_stocks_pure_factor(base_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
+                        self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction,
+                                                   benchmark_weight=temp_weight, is_long_only=False)
+                if select_method == 3:
+                    self.select_stocks_pure_factor(base_expo=lag_bb_expo_no_cf, reg_weight=np.sqrt(
+                        self.strategy_data.stock_price.ix['FreeMarketValue']), direction=direction,
+                        benchmark_weight=temp_weight, is_long_only=True)
+            return self.position.holding_matrix
+        select_inputs = {'factor': self.strategy_data.factor.iloc[0], 'holding_days': self.holding_days,
+                         'mv': self.strategy_data.stock_price.ix['FreeMarketValue'],
+                         'if_tradable': self.strategy_data.if_tradable.ix['if_tradable'],
+                         'if_inv': self.strategy_data.if_tradable.ix['if_inv']}
+        if select_method == 1:
+            select_inputs['industry'] = industry
+            if self.strategy_data.stock_pool != 'all':
+                select_inputs['benchmark_weight'] = self.strategy_data.benchmark_price.ix[
+                    'Weight_'+self.strategy_data.stock_pool]
+        if select_method == 2 or select_method == 3:
+            select_inputs['bb_factor'] = bb_obj.bb_data.factor.values
+            select_inputs['bb_factor_expo'] = bb_obj.bb_data.factor_expo.values
+        if select_method == 3:
+            select_inputs['benchmark_weight'] = temp_weight
+        self.position.holding_matrix = self.run_stage('select', calc_select, inputs=select_inputs,
+            params={'select_method': select_method, 'direction': direction})
 
         # ------------------------------------------------------------------------------------
         # holding = pd.read_csv('HOLDING500.csv', index_col=0, parse_dates=True)
@@ -872,8 +1038,8 @@ class single_factor_strategy(strategy):
             bkt_obj.reset_bkt_benchmark(['ClosePrice_adj_' + stock_pool])
         
         # 回测、画图、归因
-        bkt_obj.execute_backtest()
-        bkt_obj.get_performance(foldername=stock_pool, pdfs=self.pdfs)
+        self.execute_cached_backtest(bkt_obj)
+        self.run_stage('performance', lambda: bkt_obj.get_performance(foldername=stock_pool, pdfs=self.pdfs))
 
         # 如果要进行归因的话
         if do_pa:
@@ -888,10 +1054,10 @@ class single_factor_strategy(strategy):
                 temp_weight = data.read_data(['Weight_zz500'], ['Weight_zz500'])
                 pa_benchmark_weight = temp_weight['Weight_zz500']
             # 注意bb obj进行了一份深拷贝，这是因为在业绩归因的计算中，会根据不同的股票池丢弃数据，导致数据不全，因此不能传引用
-            bkt_obj.get_performance_attribution(outside_bb=bb_obj, benchmark_weight=pa_benchmark_weight,
-                                                discard_factor=discard_factor, show_warning=False,
-                                                foldername=stock_pool, pdfs=self.pdfs, is_real_world=False,
-                                                real_world_type=2, enable_reading_pa_return=False)
+            self.run_stage('pa', lambda: bkt_obj.get_performance_attribution(outside_bb=bb_obj,
+                benchmark_weight=pa_benchmark_weight, discard_factor=discard_factor, show_warning=False,
+                foldername=stock_pool, pdfs=self.pdfs, is_real_world=False, real_world_type=2,
+                enable_reading_pa_return=False))
 
         ###################################################################################################
         # 第六部分为, 1. 根据回归算单因子的纯因子组合收益率
@@ -900,18 +1066,32 @@ class single_factor_strategy(strategy):
         # 4. 画单因子策略n分位图的long-short图
 
         # 画单因子组合收益率
-        self.get_factor_return(weights=np.sqrt(self.strategy_data.stock_price.ix['FreeMarketValue']),
-                               holding_freq='w', direction=direction, start=bkt_start, end=bkt_end)
+        self.run_stage('factor_return', lambda: self.get_factor_return(
+            weights=np.sqrt(self.strategy_data.stock_price.ix['FreeMarketValue']), holding_freq='w',
+            direction=direction, start=bkt_start, end=bkt_end))
         # 画ic的走势图
-        self.get_factor_ic(direction=direction, holding_freq='w', start=bkt_start, end=bkt_end)
-        # 画分位数图和long short图
-        self.plot_qgroup(bkt_obj, 3, direction=direction, value=1, weight=1)
+        self.run_stage('factor_ic', lambda: self.get_factor_ic(direction=direction, holding_freq='w',
+                                                               start=bkt_start, end=bkt_end))
+        # IC的衰减表
+        self.run_stage('ic_decay', lambda: self.get_ic_decay(direction=direction, holding_freq='w',
+                                                             start=bkt_start, end=bkt_end))
+        # 画分位数图和long short图，其中每一组的回测结果单独缓存
+        self.run_stage('qgroup', lambda: self.plot_qgroup(bkt_obj, 3, direction=direction, value=1, weight=1))
 
         ###################################################################################################
         # 第七部分, 最后的收尾工作
 
         self.pdfs.close()
 
+        # 输出各阶段的用时
+        target_str = 'Single factor test stages ({0} computed, {1} cached):\n{2}\n'.format(
+            int(np.sum(self.stage_record['status'] == 'computed')),
+            int(np.sum(self.stage_record['status'] == 'cached')), self.stage_record.to_string())
+        print(target_str)
+        with open(str(os.path.abspath('.'))+'/'+self.strategy_data.stock_pool+'/performance.txt',
+                  'a', encoding='GB18030') as text_file:
+            text_file.write(target_str)
+
 
 
 
@@ -16,6 +16,7 @@ import os
 from data import data
 from strategy_data import strategy_data
 from position import position
+from trading_calendar import trading_calendar
 
 # 策略类，根据各种策略选取股票的类，这是一个基本类
 
@@ -75,6 +76,9 @@ class strategy(object):
     @staticmethod
     def resample_tradingdays(time_series, *, freq='m', loc=0):
         # 所取调仓日为每个调仓周期的第一天,注意调仓时间是调仓日的早上,即调仓日当天早上调仓时,拥有上一个周期的所有数据
+        # 交易日历支持的频率, 直接用交易日历中事先算好的每个周期的交易日位置选取调仓日
+        if trading_calendar.get_freq_key(freq) is not None:
+            return trading_calendar(time_series.index).get_rebalance_days(freq, loc=loc)
         resampled_tds = time_series.resample(freq).apply(lambda x:x.index[loc] if x.size>np.abs(loc) else np.nan).dropna()
         # 将resampled_tds改为一个索引和值都是做好的交易日的series
         resampled_tds = pd.Series(resampled_tds.values, index=resampled_tds.values)
@@ -13,9 +13,10 @@ from pandas import Series, DataFrame, Panel
 from datetime import datetime
 import os
 import statsmodels.api as sm
-from cvxopt import solvers, matrix
+from concurrent.futures import ThreadPoolExecutor
 
 from data import data
+from batch_regression import batch_regression
 
 # 数据类，所有数据均为pd.Panel, major_axis为时间，minor_axis为股票代码，items为数据名称
 
@@ -124,31 +125,208 @@ class strategy_data(data):
 
     # 计算因子暴露，简单加权
     @staticmethod
-    def get_exposure(factor, *, percentile = 0.01, compress = True, limit = 3.5):
-        temp_data = strategy_data.winsorization(factor, percentile = percentile)
-        # 如有需要，对尾部数据进行压缩
-        if compress:
-            # 先标准化
-            temp_data = strategy_data.zscore(temp_data)
-            # 进行压缩
-            temp_data = strategy_data.compress_tail_data(temp_data, limit=limit)
-        # 进行标准化
-        final_data = strategy_data.zscore(temp_data)
-        return final_data
+    def get_exposure(factor, *, percentile = 0.01, compress = True, limit = 3.5, n_jobs = 1, dtype = np.float64):
+        return strategy_data.get_fused_exposure(factor, percentile=percentile, compress=compress, limit=limit,
+                                                n_jobs=n_jobs, dtype=dtype)
     
     # 计算市值加权的因子暴露
     @staticmethod
-    def get_cap_wgt_exposure(factor, mv, *, percentile = 0.01, compress = True, limit = 3.5):
-        temp_data = strategy_data.winsorization(factor, percentile = percentile)
-        # 如有需要，对尾部数据进行压缩
+    def get_cap_wgt_exposure(factor, mv, *, percentile = 0.01, compress = True, limit = 3.5, n_jobs = 1,
+                             dtype = np.float64):
+        return strategy_data.get_fused_exposure(factor, mv=mv, percentile=percentile, compress=compress,
+                                                limit=limit, n_jobs=n_jobs, dtype=dtype)
+
+    # 融合的因子暴露计算，对每一期一次完成去极值，（市值加权的）标准化，尾部压缩，再标准化，
+    # 结果与依次调用winsorization，zscore（或cap_wgt_zscore），compress_tail_data，zscore（或cap_wgt_zscore）一致
+    # 中间结果只在一块日期的数组上计算，不再为每一步生成新的dataframe，按日期分块，可以多线程并行计算
+    @staticmethod
+    def get_fused_exposure(factor, *, mv='Empty', percentile=0.01, compress=True, limit=3.5, chunksize=250,
+                           n_jobs=1, dtype=np.float64):
+        """ Get factor exposure with winsorization, standardization and tail compression fused in one pass.
+
+        :param factor: (pd.DataFrame) factor values, dates as index, stocks as columns
+        :param mv: (pd.DataFrame) market value used as weights of mean, 'Empty' means simple mean
+        :param percentile: (float) percentile on which data will be winsorized
+        :param compress: (bool) whether to compress the tail data
+        :param limit: (float) limit of compressed tail data
+        :param chunksize: (int) number of dates processed in one chunk
+        :param n_jobs: (int) number of threads, chunks are processed in parallel if larger than 1
+        :param dtype: (np.dtype) dtype in which data is computed and stored, e.g. np.float32
+        :return: (pd.DataFrame) factor exposure
+        """
+        return strategy_data.get_multi_pool_exposure(factor, mv=mv, percentile=percentile, compress=compress,
+                                                     limit=limit, chunksize=chunksize, n_jobs=n_jobs, dtype=dtype)[0]
+
+    # 同时计算多个股票池的因子暴露，每个股票池的暴露与将股票池外的因子值和市值设为nan后调用get_fused_exposure一致
+    # 每一块日期的数据只排序一次，各股票池去极值的分位数由排序后股票池标记的累计个数找出，不再对每个股票池分别做partition
+    # 去极值之后的标准化与尾部压缩是按股票池标记做的行统计（求和，最大最小值）和逐元素的变换，逐个股票池在同一块数据上完成，
+    # 不再把各股票池的数据叠在一起，内存占用与单个股票池时相当
+    # 注意：这部分的计算量仍然与股票池的个数成正比，节省的只是分位数的计算，以及读取和对齐数据的时间
+    @staticmethod
+    def get_multi_pool_exposure(factor, *, pool_masks='default', mv='Empty', percentile=0.01, compress=True,
+                                limit=3.5, chunksize=250, n_jobs=1, dtype=np.float64):
+        """ Get factor exposures of several stock pools together.
+
+        :param factor: (pd.DataFrame) factor values, dates as index, stocks as columns
+        :param pool_masks: (list) list of pd.DataFrame of bool, True means stock is in the pool,
+            'default' means only one pool with all stocks
+        :param mv: (pd.DataFrame) market value used as weights of mean, 'Empty' means simple mean
+        :param percentile: (float) percentile on which data will be winsorized
+        :param compress: (bool) whether to compress the tail data
+        :param limit: (float) limit of compressed tail data
+        :param chunksize: (int) number of dates processed in one chunk
+        :param n_jobs: (int) number of threads, chunks are processed in parallel if larger than 1
+        :param dtype: (np.dtype) dtype in which data is computed and stored, e.g. np.float32
+        :return: (list) factor exposure of each pool, pd.DataFrame
+        """
+        values = factor.values.astype(dtype)
+        if type(mv) != str:
+            weights = mv.reindex(index=factor.index, columns=factor.columns).values.astype(dtype)
+        else:
+            weights = None
+        if type(pool_masks) != str:
+            masks = np.stack([mask.reindex(index=factor.index, columns=factor.columns, fill_value=False).
+                              fillna(False).values.astype(bool) for mask in pool_masks])
+        else:
+            masks = None
+        n_pools = 1 if masks is None else masks.shape[0]
+        outcome = np.empty((n_pools,) + values.shape, dtype=dtype)
+
+        def process_chunk(start):
+            end = min(start + chunksize, values.shape[0])
+            curr_values = values[start:end]
+            curr_weights = weights[start:end] if weights is not None else None
+            # 只有一个包含所有股票的股票池时，直接用partition找分位数，不需要排序
+            if masks is None:
+                outcome[0, start:end] = strategy_data.standardize_rows(curr_values, curr_weights,
+                    percentile=percentile, compress=compress, limit=limit)
+                return
+            is_valid = np.logical_not(np.isnan(curr_values))
+            # 每一行只排序一次，nan排在最后，所有股票池共用
+            if percentile > 0:
+                order = np.argsort(np.where(is_valid, curr_values, np.inf), axis=1)
+                sorted_values = np.take_along_axis(curr_values, order, axis=1)
+            for i in range(n_pools):
+                in_pool = np.logical_and(masks[i, start:end], is_valid)
+                bounds = strategy_data.get_masked_row_quantiles(sorted_values, np.take_along_axis(in_pool, order,
+                    axis=1), [percentile, 1 - percentile]) if percentile > 0 else 'default'
+                pool_values = np.where(in_pool, curr_values, np.nan)
+                pool_weights = np.where(masks[i, start:end], curr_weights, np.nan) \
+                    if curr_weights is not None else None
+                outcome[i, start:end] = strategy_data.standardize_rows(pool_values, pool_weights,
+                    percentile=percentile, compress=compress, limit=limit, bounds=bounds)
+
+        starts = range(0, values.shape[0], chunksize)
+        if n_jobs > 1:
+            # numpy的计算会释放gil，因此用线程即可并行，且不需要复制数据
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(process_chunk, starts))
+        else:
+            for start in starts:
+                process_chunk(start)
+        return [pd.DataFrame(outcome[i], index=factor.index, columns=factor.columns) for i in range(n_pools)]
+
+    # 每一行有n_valid个有效数据时，分位数对应的上下两个顺序统计量的位置，以及线性插值的比例
+    @staticmethod
+    def get_quantile_positions(n_valid, quantiles):
+        positions = np.maximum(n_valid - 1, 0)[:, np.newaxis] * np.asarray(quantiles, dtype=np.float64)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower + 1, np.maximum(n_valid - 1, 0)[:, np.newaxis])
+        return [lower, upper, positions - lower]
+
+    # 对数组的每一行计算分位数，忽略nan，线性插值，与DataFrame.quantile(axis=1)一致
+    # 用np.partition只找出需要的顺序统计量，不需要对整行排序
+    @staticmethod
+    def get_row_nanquantiles(values, quantiles):
+        n_valid = np.logical_not(np.isnan(values)).sum(1)
+        # nan放到最后，前n_valid个即为有效数据
+        filled = np.where(np.isnan(values), np.inf, values)
+        lower, upper, fraction = strategy_data.get_quantile_positions(n_valid, quantiles)
+        partitioned = np.partition(filled, np.unique(np.concatenate((lower.ravel(), upper.ravel()))), axis=1)
+        lower_values = np.take_along_axis(partitioned, lower, axis=1)
+        upper_values = np.take_along_axis(partitioned, upper, axis=1)
+        with np.errstate(invalid='ignore'):
+            row_quantiles = lower_values * (1 - fraction) + upper_values * fraction
+        return np.where((n_valid > 0)[:, np.newaxis], row_quantiles, np.nan)
+
+    # 在每一行已经升序排列的数组上，只对标记为True的数据计算分位数，与对这些数据调用get_row_nanquantiles一致
+    # 标记的累计个数在每一行中不减，第k个（从0开始）标记的数据即在累计个数第一次超过k的位置，用二分查找找出，
+    # 这样多组标记（如多个股票池）可以共用一次排序，每组标记只需要一次累加
+    @staticmethod
+    def get_masked_row_quantiles(sorted_values, sorted_mask, quantiles):
+        """ Get row quantiles of masked data from row-sorted data.
+
+        :param sorted_values: (np.ndarray) 2d array, each row sorted in ascending order
+        :param sorted_mask: (np.ndarray) 2d array of bool in the same order as sorted_values, True means included
+        :param quantiles: (list) quantiles between 0 and 1
+        :return: (np.ndarray) 2d array of row quantiles, rows * quantiles
+        """
+        n_rows, n_cols = sorted_mask.shape
+        cum_counts = np.cumsum(sorted_mask, axis=1)
+        n_valid = cum_counts[:, -1]
+        lower, upper, fraction = strategy_data.get_quantile_positions(n_valid, quantiles)
+        # 每一行的累计个数加上行的偏移之后，整个数组展开后升序，所有行的查找可以在一次二分查找中完成
+        offsets = np.arange(n_rows)[:, np.newaxis] * (n_cols + 1)
+        flat_counts = (cum_counts + offsets).ravel()
+        def take_order_stats(ranks):
+            locs = np.searchsorted(flat_counts, (ranks + offsets).ravel(), side='right').reshape(ranks.shape) - \
+                   np.arange(n_rows)[:, np.newaxis] * n_cols
+            return np.take_along_axis(sorted_values, np.minimum(locs, n_cols - 1), axis=1)
+        lower_values = take_order_stats(lower)
+        upper_values = take_order_stats(upper)
+        with np.errstate(invalid='ignore'):
+            row_quantiles = lower_values * (1 - fraction) + upper_values * fraction
+        return np.where((n_valid > 0)[:, np.newaxis], row_quantiles, np.nan)
+
+    # 对数组的每一行计算均值（或加权均值）和标准差，忽略nan
+    # 加权均值与cap_wgt_zscore一致：权重之和为所有有权重的股票的权重之和，而不只是有数据的股票，没有任何有效数据时为nan
+    @staticmethod
+    def get_row_mean_std(values, weights):
+        valid = np.logical_not(np.isnan(values))
+        n_valid = valid.sum(1)
+        filled = np.where(valid, values, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            simple_mean = filled.sum(1) / n_valid
+            std = np.sqrt((np.where(valid, values - simple_mean[:, np.newaxis], 0.0) ** 2).sum(1) / (n_valid - 1))
+            if weights is None:
+                mean = simple_mean
+            else:
+                weighted = values * weights
+                weighted_valid = np.logical_not(np.isnan(weighted))
+                weights_valid = np.logical_not(np.isnan(weights))
+                mean = np.where(weighted_valid, weighted, 0.0).sum(1) / np.where(weights_valid, weights, 0.0).sum(1)
+                mean = np.where(np.logical_and(weighted_valid.any(1), weights_valid.any(1)), mean, np.nan)
+        std = np.where(n_valid > 1, std, np.nan)
+        return [mean, std]
+
+    # 对一块日期的数据做融合的标准化，每一行为一期，bounds为事先算好的去极值的上下分位数，'default'为在这里计算
+    @staticmethod
+    def standardize_rows(values, weights, *, percentile=0.01, compress=True, limit=3.5, bounds='default'):
+        # 去极值，percentile为0时上下分位数即为最大最小值，不需要计算
+        if percentile > 0:
+            if type(bounds) == str:
+                bounds = strategy_data.get_row_nanquantiles(values, [percentile, 1 - percentile])
+            bounds = bounds.astype(values.dtype)
+            values = np.minimum(np.maximum(values, bounds[:, 0:1]), bounds[:, 1:2])
         if compress:
             # 先标准化
-            temp_data = strategy_data.cap_wgt_zscore(temp_data, mv)
-            # 进行压缩
-            temp_data = strategy_data.compress_tail_data(temp_data, limit=limit)
+            mean, std = strategy_data.get_row_mean_std(values, weights)
+            values = (values - mean[:, np.newaxis]) / std[:, np.newaxis]
+            # 按照eue3的方法压缩尾部，先平移使得均值为0
+            valid = np.logical_not(np.isnan(values))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                center = np.where(valid, values, 0.0).sum(1) / valid.sum(1)
+                centered = values - center[:, np.newaxis]
+                data_max = np.where(valid, centered, -np.inf).max(1)
+                data_min = np.where(valid, centered, np.inf).min(1)
+                s_plus = np.maximum(0, np.minimum(1, (limit - 3) / (data_max - 3)))
+                s_minus = np.maximum(0, np.minimum(1, (3 - limit) / (data_min + 3)))
+                centered = np.where(centered < 3, centered, (centered - 3) * s_plus[:, np.newaxis] + 3)
+                centered = np.where(centered > -3, centered, (centered + 3) * s_minus[:, np.newaxis] - 3)
+            values = centered + center[:, np.newaxis]
         # 进行标准化
-        final_data = strategy_data.cap_wgt_zscore(temp_data, mv)
-        return final_data
+        mean, std = strategy_data.get_row_mean_std(values, weights)
+        return (values - mean[:, np.newaxis]) / std[:, np.newaxis]
     
     
     # 检查在某一时间，某只股票是否处于可交易状态
@@ -235,35 +413,24 @@ class strategy_data(data):
     # 对数据进行回归取残差提纯，即gram-schmidt正交化
     @staticmethod
     def simple_orth_gs(obj, base, *, weights = 'default', add_constant=True):
-        # 定义回归函数
+        # 所有期的回归用批量回归一次完成，结果与每期分别用statsmodels.WLS(missing='drop')回归一致
         # 注意，用barra base回归时，行业暴露已经包含截距项，因此不能再添加截距项
-        def reg_func(y, x, *, weights=1, add_constant=True):
-            if add_constant:
-                x = sm.add_constant(x)
-            # 如果只有小于等于1个有效数据，则返回nan序列
-            if pd.concat([y,x], axis=1).dropna().shape[0] <= 1:
-                return 'empty'
-            model = sm.WLS(y, x, weights=weights, missing='drop')
-            results = model.fit()
-            return results
-        new_obj = obj*np.nan
-        pvalues = pd.DataFrame(np.nan, index=obj.index, columns=base.items)
-        rsquared_adj = pd.DataFrame(np.nan, index=obj.index, columns=['rsquared_adj'])
-        if weights is 'default':
-            for cursor, date in enumerate(obj.index):
-                curr_results = reg_func(obj.ix[cursor], base.ix[:,cursor,:], add_constant=add_constant)
-                if type(curr_results) != str:
-                    new_obj.ix[cursor] = curr_results.resid.reindex(obj.columns)
-                    pvalues.ix[cursor] = curr_results.pvalues
-                    rsquared_adj.ix[cursor] = curr_results.rsquared_adj
+        base = base.reindex(major_axis=obj.index, minor_axis=obj.columns)
+        if type(weights) != str:
+            weights = weights.reindex(index=obj.index, columns=obj.columns)
+            reg_weights = weights.values
         else:
-            for cursor, date in enumerate(obj.index):
-                curr_results = reg_func(obj.ix[cursor], base.ix[:,cursor,:], weights=weights.ix[cursor],
-                                        add_constant=add_constant)
-                if type(curr_results) != str:
-                    new_obj.ix[cursor] = curr_results.resid.reindex(obj.columns)
-                    pvalues.ix[cursor] = curr_results.pvalues
-                    rsquared_adj.ix[cursor] = curr_results.rsquared_adj
+            reg_weights = 'default'
+        # 如果只有小于等于1个有效数据，则这一期的结果为nan
+        resid, params, t_stats, p_values, rsquared, rsquared_adj_values = batch_regression.batch_wls(
+            obj.values, base.values, weights=reg_weights, add_constant=add_constant, min_obs=1)
+        new_obj = pd.DataFrame(resid, index=obj.index, columns=obj.columns)
+        # 有截距项时，截距项为第一个变量，其p值不需要储存
+        if add_constant:
+            p_values = p_values[:, 1:]
+        pvalues = pd.DataFrame(p_values, index=obj.index, columns=base.items)
+        rsquared_adj = pd.DataFrame(rsquared_adj_values, index=obj.index, columns=['rsquared_adj'])
+        if type(weights) != str:
             # 如果提纯为加权的回归，则默认提纯是为了之后这个残差和base进行加权回归时相互正交
             # 即：实际为残差和加权（加根号权重）后的base因子正交，那么在之后进行加权回归的时候，会再一次的进行加权
             # 为了避免残差因子在那个时候连加两次权，这里必须进行调整，即：除以根号权重
@@ -271,90 +438,106 @@ class strategy_data(data):
             new_obj = new_obj.div(np.sqrt(weights))
         return [new_obj, pvalues, rsquared_adj]
             
-    # 用因子暴露数据，回归权重，进行barra模型的回归
-    # 用二次规划问题求解此线性回归问题
-    # 目前，基于barra的业绩归因、barra基础因子内部回归都可以用这个线性回归模型，暂不支持新增因子
+    # 用因子暴露数据，回归权重，进行barra模型的回归，一次求解所有日期的带约束加权最小二乘，即行业因子收益的加权和为0
+    # 目前，基于barra的业绩归因、barra基础因子内部回归都用这个线性回归模型
+    # 只有一个等式约束的加权最小二乘问题，其解满足一个(因子数+1)阶的kkt线性方程组，因此不需要每期都调用二次规划求解器
+    # 将每期的因子暴露堆叠成日期*股票*因子的数组，用mask标记每期缺失的股票，以及股票池中没有股票的行业（或被删除的风格因子）
+    # 得到的因子收益和残差与逐期用二次规划求解的结果一致
     @staticmethod
-    def constrained_gls_barra_base(asset_return, bb, *, weights='default', indus_ret_weights = 'default'):
-        """Solving constrained gls problem using quadratic programming.
-        
-        asset_return: return of asset universe.
-        bb: barra base factor exposures, including style factors and industrial factors
-        weights: weights of gls, usually the sqrt of mv, default means equal weight
-        indus_ret_weights: weights that put on the constraints of industry factors returns, usually as the \
-                           market value, default means equal weight
+    def constrained_gls_barra_base_batch(asset_return, bb, *, weights='default', indus_ret_weights='default',
+                                         chunksize=250):
+        """Solving constrained gls problems of all dates at once using the kkt system.
+
+        :param asset_return: (pd.DataFrame) return of asset universe, with dates as index and stocks as columns
+        :param bb: (pd.Panel) barra base factor exposures, including style factors and industrial factors
+        :param weights: (pd.DataFrame) weights of gls, usually the sqrt of mv, default means equal weight
+        :param indus_ret_weights: (pd.DataFrame) weights that put on the constraints of industry factors returns,
+            usually as the market value, default means equal weight
+        :param chunksize: (int) number of dates solved together, which controls the peak memory of the stacked arrays
+        :return: (list) factor returns (pd.DataFrame, dates * factors) and residuals (pd.DataFrame, dates * stocks),
+            which are the same as solving the quadratic programming date by date
         """
-        if weights is 'default':
-            weights = pd.Series(1, index=asset_return.index)
-        if indus_ret_weights is 'default':
-            indus_ret_weights = pd.Series(1, index=asset_return.index)
-            
-        # 设置权重
-        # 回归的权重需要开根号
-        sqrt_w = np.sqrt(weights)
-        y = asset_return.mul(sqrt_w)
-        # bb中股票为index，因子名字为columns
-        x = bb.mul(sqrt_w, axis=0)
-        
-        # 只要有na，就drop掉这只股票
-        yx = pd.concat([y,x], axis=1)
-        yx = yx.dropna()
-        # 如果只有小于等于1个有效数据，返回nan序列
-        if yx.shape[0] <= 1:
-            return np.empty(x.shape[1])*np.nan
-        y = yx.ix[:, 0]
-        x = yx.ix[:, 1:]
-
-        # 设置行业因子收益限制条件，行业因子暴露为x中的第 11 列到第 38 列
-        # 行业因子的限制权重，循环在行业因子中求和
-        final_weight = pd.Series(np.arange(28) * 0, index=x.columns[10:38])
-        for cursor in range(10, 38):
-            final_weight.iloc[cursor - 10] = (indus_ret_weights * x.ix[:, cursor]).sum()
-        final_weight = final_weight / (final_weight.sum())
-
-        # 储存结果的series
-        results_s = pd.Series(np.nan, index=x.columns)
-
-        # 移除被删除的风格因子，或股票池中不包含的行业因子
-        # 首先，x中暴露全为0的因子，一定是要被删除的
-        x = x.replace(0, np.nan).dropna(axis=1, how='all').fillna(0.0)
-        # 判断行业因子中有多少要被移除的，只需要看final_weight中有多少权重是0
-        final_weight = final_weight.replace(0, np.nan).dropna()
-        num_valid_all = x.shape[1]
-        num_valid_indus = final_weight.shape[0]
-        num_valid_style = num_valid_all - num_valid_indus - 1
-
-        # 设置行业因子收益的加权求和限制为0
-        indus_cons = pd.Series(np.arange(num_valid_all) * 0)
-        # 系数的第11到38项设置为行业因子收益的权重，注意如果有被移除的行业因子，则需要对应调整
-        indus_cons.iloc[num_valid_style:num_valid_all-1] = final_weight.values
-
-        # 开始设置优化
-        # P = X.T dot X
-        P = matrix(np.dot(x.as_matrix().transpose(), x.as_matrix()))
-        # q = - (X.T dot Y)
-        q = matrix(-np.dot(x.as_matrix().transpose(), y.as_matrix()))
-
-        # 设置限制条件
-        A = matrix(indus_cons.as_matrix(), (1, indus_cons.size))
-        b = matrix(0.0)
-        
-        # 隐藏优化器输出
-        solvers.options['show_progress'] = False
-        # 解优化问题
-        results = solvers.qp(P=P, q=q, A=A, b=b)
-        # 将数据类型改为(n,)的ndarray
-        results_np = np.array(results['x']).squeeze()
-
-        # 将结果对应到相应的因子上，构成结果的series
-        results_s[x.columns] = results_np
-        # 不存在的因子收益，可以认为它的收益是0
-        results_s = results_s.fillna(0)
-
-        # 计算残差
-        residuals = y - x.dot(results_np)
-        
-        return [results_s, residuals]
+        dates = asset_return.index
+        stocks = asset_return.columns
+        bb = bb.reindex(major_axis=dates, minor_axis=stocks)
+        if type(weights) == str and weights == 'default':
+            weights = pd.DataFrame(1.0, index=dates, columns=stocks)
+        else:
+            weights = weights.reindex(index=dates, columns=stocks)
+        if type(indus_ret_weights) == str and indus_ret_weights == 'default':
+            indus_ret_weights = pd.DataFrame(1.0, index=dates, columns=stocks)
+        else:
+            indus_ret_weights = indus_ret_weights.reindex(index=dates, columns=stocks)
+
+        n_factor = bb.items.size
+        # 行业因子为以Industry开头的因子，即pd.get_dummies的前缀
+        is_indus = np.array([str(item).startswith('Industry') for item in bb.items])
+
+        factor_return = np.empty((dates.size, n_factor)) * np.nan
+        residuals = np.empty((dates.size, stocks.size)) * np.nan
+        # 按日期分块求解，控制堆叠数组的内存
+        for start in range(0, dates.size, chunksize):
+            end = min(start + chunksize, dates.size)
+            n_dates = end - start
+            # 设置权重，回归的权重需要开根号
+            sqrt_w = np.sqrt(weights.values[start:end])
+            y = asset_return.values[start:end] * sqrt_w
+            # 日期*股票*因子
+            x = bb.values[:, start:end, :].transpose(1, 2, 0) * sqrt_w[:, :, np.newaxis]
+
+            # 只要有na，这只股票就不参与当期的回归，将其数据设为0，使其对各个求和都没有贡献
+            valid = np.logical_and(np.logical_not(np.isnan(y)), np.logical_not(np.isnan(x).any(2)))
+            y = np.where(valid, y, 0.0)
+            x = np.where(valid[:, :, np.newaxis], x, 0.0)
+            # 如果只有小于等于1个有效数据，当期返回nan
+            enough = valid.sum(1) > 1
+
+            # 行业因子收益的限制权重，为行业中股票的indus_ret_weights乘以暴露的求和
+            indus_w = indus_ret_weights.values[start:end]
+            indus_w = np.where(np.isnan(indus_w), 0.0, indus_w)
+            cons = np.einsum('tn,tnk->tk', indus_w, x)
+            cons[:, np.logical_not(is_indus)] = 0.0
+            cons_sum = cons.sum(1)
+            has_cons = cons_sum != 0
+            cons[has_cons] = cons[has_cons] / cons_sum[has_cons, np.newaxis]
+
+            # kkt方程组: [X'X, c; c', 0] * [f; lambda] = [X'y; 0]
+            kkt = np.zeros((n_dates, n_factor + 1, n_factor + 1))
+            kkt[:, :n_factor, :n_factor] = np.einsum('tnk,tnl->tkl', x, x)
+            kkt[:, :n_factor, n_factor] = cons
+            kkt[:, n_factor, :n_factor] = cons
+            rhs = np.zeros((n_dates, n_factor + 1))
+            rhs[:, :n_factor] = np.einsum('tnk,tn->tk', x, y)
+
+            # 暴露全为0的因子（被删除的风格因子，或股票池中不包含的行业因子）不参与回归
+            # 将其对应的行列只保留对角线上的1，则解出的因子收益为0，与不存在的因子收益为0的处理一致
+            t_idx, k_idx = np.nonzero(np.logical_not((x != 0).any(1)))
+            kkt[t_idx, k_idx, :] = 0.0
+            kkt[t_idx, :, k_idx] = 0.0
+            kkt[t_idx, k_idx, k_idx] = 1.0
+            rhs[t_idx, k_idx] = 0.0
+            # 没有行业约束的日期，拉格朗日乘子也只保留对角线上的1
+            kkt[np.logical_not(has_cons), n_factor, n_factor] = 1.0
+            # 有效数据不足的日期，用单位阵占位，之后结果设为nan
+            kkt[np.logical_not(enough)] = np.eye(n_factor + 1)
+            rhs[np.logical_not(enough)] = 0.0
+
+            try:
+                solution = np.linalg.solve(kkt, rhs[:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                # 有奇异的方程组时（如有效股票数少于因子数），改用伪逆求解
+                solution = np.einsum('tij,tj->ti', np.linalg.pinv(kkt), rhs)
+            curr_return = solution[:, :n_factor]
+            # 计算残差，注意残差为加权后的残差
+            curr_resid = y - np.einsum('tnk,tk->tn', x, curr_return)
+
+            curr_return[np.logical_not(enough)] = np.nan
+            factor_return[start:end] = curr_return
+            residuals[start:end] = np.where(np.logical_and(valid, enough[:, np.newaxis]), curr_resid, np.nan)
+
+        factor_return = pd.DataFrame(factor_return, index=dates, columns=bb.items)
+        residuals = pd.DataFrame(residuals, index=dates, columns=stocks)
+        return [factor_return, residuals]
 
     # 此函数用于计算基准的因子暴露，以及涉及基准的因子暴露计算的超额因子暴露的计算的调整
     # 在计算基准的因子暴露时（或基于基准因子暴露的超额组合因子暴露），会出现基准中的成分股不能交易的情况，
@@ -480,4 +663,30 @@ class strategy_data(data):
         
         
         
-    
\ No newline at end of file
+    
+    # 将行业等类别数据一次性编码为整数，所有日期共用一套编码，编码按照类别排序，nan的编码为-1
+    @staticmethod
+    def encode_labels(labels):
+        """ Encode labels of all dates into integer codes.
+
+        :param labels: (pd.DataFrame) labels, such as industry, dates as index, stocks as columns
+        :return: (list) [codes, uniques], codes is np.ndarray of the same shape as labels, uniques is pd.Index of
+            sorted labels, label of code i is uniques[i]
+        """
+        codes, uniques = pd.factorize(labels.values.ravel(), sort=True)
+        return [codes.reshape(labels.shape), pd.Index(uniques)]
+
+    # 根据类别的编码生成虚拟变量，即第i个类别的虚拟变量为编码为i的位置为1，其余为0，编码为-1（nan）的位置全为0
+    @staticmethod
+    def get_dummies_from_codes(codes, n_classes, *, dtype=np.float64):
+        """ Get one-hot dummies from integer codes.
+
+        :param codes: (np.ndarray) dates*stocks integer codes, -1 means nan
+        :param n_classes: (int) number of classes
+        :param dtype: (np.dtype) dtype of dummies, e.g. np.int8
+        :return: (np.ndarray) classes*dates*stocks array of dummies
+        """
+        dummies = np.zeros((n_classes,) + codes.shape, dtype=dtype)
+        date_loc, stock_loc = np.nonzero(codes >= 0)
+        dummies[codes[date_loc, stock_loc], date_loc, stock_loc] = 1.0
+        return dummies
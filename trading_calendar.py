@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+# 交易日历，由交易日表建立一次，之后所有对交易日的查找都用整数位置完成
+# 日期到位置的查找用dict，为O(1)，每个交易日所在的周，月，季度，年的编号以及每个周期的第一个和最后一个交易日的位置都事先算好，
+# 以替代对价格序列做resample().apply()选调仓日，以及在回测中反复做get_loc，in，asof等查找的方式
+# 约定：周为周一到周日，与pandas中resample('w')的周期一致，周期编号只在同一频率内可比
+
+class trading_calendar(object):
+    """ This is the class of trading calendar.
+
+    trading_days (pd.DatetimeIndex): all trading days in ascending order
+    """
+    # 支持的频率
+    freqs = ['d', 'w', 'm', 'q', 'a']
+
+    def __init__(self, trading_days):
+        self.trading_days = pd.DatetimeIndex(trading_days)
+        self.date_positions = dict(zip(self.trading_days, range(self.trading_days.size)))
+        # 每个频率下，每个交易日所在周期的编号，以及每个周期第一个和最后一个交易日的位置
+        self.period_ids = {}
+        self.period_starts = {}
+        self.period_ends = {}
+        for freq in trading_calendar.freqs:
+            ids = self.get_period_ids(freq)
+            is_start = np.ones(ids.size, dtype=bool)
+            is_start[1:] = ids[1:] != ids[:-1]
+            is_end = np.ones(ids.size, dtype=bool)
+            is_end[:-1] = is_start[1:]
+            self.period_ids[freq] = ids
+            self.period_starts[freq] = np.flatnonzero(is_start)
+            self.period_ends[freq] = np.flatnonzero(is_end)
+
+    # 从数据库的交易日表建立交易日历
+    @staticmethod
+    def from_database(*, start_date='default', end_date='default', market='83'):
+        from database import database
+        db = database(start_date=start_date, end_date=end_date, market=market)
+        db.initialize_jydb()
+        db.get_trading_days()
+        return trading_calendar(pd.to_datetime(db.trading_days.values))
+
+    # 标准化频率的写法，如'M'，'W'为'm'，'w'，'y'为'a'，不支持的频率返回None
+    @staticmethod
+    def get_freq_key(freq):
+        freq_key = str(freq).lower()
+        freq_key = 'a' if freq_key == 'y' else freq_key
+        return freq_key if freq_key in trading_calendar.freqs else None
+
+    # 每个交易日所在周期的编号
+    def get_period_ids(self, freq='m'):
+        """ Get period ids of all trading days.
+
+        :param freq: (str) frequency of periods, 'd', 'w', 'm', 'q' or 'a'
+        :return: (np.ndarray) integer period ids of trading days
+        """
+        freq = trading_calendar.get_freq_key(freq)
+        if freq in self.period_ids:
+            return self.period_ids[freq]
+        days = self.trading_days.values.astype('datetime64[D]').astype(np.int64)
+        if freq == 'd':
+            return days
+        # 1970-01-01为周四，加3之后周一为每周的第一天
+        if freq == 'w':
+            return (days + 3) // 7
+        months = self.trading_days.values.astype('datetime64[M]').astype(np.int64)
+        if freq == 'm':
+            return months
+        if freq == 'q':
+            return months // 3
+        return months // 12
+
+    # 日期在交易日历中的位置，O(1)的查找，不是交易日的日期会报错
+    def get_loc(self, date):
+        return self.date_positions[pd.Timestamp(date)]
+
+    # 一组日期在交易日历中的位置，不是交易日的日期位置为-1
+    def get_locs(self, dates):
+        return self.trading_days.get_indexer(pd.DatetimeIndex(dates))
+
+    # 一组日期在所有交易日上的标记，如调仓日的标记
+    def get_day_mask(self, dates):
+        locs = self.get_locs(dates)
+        mask = np.zeros(self.trading_days.size, dtype=bool)
+        mask[locs[locs >= 0]] = True
+        return mask
+
+    # 调仓日，即每个周期中的第loc个交易日，结果与strategy.resample_tradingdays中对价格序列做resample的结果一致
+    # 即loc为0时是每个周期的第一个交易日，loc为-1时是最后一个交易日，周期内交易日不超过abs(loc)个的周期没有调仓日
+    def get_rebalance_days(self, freq='m', *, loc=0, start='default', end='default'):
+        """ Get rebalance days of each period.
+
+        :param freq: (str) frequency of periods, 'd', 'w', 'm', 'q' or 'a'
+        :param loc: (int) position of rebalance day in each period, negative means counting from the end
+        :param start: (pd.Timestamp) start date of rebalance days
+        :param end: (pd.Timestamp) end date of rebalance days
+        :return: (pd.Series) rebalance days as both values and index
+        """
+        freq = trading_calendar.get_freq_key(freq)
+        starts = self.period_starts[freq]
+        ends = self.period_ends[freq]
+        sizes = ends - starts + 1
+        rebalance_locs = starts + loc if loc >= 0 else ends + 1 + loc
+        rebalance_days = self.trading_days[rebalance_locs[sizes > np.abs(loc)]]
+        rebalance_days = pd.Series(rebalance_days, index=rebalance_days)
+        if start != 'default':
+            rebalance_days = rebalance_days[start:]
+        if end != 'default':
+            rebalance_days = rebalance_days[:end]
+        return rebalance_days
+
+    # 每个日期之前（包括当天）的最后一个调仓日，即对调仓日做asof，调仓日要求升序排列，在第一个调仓日之前的日期为NaT
+    @staticmethod
+    def get_asof_days(rebalance_days, dates):
+        rebalance_days = pd.DatetimeIndex(rebalance_days)
+        asof_locs = np.searchsorted(rebalance_days.values, pd.DatetimeIndex(dates).values, side='right') - 1
+        asof_days = pd.Series(rebalance_days[np.maximum(asof_locs, 0)], index=dates)
+        asof_days[asof_locs < 0] = pd.NaT
+        return asof_days